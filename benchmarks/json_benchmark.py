@@ -0,0 +1,77 @@
+"""
+Decode time and peak memory of big vault listings: json (response.json), orjson and streaming.
+Streaming keeps memory flat but decodes slower than json.loads. Projection runs on every item after it is
+fully decoded, so it saves memory of kept items only, not decode time.
+Run from project root: python -m benchmarks.json_benchmark --vaults 5000
+"""
+import json
+import time
+import argparse
+import tracemalloc
+
+from modules.superform_api import loads, iter_json_items, _project, orjson, ijson
+
+FIELDS = ('id', 'chain.id', 'vault_statistics.apy', 'vault_statistics.tvl_now')
+
+
+def build_payload(vaults_number: int) -> bytes:
+    vaults = []
+    for i in range(vaults_number):
+        vaults.append({
+            'id': f'vault-{i}',
+            'superform_id': str(6277101737052240744009225870848007040394826011474577400000 + i),
+            'name': f'Vault {i}',
+            'description': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit. ' * 8,
+            'chain': {'id': 8453, 'name': 'Base', 'logo': 'https://example.com/base.png'},
+            'protocol': {'id': i % 50, 'name': f'Protocol {i % 50}', 'vanity_url': f'protocol-{i % 50}',
+                         'links': [f'https://example.com/{j}' for j in range(5)]},
+            'asset': {'symbol': 'WETH', 'decimals': 18, 'address': '0x4200000000000000000000000000000000000006'},
+            'vault_statistics': {'apy': 3.21 + i % 7, 'tvl_now': 1_000_000.5 + i, 'share_price': 1.0123,
+                                 'apy_history': [{'timestamp': 1_700_000_000 + j, 'apy': 3.0 + j / 100}
+                                                 for j in range(20)]},
+            'tags': ['lending', 'eth', 'blue-chip'],
+        })
+    return json.dumps(vaults).encode()
+
+
+def chunks(payload: bytes, size: int = 64 * 1024):
+    for i in range(0, len(payload), size):
+        yield payload[i:i + size]
+
+
+def measure(name: str, func, baseline: float = None) -> float:
+    """
+    Time is measured without tracemalloc, it slows down allocations a lot
+    :param baseline: (opt) seconds of json.loads, time is also printed relative to it
+    :return: seconds
+    """
+    start = time.perf_counter()
+    count = func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    ratio = elapsed / baseline if baseline else 1.
+    print(f'{name:<32}{elapsed:>8.3f} s{ratio:>7.2f}x{peak / 2 ** 20:>10.1f} MB peak  {count} vaults')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--vaults', type=int, default=5000)
+    args = parser.parse_args()
+
+    payload = build_payload(args.vaults)
+    print(f'payload {len(payload) / 2 ** 20:.1f} MB, orjson: {orjson is not None}, '
+          f'ijson: {ijson.backend if ijson else None}')
+
+    baseline = measure('json.loads', lambda: len(json.loads(payload)))
+    measure('loads', lambda: len(loads(payload)), baseline)
+    measure('loads + projection', lambda: len([_project(vault, FIELDS) for vault in loads(payload)]), baseline)
+    measure('streaming', lambda: sum(1 for _ in iter_json_items(chunks(payload))), baseline)
+    measure('streaming + projection', lambda: sum(1 for _ in iter_json_items(chunks(payload), FIELDS)), baseline)
+
+
+if __name__ == '__main__':
+    main()
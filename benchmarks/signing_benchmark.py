@@ -0,0 +1,67 @@
+"""
+Signatures per second of inline signing (as in sign_tx), inline signing from threads and SigningService.
+Run from project root: python -m benchmarks.signing_benchmark --txs 5000 --wallets 500
+"""
+import time
+import argparse
+
+from concurrent.futures import ThreadPoolExecutor
+
+from web3 import Web3
+from eth_account import Account
+
+from utils.signing import SigningService
+
+
+def build_txs(accounts, txs_number: int):
+    txs = []
+    for i in range(txs_number):
+        account = accounts[i % len(accounts)]
+        txs.append({
+            'from': account.address,
+            'to': '0xa195608C2306A26f727d5199D5A382a4508308DA',
+            'value': 10 ** 15,
+            'data': '0x' + 'ab' * 228,
+            'gas': 350_000,
+            'maxFeePerGas': 10 ** 8,
+            'maxPriorityFeePerGas': 10 ** 6,
+            'nonce': i // len(accounts),
+            'chainId': 8453,
+            'type': '0x2',
+        })
+    return txs
+
+
+def measure(name: str, func, txs_number: int):
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    print(f'{name:<24}{txs_number / elapsed:>12.0f} sig/s  {elapsed:.2f} s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--txs', type=int, default=2000)
+    parser.add_argument('--wallets', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=0, help='signing processes, 0 - one per cpu')
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+
+    accounts = [Account.create() for _ in range(args.wallets)]
+    keys = {account.address: account.key for account in accounts}
+    txs = build_txs(accounts, args.txs)
+    w3 = Web3()
+
+    measure('inline', lambda: [w3.eth.account.sign_transaction(tx, keys[tx['from']]) for tx in txs], args.txs)
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        measure(f'inline, {args.threads} threads',
+                lambda: list(pool.map(lambda tx: w3.eth.account.sign_transaction(tx, keys[tx['from']]), txs)),
+                args.txs)
+
+    with SigningService(keys.values(), workers=args.workers) as service:
+        service.sign(txs[:1])  # start workers and load keys before measuring
+        measure('SigningService', lambda: service.sign(txs), args.txs)
+
+
+if __name__ == '__main__':
+    main()
@@ -4,10 +4,33 @@ script_name = 'Superform'
 
 
 log_file = './logs/superform'
+log_json = True  # write log file as json lines with wallet and vault fields
+log_compression = 'gz'
+metrics_file = './logs/metrics.prom'
+trace_file = './logs/traces.jsonl'  # set to '' to disable tracing
+
+# record api and rpc traffic to cassette or replay it offline: '', 'record' or 'replay'
+cassette_mode = ''
+cassette_file = './files/cassettes/run.jsonl.gz'
+cassette_speed = 0  # replay speed multiplier for recorded latency, 0 - as fast as possible
 keys_file = './files/keys'
 wallets_file = './files/wallets'
+rpc_pool_size = 32  # keep-alive connections per rpc host shared by all accounts
+rpc_timeout = 30
+key_loader_workers = 0  # processes to derive addresses in, 0 - derive lazily when address is used
+signing_workers = 0  # processes to sign transactions in bulk, 0 - one per cpu
+signing_chunk_size = 64  # transactions per signing worker task
+broadcast_batch_size = 50  # raw transactions in one json-rpc batch request
 
 minimum_balance_left = 0.02
+price_ttl = 60  # seconds while CoinGecko price is fresh
+price_stale_ttl = 600  # seconds after price_ttl while old price is used and refreshed in background
+
+safari_season = 4
+points_snapshot_dir = './files/snapshots/points'
+points_fetch_workers = 8
+claim_plan_file = './files/claim_plan.json'
+claim_plan_workers = 8
 
 sleeping_time = {
     'default': (30, 60),
@@ -15,11 +38,69 @@ sleeping_time = {
     ConnectionError: (300, 500),
     'other_exception': (50, 150),
 }
+retry_max_attempts = 3  # failed wallet operation is scheduled again with delay from sleeping_time
+retry_workers = 1  # wallet operations running at the same time
+dead_letter_file = './files/dead_letter.jsonl'
 
 
 superform_router_address = '0xa195608C2306A26f727d5199D5A382a4508308DA'
 eth_address = '0xEeeeeEeeeEeEeeEeEeEeeEEEeeeeEeeeeeeeEEeE'
 weth_address = '0x4200000000000000000000000000000000000006'
+multicall3_address = '0xcA11bde05977b3631167028862bE2a173976CA11'  # same address on all chains
+
+# pre-flight deposits and withdrawals with eth_estimateGas and state overrides on our rpc, gas is reused for tx
+local_simulation = True
+# also run Superform API simulations, they are used anyway if local_simulation is disabled
+remote_simulation = False
+# storage slot of allowance mapping, allows to simulate as if token was approved, WETH9 - slot 4
+allowance_storage_slots = {
+    weth_address: 4,
+}
+# gas limit is learned from receipts per (chain, to, method selector, vault) and replaces eth_estimateGas
+gas_profiles_file = './files/gas_profiles.json'
+gas_profile_quantile = 0.95
+gas_profile_margin = 1.1
+gas_profile_min_samples = 5
+
+# same address on all supported chains, could be checked with SuperFormApi.get_contract_deployment_address()
+super_positions_address = '0x01dF6fb6a28a89d6bFa53b2b3F20644AbF417678'
+# fill from get_contract_deployment_address(), claims are not sent and reward events are not watched while it is empty
+rewards_distributor_address = ''
+watcher_poll_interval = 12
+watcher_confirmations = 2
+positions_db_file = './files/positions.db'
+get_logs_initial_range = 2_000
+get_logs_max_range = 50_000
+
+# multi-chain balance scan, network ids according to get_network_by_chain_id
+scan_network_ids = [13, 3, 0, 7, 6, 15, 14]
+scan_tokens = {3: [weth_address]}  # {network id: [erc20 token addresses]}
+# {network id: [superform ids]} to scan SuperPositions, taken from portfolios of wallets if empty
+scan_superform_ids = {}
+scan_batch_size = 500
+scan_report_file = './files/multichain_scan.json'
+
+# staged deposits: plan -> simulate -> sign -> broadcast, every stage has own worker threads
+pipeline_plan_file = './files/deposit_plan.json'
+pipeline_workers = {'simulate': 4, 'sign': 2, 'broadcast': 4}
+# sign waiting transactions in SigningService process pool and send them in json-rpc batches,
+# pays off with several free cpu cores, on 1-2 cores inline signing is faster, see benchmarks/signing_benchmark.py
+pipeline_bulk_signing = False
+pipeline_batch_size = 20
+
+# vault reallocation of all wallets from vault stats, portfolios and gas costs
+rebalance_max_vault_share = 0.5  # max part of wallet value in one vault
+rebalance_max_tvl_share = 0.05  # max part of vault tvl held by all our wallets together
+rebalance_min_tvl = 100_000  # usd, smaller vaults are not used as targets
+rebalance_min_move_gas_multiple = 10  # skip deposit or withdrawal smaller than gas cost x this value
+rebalance_horizon_days = 30  # extra yield over this period has to pay for gas of wallet moves
+rebalance_gas_units = 700_000  # gas of one vault operation, used to estimate usd cost per chain
+rebalance_plan_file = './files/rebalance_plan.json'
+
+# history of vault apy and tvl, memory-mapped columns with fixed number of vaults
+vault_history_dir = './files/vault_history'
+vault_history_capacity = 4096  # max vaults, fixed when store is created
+vault_history_interval = 600  # seconds between snapshots
 
 morpho_well_eth_vault_id = 'pxOqM7dFwI2Abt-yTv4jC'   # Base Moonwell Flagship ETH
 
@@ -29,3 +110,6 @@ swap_slippage = 10  # 0.1%
 # add tg token if you want to send error messages somewhere
 tg_token = ''
 tg_chat_id = ''
+notifier_window = 60  # seconds to group identical errors into one message
+notifier_queue_size = 1000
+notifier_min_interval = 1  # seconds between messages
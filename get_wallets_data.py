@@ -1,29 +1,27 @@
-import time
-import random
+import json
 
 from loguru import logger
 
-from config import sleeping_time, log_file, wallets_file
-from modules.superform_api import SuperFormApi
-from utils.helpful_scripts import load_wallets, load_logger, catch_errors
-
-
-@catch_errors(sleeping_time)
-def get_points_wallets(address):
-    api_bot = SuperFormApi()
-    logger.info(api_bot.get_safari_points(address=address, season=4))
+from config import log_file, metrics_file, wallets_file, safari_season
+from modules.points_aggregator import PointsAggregator
+from utils.helpful_scripts import load_wallets, load_logger
+from utils.metrics import metrics
 
 
 def use_script():
+    load_logger(log_file)
     addresses = load_wallets(wallets_file)
     total_account = len(addresses)
     logger.info(f"Loaded for {total_account} accounts")
 
-    for address in addresses:
-        load_logger(log_file)
-        random_sleep = random.randint(1, 3)
-        get_points_wallets(address=address)
-        time.sleep(random_sleep)
+    report = PointsAggregator(season=safari_season).run(addresses)
+    logger.info(f"Season {safari_season} aggregates: {json.dumps(report['aggregates'])}")
+    logger.info(f"{len(report['changed'])} wallets changed since previous snapshot")
+    for wallet in report['changed']:
+        logger.info(wallet)
+
+    logger.info(f'Metrics summary: {metrics.dump(metrics_file)}')
+    logger.complete()
 
 
 if __name__ == '__main__':
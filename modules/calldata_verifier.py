@@ -0,0 +1,154 @@
+import json
+import functools
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Tuple
+
+from web3 import Web3
+from eth_account.account import ChecksumAddress
+
+from utils.constants import ZERO_ADDRESS
+from config import superform_router_address, rewards_distributor_address, eth_address
+
+abi_files = {
+    'SuperformRouter': 'files/abis/superform/SuperformRouter.json',
+    'RewardsDistributor': 'files/abis/superform/RewardsDistributor.json',
+}
+
+CLAIM_FUNCTIONS = ('claim', 'batchClaim')
+
+
+@functools.lru_cache(maxsize=None)
+def _decoder(name: str):
+    """
+    :return: contract without address, used only to decode calldata, abi is read once
+    """
+    abi = json.load(Path(abi_files[name]).open())
+    return Web3().eth.contract(abi=abi['abi'] if isinstance(abi, dict) else abi)
+
+
+def decode_router_call(data: str) -> Tuple[str, List[Dict]]:
+    """
+    Decodes SuperformRouter calldata, single and multi vault requests are flattened to one item per vault
+    :return: (function name, [{'superform_id', 'amount', 'output_amount', 'max_slippage', 'liq_token',
+        'native_amount', 'receiver', 'receiver_sp', 'retain4626'}])
+    """
+    function, params = _decoder('SuperformRouter').decode_function_input(data)
+    request = params['req_']
+    superforms_data = request.get('superformsData', request.get('superformData'))
+    if isinstance(superforms_data, dict):
+        superforms_data = [superforms_data]
+
+    legs = []
+    for superform_data in superforms_data:
+        if 'superformIds' in superform_data:
+            rows = zip(superform_data['superformIds'], superform_data['amounts'], superform_data['outputAmounts'],
+                       superform_data['maxSlippages'], superform_data['liqRequests'], superform_data['retain4626s'])
+        else:
+            rows = [(superform_data['superformId'], superform_data['amount'], superform_data['outputAmount'],
+                     superform_data['maxSlippage'], superform_data['liqRequest'], superform_data['retain4626'])]
+        for superform_id, amount, output_amount, max_slippage, liq_request, retain4626 in rows:
+            legs.append({
+                'superform_id': superform_id,
+                'amount': amount,
+                'output_amount': output_amount,
+                'max_slippage': max_slippage,
+                'liq_token': liq_request['token'],
+                'native_amount': liq_request['nativeAmount'],
+                'receiver': superform_data['receiverAddress'],
+                'receiver_sp': superform_data['receiverAddressSP'],
+                'retain4626': retain4626,
+            })
+    return function.fn_name, legs
+
+
+def verify_router_tx(tx_data: Dict, operation: str, user: ChecksumAddress, superform_id: int | str,
+                     max_slippage: int, amount: int = None, token: str = None) -> List[str]:
+    """
+    Checks transaction built by api against the quote we asked for
+    :param tx_data: start_deposit or start_withdrawal response with 'to', 'data' and 'value'
+    :param operation: 'deposit' or 'withdraw'
+    :param user: our wallet, it has to be receiver and refund address
+    :param superform_id: superform id from calculate response
+    :param max_slippage: biggest allowed slippage, 10000 = 100%
+    :param amount: (opt) superpositions amount for withdrawals, max tx value in wei for native deposits
+    :param token: (opt) token we deposit from, checked against liquidity request
+    :return: list of mismatches, empty if transaction is exactly what we asked for
+    """
+    errors = []
+    if Web3.to_checksum_address(tx_data['to']) != Web3.to_checksum_address(superform_router_address):
+        errors.append(f"tx is sent to {tx_data['to']} instead of SuperformRouter")
+        return errors
+
+    try:
+        function_name, legs = decode_router_call(tx_data['data'])
+    except ValueError as err:
+        return [f'could not decode calldata: {err}']
+
+    if not function_name.endswith('Deposit' if operation == 'deposit' else 'Withdraw'):
+        errors.append(f'{function_name} is called instead of {operation}')
+    if len(legs) != 1:
+        errors.append(f'tx has {len(legs)} vaults instead of 1')
+
+    user = Web3.to_checksum_address(user)
+    native_amount = 0
+    for leg in legs:
+        if leg['superform_id'] != int(superform_id):
+            errors.append(f"superform id {leg['superform_id']} instead of {superform_id}")
+        if leg['receiver'] != user:
+            errors.append(f"receiver/refund address {leg['receiver']} instead of {user}")
+        if operation == 'deposit' and leg['receiver_sp'] not in (user, ZERO_ADDRESS):
+            errors.append(f"superpositions receiver {leg['receiver_sp']} instead of {user}")
+        if leg['max_slippage'] > max_slippage:
+            errors.append(f"max slippage {leg['max_slippage']} is bigger than {max_slippage}")
+        if amount is not None and operation == 'withdraw' and leg['amount'] != amount:
+            errors.append(f"amount {leg['amount']} instead of {amount}")
+        if token is not None and leg['liq_token'] not in (ZERO_ADDRESS, Web3.to_checksum_address(token)):
+            errors.append(f"liquidity token {leg['liq_token']} instead of {token}")
+        native_amount += leg['native_amount']
+
+    # tx could not take more native coin than we deposit, otherwise value has to be spent by liquidity requests
+    value = int(tx_data['value'])
+    native_deposit = operation == 'deposit' and token is not None and \
+        Web3.to_checksum_address(token) == Web3.to_checksum_address(eth_address)
+    # api gets human-readable amount, so its wei value could differ from ours by rounding
+    if native_deposit and amount is not None and value > amount + amount // 10 ** 6:
+        errors.append(f'tx value {value} is bigger than deposit amount {amount}')
+    elif not native_deposit and value > native_amount:
+        errors.append(f'tx value {value} is bigger than native amount of liquidity requests {native_amount}')
+    return errors
+
+
+def verify_claim_tx(claim_tx_data: Dict, user: ChecksumAddress) -> List[str]:
+    """
+    Checks that rewards claim is sent to RewardsDistributor and rewards are received by our wallet
+    :param claim_tx_data: start_claim_rewards response with 'to' and 'transactionData'
+    :param user: our wallet
+    :return: list of mismatches, empty if transaction is correct
+    """
+    errors = []
+    # any contract with the same claim selector would pass calldata check, so target could not be skipped
+    if not rewards_distributor_address:
+        errors.append('rewards_distributor_address is not set in config, claim target could not be verified')
+    elif Web3.to_checksum_address(claim_tx_data['to']) != Web3.to_checksum_address(rewards_distributor_address):
+        errors.append(f"tx is sent to {claim_tx_data['to']} instead of RewardsDistributor")
+    try:
+        function, params = _decoder('RewardsDistributor').decode_function_input(claim_tx_data['transactionData'])
+    except ValueError as err:
+        return errors + [f'could not decode calldata: {err}']
+
+    if function.fn_name not in CLAIM_FUNCTIONS:
+        errors.append(f'{function.fn_name} is called instead of claim')
+    elif params['receiver_'] != Web3.to_checksum_address(user):
+        errors.append(f"rewards receiver {params['receiver_']} instead of {user}")
+    return errors
+
+
+def log_mismatches(errors: List[str], operation: str) -> bool:
+    """
+    :return: True if there are no mismatches
+    """
+    for error in errors:
+        logger.error(f'Calldata of {operation} does not match quote: {error}')
+    return not errors
@@ -0,0 +1,84 @@
+import json
+import itertools
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Iterator, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.superform_api import SuperFormApi
+from config import claim_plan_file, claim_plan_workers
+
+
+class ClaimPlan:
+    def __init__(self, seasons: List[int]):
+        """
+        Result of bulk get_available_rewards check
+        :param seasons: list of safari seasons that were checked
+        """
+        self.seasons = list(seasons)
+        self.claims: Dict[str, Dict[int, List[Dict]]] = {}
+        self.wallets_checked = 0
+        self.failed: List[Tuple[str, int]] = []
+
+    def add(self, address: str, season: int, rewards: List[Dict]):
+        claimable = [reward for reward in rewards if reward['status'] == 'claimable']
+        if claimable:
+            self.claims.setdefault(address, {})[season] = claimable
+
+    def items(self) -> Iterator[Tuple[str, int, List[Dict]]]:
+        """
+        :return: iterator of (address, season, claimable rewards)
+        """
+        for address, seasons in self.claims.items():
+            for season, rewards in seasons.items():
+                yield address, season, rewards
+
+    def summary(self) -> Dict:
+        wallets_to_claim = len(self.claims)
+        return {
+            'seasons': self.seasons,
+            'wallets_checked': self.wallets_checked,
+            'wallets_to_claim': wallets_to_claim,
+            'claim_txs': sum(len(seasons) for seasons in self.claims.values()),
+            'rewards': sum(len(rewards) for _, _, rewards in self.items()),
+            'failed_checks': len(self.failed),
+            'skipped_percent': round(100 * (1 - wallets_to_claim / self.wallets_checked), 1)
+            if self.wallets_checked else 0,
+        }
+
+    def save(self, path: str = claim_plan_file):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as file:
+            json.dump({'summary': self.summary(), 'claims': self.claims, 'failed': self.failed}, file, indent=2)
+
+
+def build_claim_plan(addresses: List[str], seasons: List[int], max_workers: int = claim_plan_workers,
+                     api: SuperFormApi = None) -> ClaimPlan:
+    """
+    Checks available rewards for every (wallet, season) concurrently without building signing clients
+    :param addresses: list of wallet addresses
+    :param seasons: list of safari seasons
+    :param max_workers: number of concurrent api requests
+    :param api: (opt) SuperFormApi instance shared by all threads
+    :return: ClaimPlan with claimable rewards only
+    """
+    api = api if api else SuperFormApi()
+    plan = ClaimPlan(seasons)
+    plan.wallets_checked = len(addresses)
+
+    def check(task):
+        address, season = task
+        try:
+            return address, season, api.get_available_rewards(address=address, season=season)
+        except Exception as err:
+            logger.error(f'Could not get rewards of {address} for season {season} - {type(err).__name__}: {err}')
+            return address, season, None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for address, season, rewards in pool.map(check, itertools.product(addresses, seasons)):
+            if rewards is None:
+                plan.failed.append((address, season))
+            else:
+                plan.add(address, season, rewards)
+    return plan
@@ -8,6 +8,7 @@ from web3.contract import Contract
 from eth_account.signers.local import LocalAccount
 from eth_account.account import ChecksumAddress
 from utils.helpful_scripts import get_network_by_chain_id, get_native, get_balance, get_decimals
+from utils.rpc_pool import provider_pool
 
 
 class MyClient:
@@ -28,7 +29,8 @@ class MyClient:
         self.explorer = self.network.explorer
         self.chain_id = self.network.chain_id
         self.rpc = random.choice(self.network.rpc)
-        self.w3 = Web3(Web3.HTTPProvider(self.rpc))
+        # shared by all clients with the same rpc, connections are reused across accounts
+        self.w3 = provider_pool.get_web3(self.rpc)
 
     def get_native_balance(self) -> int:
         """
@@ -0,0 +1,329 @@
+import json
+import queue
+import random
+import threading
+
+from pathlib import Path
+from loguru import logger
+from typing import Callable, Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from web3 import Web3
+from eth_account.signers.local import LocalAccount
+
+from modules.superform_sdk import MySuperform
+from modules.multichain_scanner import MultiChainScanner
+from utils.helpful_scripts import build_tx_with_data, sign_tx, broadcast_tx, check_tx_status, get_decimals, \
+    get_network_by_chain_id
+from utils.rpc_pool import provider_pool
+from utils.tracing import tracer
+from utils.gas_profiles import gas_profiles
+from utils.signing import SigningService, RawTxBroadcaster
+from config import eth_address, minimum_balance_left, pipeline_plan_file, pipeline_workers, pipeline_bulk_signing, \
+    pipeline_batch_size
+
+_DONE = object()
+
+
+def _call(name: str, func: Callable[[Dict], bool], item: Dict) -> bool:
+    """
+    Runs func for one item with wallet context, exception marks item as failed
+    :return: result of func, False if it raised
+    """
+    with logger.contextualize(wallet=item['wallet'], vault=item['vault_id']), \
+            tracer.span(name, wallet=item['wallet'], vault=item['vault_id']):
+        try:
+            return func(item)
+        except Exception as err:
+            logger.error(f'{name} failed - {type(err).__name__}: {err}')
+            item.update({'status': 'failed', 'error': f'{name}: {type(err).__name__}: {err}'})
+            return False
+
+
+class _Stage:
+    def __init__(self, name: str, func: Callable, workers: int, batch_size: int = 1):
+        """
+        Worker pool with input queue. func returns True to pass item to the next stage.
+        With batch_size > 1 func gets list of items already waiting in the queue and returns items to pass
+        """
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.batch_size = batch_size
+        self.input = queue.Queue()
+        self.next: _Stage | None = None
+        self._running = workers
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._run, name=f'{name}-{i}', daemon=True) for i in range(workers)]
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def join(self):
+        for thread in self._threads:
+            thread.join()
+
+    def _take(self) -> Tuple[List[Dict], bool]:
+        """
+        Waits for one item and takes up to batch_size items which are already in the queue
+        :return: (items, True if the end of input was reached)
+        """
+        item = self.input.get()
+        if item is _DONE:
+            return [], True
+        items = [item]
+        while len(items) < self.batch_size:
+            try:
+                item = self.input.get_nowait()
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return items, True
+            items.append(item)
+        return items, False
+
+    def _process(self, items: List[Dict]) -> List[Dict]:
+        if self.batch_size == 1:
+            return [item for item in items if _call(self.name, self.func, item)]
+        with tracer.span(self.name, size=len(items)):
+            try:
+                return self.func(items)
+            except Exception as err:
+                logger.error(f'{self.name} of {len(items)} wallets failed - {type(err).__name__}: {err}')
+                for item in items:
+                    item.update({'status': 'failed', 'error': f'{self.name}: {type(err).__name__}: {err}'})
+                return []
+
+    def _run(self):
+        while True:
+            items, done = self._take()
+            for item in self._process(items) if items else []:
+                if self.next:
+                    self.next.input.put(item)
+            if done:
+                # let other workers of this stage stop, the last one stops the next stage
+                self.input.put(_DONE)
+                with self._lock:
+                    self._running -= 1
+                    last = self._running == 0
+                if last and self.next:
+                    self.next.input.put(_DONE)
+                return
+
+
+class DepositPipeline:
+    def __init__(self, accounts: List[LocalAccount], vault_id: str, token_address: str = eth_address,
+                 network_id: int = 3, dry_run: bool = False, plan_file: str = pipeline_plan_file,
+                 workers: Dict[str, int] = None, bulk_signing: bool = pipeline_bulk_signing,
+                 batch_size: int = pipeline_batch_size):
+        """
+        Deposits of many wallets split into stages: plan -> simulate -> sign -> broadcast.
+        Planning is done in bulk, other stages have own worker pools and queues and overlap across wallets,
+        so throughput is limited by the slowest stage instead of the sum of all stages
+        :param accounts: accounts to deposit from
+        :param vault_id: vault id, e.g. - pxOqM7dFwI2Abt-yTv4jC
+        :param token_address: token to deposit, default is ETH
+        :param network_id: number according to get_network_by_chain_id
+        :param dry_run: stop after simulation, nothing is approved, signed or sent
+        :param plan_file: json file with plan and result of every wallet
+        :param workers: (opt) Dict - {'simulate': int, 'sign': int, 'broadcast': int}
+        :param bulk_signing: sign waiting transactions together in SigningService process pool
+            and send them in one json-rpc batch
+        :param batch_size: max transactions signed and sent together with bulk_signing
+        """
+        self.accounts = {account.address: account for account in accounts}
+        self.vault_id = vault_id
+        self.token_address = Web3.to_checksum_address(token_address)
+        self.native = self.token_address == Web3.to_checksum_address(eth_address)
+        self.network_id = network_id
+        self.dry_run = dry_run
+        self.plan_file = Path(plan_file)
+        self.workers = {**pipeline_workers, **(workers or {})}
+        self.bulk_signing = bulk_signing
+        self.batch_size = batch_size
+        self.signer: SigningService | None = None
+        self.items: List[Dict] = []
+        # clients, quotes and signed transactions are kept out of plan file
+        self._runtime: Dict[str, Dict] = {}
+
+    """
+    STAGES
+    """
+
+    def plan(self) -> List[Dict]:
+        """
+        Decides amount of every wallet from balances scanned in bulk and writes plan file
+        :return: list of {'wallet', 'vault_id', 'token', 'amount', 'status'}
+        """
+        network = get_network_by_chain_id(self.network_id)
+        tokens = {} if self.native else {self.network_id: [self.token_address]}
+        balances = MultiChainScanner([self.network_id], tokens=tokens).scan_chain(self.network_id, list(self.accounts))
+        decimals = 18 if self.native else \
+            get_decimals(w3=provider_pool.get_web3(random.choice(network.rpc)), token_address=self.token_address)
+
+        self.items = []
+        for wallet, balance in balances.items():
+            raw_balance = balance['native'] if self.native else balance['tokens'][self.token_address]
+            item = {'wallet': wallet, 'vault_id': self.vault_id, 'token': self.token_address, 'amount': 0,
+                    'status': 'planned'}
+            if raw_balance is None:
+                item.update({'status': 'failed', 'error': 'plan: could not get balance'})
+            else:
+                normalized = raw_balance / 10 ** decimals
+                # deposit 90 - 95 % of native balance or 100% of token balance, same as single wallet deposit
+                if self.native and normalized < minimum_balance_left:
+                    item['status'] = 'skipped'
+                elif self.native:
+                    item['amount'] = normalized * random.randint(9000, 9500) / 10000
+                elif normalized < 0.01:
+                    item['status'] = 'skipped'
+                else:
+                    item['amount'] = normalized
+            self.items.append(item)
+        self.save()
+        return self.items
+
+    def simulate(self, item: Dict) -> bool:
+        client = MySuperform(account=self.accounts[item['wallet']])
+        quote = client.quote_deposit(vault_id=self.vault_id, amount=item['amount'], token_address=self.token_address)
+        if quote is None:
+            item.update({'status': 'failed', 'error': 'simulate: calldata does not match quote'})
+            return False
+        calculate_dep, tx_data = quote
+
+        simulation = client.preflight(tx_data=tx_data, token_address=self.token_address, operation_type='smart')
+        if simulation is not None and not simulation.success:
+            item.update({'status': 'failed', 'error': f'simulate: reverted {simulation.revert_reason}'})
+            return False
+
+        item.update({'status': 'simulated', 'gas': simulation.gas_used if simulation else None})
+        self._runtime[item['wallet']] = {'client': client, 'calculate': calculate_dep, 'tx_data': tx_data,
+                                         'simulation': simulation}
+        return not self.dry_run
+
+    def prepare(self, item: Dict) -> bool:
+        """
+        Approves token if needed and builds deposit transaction
+        """
+        runtime = self._runtime[item['wallet']]
+        client, tx_data = runtime['client'], runtime['tx_data']
+        gas = client.before_vault_operation(tx_data=tx_data, amount=item['amount'], token_address=self.token_address,
+                                            superform_id=runtime['calculate']['in']['superFormId'],
+                                            operation_type='smart', calldata_verified=True,
+                                            preflight=runtime['simulation'])
+        if gas is None:
+            item.update({'status': 'failed', 'error': 'sign: could not prepare deposit'})
+            return False
+
+        runtime['tx'] = build_tx_with_data(to=tx_data['to'], w3=client.w3, account=client.account,
+                                           eip1559=client.eip1559_support, data=tx_data['data'],
+                                           value=int(tx_data['value']), gas=gas, vault=self.vault_id)
+        return True
+
+    def sign(self, item: Dict) -> bool:
+        if not self.prepare(item):
+            return False
+        runtime = self._runtime[item['wallet']]
+        runtime['signed_tx'] = sign_tx(w3=runtime['client'].w3, tx=runtime['tx'], account=runtime['client'].account)
+        item['status'] = 'signed'
+        return True
+
+    def sign_batch(self, items: List[Dict]) -> List[Dict]:
+        prepared = [item for item in items if _call('prepare', self.prepare, item)]
+        signed_txs = self.signer.sign([self._runtime[item['wallet']]['tx'] for item in prepared])
+        for item, signed_tx in zip(prepared, signed_txs):
+            self._runtime[item['wallet']]['signed_tx'] = signed_tx
+            item['status'] = 'signed'
+        return prepared
+
+    def broadcast(self, item: Dict) -> bool:
+        runtime = self._runtime.pop(item['wallet'])
+        client = runtime['client']
+        tx_hash = broadcast_tx(w3=client.w3, signed_tx=runtime['signed_tx'], tx=runtime['tx'],
+                               explorer=client.explorer, vault=self.vault_id)
+        item['tx_hash'] = tx_hash.hex()
+        item['status'] = 'deposited' if check_tx_status(w3=client.w3, tx_hash=tx_hash) else 'reverted'
+        return True
+
+    def broadcast_batch(self, items: List[Dict]) -> List[Dict]:
+        runtimes = [self._runtime.pop(item['wallet']) for item in items]
+        # all clients are on the same network
+        client = runtimes[0]['client']
+        results = RawTxBroadcaster(client.w3, explorer=client.explorer, batch_size=self.batch_size) \
+            .broadcast([runtime['signed_tx'] for runtime in runtimes])
+
+        sent = {item['wallet']: (runtime, result) for item, runtime, result in zip(items, runtimes, results)}
+
+        def confirm(item: Dict) -> bool:
+            runtime, result = sent[item['wallet']]
+            if result['error']:
+                item.update({'status': 'failed', 'error': f"broadcast: {result['error']}"})
+                return False
+            tx, tx_hash = runtime['tx'], result['tx_hash']
+            gas_key = gas_profiles.key(chain_id=tx['chainId'], to=tx['to'], data=tx['data'], vault=self.vault_id)
+            gas_profiles.track(tx_hash.hex(), gas_key, tx['gas'])
+            item['tx_hash'] = tx_hash.hex()
+            item['status'] = 'deposited' if check_tx_status(w3=client.w3, tx_hash=tx_hash) else 'reverted'
+            return True
+
+        # confirmations are waited for at the same time
+        with ThreadPoolExecutor(max_workers=len(items)) as pool:
+            confirmed = pool.map(lambda item: _call('confirm', confirm, item), items)
+            return [item for item, ok in zip(items, confirmed) if ok]
+
+    """
+    RUN
+    """
+
+    def save(self):
+        self.plan_file.parent.mkdir(parents=True, exist_ok=True)
+        with self.plan_file.open('w') as file:
+            json.dump({'vault_id': self.vault_id, 'token': self.token_address, 'dry_run': self.dry_run,
+                       'summary': self.summary(), 'items': self.items}, file, indent=2)
+
+    def summary(self) -> Dict[str, int]:
+        result = {}
+        for item in self.items:
+            result[item['status']] = result.get(item['status'], 0) + 1
+        return result
+
+    def run(self) -> Dict[str, int]:
+        """
+        :return: Dict - {status: number of wallets}
+        """
+        with logger.contextualize(vault=self.vault_id):
+            self.plan()
+            logger.info(f'Deposit plan: {self.summary()}, saved to {self.plan_file}')
+
+        stages = [_Stage('simulate', self.simulate, self.workers['simulate'])]
+        if self.dry_run:
+            pass
+        elif self.bulk_signing:
+            # keys are loaded into signing processes once
+            self.signer = SigningService(account.key for account in self.accounts.values())
+            stages.append(_Stage('sign', self.sign_batch, self.workers['sign'], batch_size=self.batch_size))
+            stages.append(_Stage('broadcast', self.broadcast_batch, self.workers['broadcast'],
+                                 batch_size=self.batch_size))
+        else:
+            stages.append(_Stage('sign', self.sign, self.workers['sign']))
+            stages.append(_Stage('broadcast', self.broadcast, self.workers['broadcast']))
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+        try:
+            for stage in stages:
+                stage.start()
+            for item in self.items:
+                if item['status'] == 'planned':
+                    stages[0].input.put(item)
+            stages[0].input.put(_DONE)
+            for stage in stages:
+                stage.join()
+        finally:
+            if self.signer:
+                self.signer.close()
+                self.signer = None
+
+        self.save()
+        return self.summary()
@@ -0,0 +1,109 @@
+from loguru import logger
+from typing import Dict
+
+from web3 import Web3
+from eth_abi import decode
+from eth_account.account import ChecksumAddress
+
+from utils.constants import MAX_APPROVAL_HEX
+from config import allowance_storage_slots
+
+ERROR_SELECTOR = '0x08c379a0'  # Error(string)
+PANIC_SELECTOR = '0x4e487b71'  # Panic(uint256)
+INVALID_PARAMS_CODE = -32602
+# messages of rpcs that do not accept state override param of eth_estimateGas
+OVERRIDE_UNSUPPORTED_MESSAGES = ('invalid params', 'invalid argument', 'too many arguments', 'override')
+
+
+def allowance_slot(owner: str, spender: str, mapping_slot: int) -> str:
+    """
+    Storage slot of allowance[owner][spender] for solidity mapping(address => mapping(address => uint256))
+    """
+    inner = Web3.solidity_keccak(['uint256', 'uint256'], [int(owner, 16), mapping_slot])
+    return Web3.solidity_keccak(['uint256', 'bytes32'], [int(spender, 16), inner]).hex()
+
+
+def approval_override(owner: str, token: str, spender: str) -> Dict | None:
+    """
+    :return: eth_call state override with max allowance, None if allowance slot of token is unknown
+    """
+    token = Web3.to_checksum_address(token)
+    if token not in allowance_storage_slots:
+        return None
+    slot = allowance_slot(owner, spender, allowance_storage_slots[token])
+    return {token: {'stateDiff': {slot: MAX_APPROVAL_HEX}}}
+
+
+def decode_revert_reason(data: str) -> str:
+    if not data or data == '0x':
+        return 'reverted without reason'
+    if data.startswith(ERROR_SELECTOR):
+        return decode(['string'], bytes.fromhex(data[10:]))[0]
+    if data.startswith(PANIC_SELECTOR):
+        return f'panic {hex(decode(["uint256"], bytes.fromhex(data[10:]))[0])}'
+    return f'custom error {data[:10]}'
+
+
+class SimulationResult:
+    def __init__(self, success: bool, gas_used: int = 0, revert_reason: str = ''):
+        self.success = success
+        self.gas_used = gas_used
+        self.revert_reason = revert_reason
+
+    def __repr__(self):
+        if self.success:
+            return f'SimulationResult(success, gas_used={self.gas_used})'
+        return f'SimulationResult(reverted, {self.revert_reason})'
+
+
+class LocalSimulator:
+    def __init__(self, w3: Web3):
+        """
+        Pre-flight of transactions against our own rpc with eth_estimateGas and state overrides,
+        gives revert reason or gas used in one call
+        :param w3: Web3 instance of the chain
+        """
+        self.w3 = w3
+
+    def simulate(self, sender: ChecksumAddress, to: str, data: str, value: int = 0,
+                 state_override: Dict = None) -> SimulationResult | None:
+        """
+        :param sender: transaction sender
+        :param to: transaction target
+        :param data: calldata
+        :param value: value in wei
+        :param state_override: (opt) {address: {'stateDiff': {slot: value}, 'balance': ...}}
+        :return: SimulationResult with gas_used if transaction would succeed or revert_reason if not,
+            None if rpc does not support state_override
+        """
+        tx = {'from': sender, 'to': Web3.to_checksum_address(to), 'data': data, 'value': hex(int(value))}
+        params = [tx, 'latest', state_override] if state_override else [tx, 'latest']
+        try:
+            gas_used = self.w3.manager.request_blocking('eth_estimateGas', params)
+        except ValueError as err:
+            error = err.args[0] if err.args and isinstance(err.args[0], dict) else {'message': str(err)}
+            message = error.get('message', '').lower()
+            if 'revert' not in message and 'data' not in error:
+                if state_override and (error.get('code') == INVALID_PARAMS_CODE or
+                                       any(text in message for text in OVERRIDE_UNSUPPORTED_MESSAGES)):
+                    logger.warning(f'Rpc does not support state override - {error.get("message")}')
+                    return None
+                raise
+            reason = decode_revert_reason(error.get('data') or '')
+            logger.debug(f'Local simulation reverted - {error.get("message")}: {reason}')
+            return SimulationResult(success=False, revert_reason=reason)
+        return SimulationResult(success=True, gas_used=int(gas_used, 16) if isinstance(gas_used, str) else gas_used)
+
+    def simulate_with_approval(self, sender: ChecksumAddress, to: str, data: str, value: int = 0,
+                               token: str = None, spender: str = None) -> SimulationResult | None:
+        """
+        Simulates transaction as if token was already approved to spender
+        :return: SimulationResult, None if approval is needed but allowance slot of token is unknown
+            or rpc does not support state override
+        """
+        state_override = None
+        if token and spender:
+            state_override = approval_override(sender, token, spender)
+            if state_override is None:
+                return None
+        return self.simulate(sender=sender, to=to, data=data, value=value, state_override=state_override)
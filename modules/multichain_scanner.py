@@ -0,0 +1,107 @@
+import time
+import random
+
+from loguru import logger
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from web3 import Web3
+
+from utils.rpc_pool import provider_pool
+from utils.helpful_scripts import get_network_by_chain_id, load_abi
+from config import multicall3_address, super_positions_address, scan_batch_size
+
+# static calls are encoded by hand, web3 abi encoding is the slowest part of building thousands of calls
+GET_ETH_BALANCE = Web3.keccak(text='getEthBalance(address)')[:4]
+ERC20_BALANCE_OF = Web3.keccak(text='balanceOf(address)')[:4]
+ERC1155_BALANCE_OF = Web3.keccak(text='balanceOf(address,uint256)')[:4]
+
+
+def _encode(selector: bytes, *words: int) -> bytes:
+    return selector + b''.join(word.to_bytes(32, 'big') for word in words)
+
+
+class MultiChainScanner:
+    def __init__(self, network_ids: List[int], tokens: Dict[int, List[str]] = None,
+                 superform_ids: Dict[int, List[int]] = None, batch_size: int = scan_batch_size):
+        """
+        Scans native, token and SuperPositions balances of many wallets on many chains at once.
+        Every chain is scanned in its own thread with Multicall3 batches, so total time is the time of the slowest chain
+        :param network_ids: numbers according to get_network_by_chain_id
+        :param tokens: (opt) Dict - {network id: [erc20 token addresses]}
+        :param superform_ids: (opt) Dict - {network id: [superform ids]} to read SuperPositions balances
+        :param batch_size: calls in one Multicall3 eth_call
+        """
+        self.networks = {network_id: get_network_by_chain_id(network_id) for network_id in network_ids}
+        self.tokens = tokens or {}
+        self.superform_ids = superform_ids or {}
+        self.batch_size = batch_size
+
+    def _calls(self, multicall_address: str, network_id: int, wallets: List[str]) -> List[Tuple[Tuple, Tuple]]:
+        """
+        :return: list of (Multicall3 call, (wallet, kind, asset))
+        """
+        super_positions = Web3.to_checksum_address(super_positions_address)
+        tokens = [Web3.to_checksum_address(token) for token in self.tokens.get(network_id, [])]
+
+        calls = []
+        for wallet in wallets:
+            calls.append(((multicall_address, True, _encode(GET_ETH_BALANCE, int(wallet, 16))),
+                          (wallet, 'native', '')))
+            for token in tokens:
+                calls.append(((token, True, _encode(ERC20_BALANCE_OF, int(wallet, 16))),
+                              (wallet, 'tokens', token)))
+            for superform_id in self.superform_ids.get(network_id, []):
+                calls.append(((super_positions, True, _encode(ERC1155_BALANCE_OF, int(wallet, 16), int(superform_id))),
+                              (wallet, 'superpositions', str(superform_id))))
+        return calls
+
+    def scan_chain(self, network_id: int, wallets: List[str]) -> Dict[str, Dict]:
+        """
+        :return: Dict - {wallet: {'native': int, 'tokens': {token: int}, 'superpositions': {superform id: int}}}
+        """
+        network = self.networks[network_id]
+        w3 = provider_pool.get_web3(random.choice(network.rpc))
+        multicall = w3.eth.contract(Web3.to_checksum_address(multicall3_address), abi=load_abi('multicall3'))
+        calls = self._calls(multicall.address, network_id, wallets)
+
+        result = {wallet: {'native': None, 'tokens': {}, 'superpositions': {}} for wallet in wallets}
+        for i in range(0, len(calls), self.batch_size):
+            batch = calls[i:i + self.batch_size]
+            responses = multicall.functions.aggregate3([call for call, _ in batch]).call()
+            for (_, (wallet, kind, asset)), (success, data) in zip(batch, responses):
+                value = int.from_bytes(data[:32], 'big') if success and len(data) >= 32 else None
+                if kind == 'native':
+                    result[wallet]['native'] = value
+                else:
+                    result[wallet][kind][asset] = value
+        return result
+
+    def scan(self, wallets: List[str]) -> Dict:
+        """
+        :param wallets: wallet addresses
+        :return: Dict - {'wallets': {wallet: {chain id: balances}}, 'failed_chains': {chain id: error},
+            'chain_seconds': {chain id: seconds}}
+        """
+        wallets = [Web3.to_checksum_address(wallet) for wallet in wallets]
+
+        def scan_one(network_id):
+            start = time.perf_counter()
+            try:
+                return network_id, self.scan_chain(network_id, wallets), None, time.perf_counter() - start
+            except Exception as err:
+                logger.error(f'Scan of {self.networks[network_id]} failed - {type(err).__name__}: {err}')
+                return network_id, None, f'{type(err).__name__}: {err}', time.perf_counter() - start
+
+        merged = {wallet: {} for wallet in wallets}
+        failed, seconds = {}, {}
+        with ThreadPoolExecutor(max_workers=len(self.networks) or 1) as pool:
+            for network_id, balances, error, elapsed in pool.map(scan_one, self.networks):
+                chain_id = self.networks[network_id].chain_id
+                seconds[chain_id] = round(elapsed, 3)
+                if error:
+                    failed[chain_id] = error
+                    continue
+                for wallet, chain_balances in balances.items():
+                    merged[wallet][chain_id] = chain_balances
+        return {'wallets': merged, 'failed_chains': failed, 'chain_seconds': seconds}
@@ -0,0 +1,151 @@
+import time
+import numpy as np
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.superform_api import SuperFormApi
+from config import points_snapshot_dir, points_fetch_workers
+
+METRICS = ('xp', 'tvl', 'tournament_rank', 'boost')
+RANK_BINS = np.array([1, 11, 101, 1001, 10001, np.inf])
+
+
+class PointsAggregator:
+    def __init__(self, season: int, snapshot_dir: str = points_snapshot_dir, max_workers: int = points_fetch_workers,
+                 api: SuperFormApi = None):
+        """
+        Fetches safari points of all wallets, stores snapshots and reports fleet aggregates and changed wallets
+        :param season: (int) Safari season number
+        :param snapshot_dir: directory for .npz snapshots
+        :param max_workers: number of concurrent api requests
+        :param api: (opt) SuperFormApi instance shared by all threads
+        """
+        self.season = season
+        self.snapshot_dir = Path(snapshot_dir)
+        self.max_workers = max_workers
+        self.api = api if api else SuperFormApi()
+
+    def _fetch_one(self, address: str) -> Dict | None:
+        try:
+            return self.api.get_safari_points(address=address, season=self.season)
+        except Exception as err:
+            logger.error(f'Could not get safari points for {address} - {type(err).__name__}: {err}')
+            return None
+
+    def fetch(self, addresses: List[str]) -> Dict[str, Dict | None]:
+        """
+        :param addresses: list of wallet addresses
+        :return: Dict - {address: get_safari_points response or None if request failed}
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return dict(zip(addresses, pool.map(self._fetch_one, addresses)))
+
+    @staticmethod
+    def build_snapshot(points: Dict[str, Dict | None]) -> Dict[str, np.ndarray]:
+        """
+        Converts api responses to column arrays sorted by address, missing values are NaN
+        :return: Dict - {'address': array, 'xp': array, 'tvl': array, 'tournament_rank': array, 'boost': array}
+        """
+        addresses = np.array(sorted(points), dtype=str)
+        columns = {metric: np.full(len(addresses), np.nan) for metric in METRICS}
+        for i, address in enumerate(addresses):
+            current = (points[address] or {}).get('current') or {}
+            for metric in METRICS:
+                value = current.get(metric)
+                if value is not None:
+                    columns[metric][i] = float(value)
+        return {'address': addresses, **columns}
+
+    def save_snapshot(self, snapshot: Dict[str, np.ndarray]) -> Path:
+        self.snapshot_dir.mkdir(parents=True, exist_ok=True)
+        path = self.snapshot_dir / f'season{self.season}_{time.strftime("%Y%m%d_%H%M%S")}.npz'
+        np.savez_compressed(path, **snapshot)
+        return path
+
+    def load_last_snapshot(self) -> Dict[str, np.ndarray] | None:
+        snapshots = sorted(self.snapshot_dir.glob(f'season{self.season}_*.npz'))
+        if not snapshots:
+            return None
+        with np.load(snapshots[-1]) as data:
+            return {key: data[key] for key in data.files}
+
+    @staticmethod
+    def aggregates(snapshot: Dict[str, np.ndarray]) -> Dict:
+        """
+        :return: fleet aggregates - total xp and tvl, boost distribution and rank histogram
+        """
+        xp, tvl, rank, boost = (snapshot[metric] for metric in METRICS)
+        ranked = rank[~np.isnan(rank)]
+        boosts, boost_counts = np.unique(boost[~np.isnan(boost)], return_counts=True)
+        rank_counts, _ = np.histogram(ranked, bins=RANK_BINS)
+        return {
+            'wallets': int(len(snapshot['address'])),
+            'active_wallets': int(np.count_nonzero(np.nan_to_num(xp) > 0)),
+            'total_xp': float(np.nansum(xp)),
+            'total_tvl': float(np.nansum(tvl)),
+            'best_rank': int(ranked.min()) if ranked.size else None,
+            'boost_distribution': {float(b): int(c) for b, c in zip(boosts, boost_counts)},
+            'rank_histogram': {f'{int(low)}-{int(high) - 1 if np.isfinite(high) else "inf"}': int(count)
+                               for low, high, count in zip(RANK_BINS[:-1], RANK_BINS[1:], rank_counts)},
+        }
+
+    @staticmethod
+    def diff(current: Dict[str, np.ndarray], previous: Dict[str, np.ndarray] | None) -> List[Dict]:
+        """
+        Finds wallets which are new or have any metric changed since previous snapshot
+        :return: list of {'address': ..., 'xp': (old, new), ...} only for changed metrics
+        """
+        count = len(current['address'])
+        if previous is None or not len(previous['address']):
+            changed = np.ones(count, dtype=bool)
+            position = np.zeros(count, dtype=int)
+            found = np.zeros(count, dtype=bool)
+        else:
+            # both snapshots are sorted by address
+            position = np.searchsorted(previous['address'], current['address'])
+            position = np.minimum(position, len(previous['address']) - 1)
+            found = previous['address'][position] == current['address']
+            changed = ~found
+            for metric in METRICS:
+                old, new = previous[metric][position], current[metric]
+                changed |= ~((old == new) | (np.isnan(old) & np.isnan(new)))
+
+        result = []
+        for i in np.flatnonzero(changed):
+            row = {'address': str(current['address'][i])}
+            for metric in METRICS:
+                new = current[metric][i]
+                old = previous[metric][position[i]] if found[i] else np.nan
+                if not (old == new or (np.isnan(old) and np.isnan(new))):
+                    row[metric] = (None if np.isnan(old) else float(old), None if np.isnan(new) else float(new))
+            result.append(row)
+        return result
+
+    def run(self, addresses: List[str]) -> Dict:
+        """
+        Fetches points, saves snapshot and compares it with previous one
+        :return: Dict - {'aggregates': {...}, 'changed': [...], 'snapshot': path}
+        """
+        previous = self.load_last_snapshot()
+        points = self.fetch(addresses)
+        snapshot = self.build_snapshot(points)
+
+        # wallets with failed requests keep values from previous snapshot instead of showing up as changed
+        failed = np.array([points[address] is None for address in snapshot['address']], dtype=bool)
+        if previous is not None and len(previous['address']) and failed.any():
+            position = np.minimum(np.searchsorted(previous['address'], snapshot['address']),
+                                  len(previous['address']) - 1)
+            carry = failed & (previous['address'][position] == snapshot['address'])
+            for metric in METRICS:
+                snapshot[metric][carry] = previous[metric][position[carry]]
+            logger.warning(f'{int(failed.sum())} wallets failed, {int(carry.sum())} taken from previous snapshot')
+
+        path = self.save_snapshot(snapshot)
+        return {
+            'aggregates': self.aggregates(snapshot),
+            'changed': self.diff(snapshot, previous),
+            'snapshot': str(path),
+        }
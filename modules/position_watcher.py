@@ -0,0 +1,236 @@
+import json
+import time
+import asyncio
+import collections
+
+from pathlib import Path
+from loguru import logger
+from typing import Callable, Dict, List, Iterable
+
+from hexbytes import HexBytes
+from web3 import Web3, AsyncWeb3
+from web3.providers import WebsocketProviderV2
+from eth_account.account import ChecksumAddress
+
+from modules.positions_indexer import AdaptiveLogFetcher
+
+from config import super_positions_address, rewards_distributor_address, watcher_poll_interval, \
+    watcher_confirmations
+
+abi_files = {
+    'SuperPositions': 'files/abis/superform/SuperPositions.json',
+    'RewardsDistributor': 'files/abis/superform/RewardsDistributor.json',
+}
+
+POSITION_EVENTS = ('TransferSingle', 'TransferBatch')
+REWARD_EVENTS = ('RewardsClaimed',)
+
+# eth_getLogs topic OR-lists are limited by most providers
+WALLETS_PER_FILTER = 100
+SEEN_LOGS_LIMIT = 10_000
+
+
+def address_topic(address: str) -> str:
+    """
+    :return: address padded to 32 bytes topic
+    """
+    return '0x' + address.lower().replace('0x', '').rjust(64, '0')
+
+
+def _int(value) -> int:
+    return int(value, 16) if isinstance(value, str) else value
+
+
+def _log_id(log) -> tuple:
+    """
+    :return: (tx hash, log index) for both formatted logs and raw websocket logs
+    """
+    return HexBytes(log['transactionHash']), _int(log['logIndex'])
+
+
+class PositionWatcher:
+    def __init__(self, w3: Web3, wallets: Iterable[str], on_change: Callable[[ChecksumAddress, List[Dict]], None],
+                 super_positions: str = super_positions_address, rewards_distributor: str = rewards_distributor_address,
+                 start_block: int = None, confirmations: int = watcher_confirmations):
+        """
+        Watches SuperPositions transfers and RewardsDistributor claims of our wallets using contract logs
+        :param w3: Web3 instance of the chain
+        :param wallets: wallet addresses to watch
+        :param on_change: callback(wallet, events) called once per poll for every affected wallet
+        :param super_positions: SuperPositions contract address
+        :param rewards_distributor: (opt) RewardsDistributor contract address, reward events are skipped if empty
+        :param start_block: (opt) first block to check, default is current head
+        :param confirmations: blocks to wait before log is processed
+        """
+        self.w3 = w3
+        self.wallets = {Web3.to_checksum_address(wallet) for wallet in wallets}
+        self.on_change = on_change
+        self.confirmations = confirmations
+        self.last_block = start_block - 1 if start_block is not None else None
+        # the same log could match both `from` and `to` filters
+        self._seen_logs = collections.OrderedDict()
+        self.fetcher = AdaptiveLogFetcher(w3)
+
+        self.contracts = {'SuperPositions': self._contract(super_positions, 'SuperPositions')}
+        if rewards_distributor:
+            self.contracts['RewardsDistributor'] = self._contract(rewards_distributor, 'RewardsDistributor')
+
+        self.topics = {}
+        for name, contract in self.contracts.items():
+            for event in POSITION_EVENTS if name == 'SuperPositions' else REWARD_EVENTS:
+                event_abi = getattr(contract.events, event)._get_event_abi()
+                signature = f"{event}({','.join(i['type'] for i in event_abi['inputs'])})"
+                self.topics[Web3.keccak(text=signature).hex()] = (name, event)
+
+    def _contract(self, address: str, name: str):
+        return self.w3.eth.contract(address=Web3.to_checksum_address(address),
+                                    abi=json.load(Path(abi_files[name]).open()))
+
+    def filters(self) -> List[Dict]:
+        """
+        Builds log filters (without block range) that match only events of our wallets.
+        Transfers are matched by `from` (topic 2) or `to` (topic 3), claims by claimer (topic 1) or receiver (topic 2)
+        """
+        wallets = sorted(self.wallets)
+        result = []
+        for i in range(0, len(wallets), WALLETS_PER_FILTER):
+            wallet_topics = [address_topic(wallet) for wallet in wallets[i:i + WALLETS_PER_FILTER]]
+            for name, contract in self.contracts.items():
+                signatures = [topic for topic, (contract_name, _) in self.topics.items() if contract_name == name]
+                positions = (2, 3) if name == 'SuperPositions' else (1, 2)
+                for position in positions:
+                    topics = [signatures] + [None] * (position - 1) + [wallet_topics]
+                    result.append({'address': contract.address, 'topics': topics})
+        return result
+
+    def decode(self, log) -> List[Dict]:
+        """
+        Decodes log into change events, one per affected wallet of our set
+        :return: list of {'wallet', 'kind', 'event', 'superform_ids', 'block', 'tx_hash', 'args'}
+        """
+        topic = log['topics'][0]
+        topic = topic.hex() if isinstance(topic, bytes) else topic
+        if topic not in self.topics:
+            return []
+        name, event = self.topics[topic]
+        decoded = getattr(self.contracts[name].events, event)().process_log(log)
+        args = dict(decoded['args'])
+
+        if name == 'SuperPositions':
+            kind = 'position'
+            wallets = {args['from'], args['to']}
+            superform_ids = list(args['ids']) if 'ids' in args else [args['id']]
+        else:
+            kind = 'reward'
+            wallets = {args['claimer'], args['receiver']}
+            superform_ids = []
+
+        return [{
+            'wallet': wallet,
+            'kind': kind,
+            'event': event,
+            'superform_ids': superform_ids,
+            'block': decoded['blockNumber'],
+            'tx_hash': decoded['transactionHash'].hex(),
+            'args': args,
+        } for wallet in wallets & self.wallets]
+
+    def emit(self, logs: Iterable) -> Dict[ChecksumAddress, List[Dict]]:
+        """
+        Groups decoded events by wallet and calls on_change once per affected wallet.
+        Logs removed by reorg are skipped, log that could not be decoded is logged and skipped
+        """
+        changes: Dict[ChecksumAddress, List[Dict]] = {}
+        for log in logs:
+            log_id = _log_id(log)
+            if log_id in self._seen_logs or log.get('removed'):
+                continue
+            try:
+                events = self.decode(log)
+            except Exception as err:
+                logger.error(f'Could not decode log {log_id[0].hex()}:{log_id[1]} - {type(err).__name__}: {err}')
+                events = []
+            for event in events:
+                changes.setdefault(event['wallet'], []).append(event)
+            # marked only after processing, log that failed before this point is processed again by next poll
+            self._seen_logs[log_id] = None
+            if len(self._seen_logs) > SEEN_LOGS_LIMIT:
+                self._seen_logs.popitem(last=False)
+
+        for wallet, events in changes.items():
+            try:
+                self.on_change(wallet, events)
+            except Exception as err:
+                logger.error(f'Change handler failed for {wallet} - {type(err).__name__}: {err}')
+        return changes
+
+    def get_logs(self, from_block: int, to_block: int) -> List:
+        logs = []
+        for log_filter in self.filters():
+            for _, page in self.fetcher.iter_logs(log_filter, from_block, to_block):
+                logs.extend(page)
+        return logs
+
+    def poll_once(self) -> Dict[ChecksumAddress, List[Dict]]:
+        """
+        Processes new confirmed blocks since previous poll
+        :return: Dict - {wallet: [events]}
+        """
+        head = self.w3.eth.block_number - self.confirmations
+        if self.last_block is None:
+            self.last_block = head
+            return {}
+        if head <= self.last_block:
+            return {}
+
+        changes = self.emit(self.get_logs(self.last_block + 1, head))
+        self.last_block = head
+        return changes
+
+    def run(self, poll_interval: int = watcher_poll_interval):
+        """
+        Polls eth_getLogs forever
+        :param poll_interval: seconds between polls
+        """
+        logger.info(f'Watching {len(self.wallets)} wallets from block {self.last_block}')
+        while True:
+            try:
+                changes = self.poll_once()
+                if changes:
+                    logger.info(f'Changes for {len(changes)} wallets up to block {self.last_block}')
+            except Exception as err:
+                logger.error(f'Watcher poll failed - {type(err).__name__}: {err}')
+            time.sleep(poll_interval)
+
+    async def subscribe(self, ws_uri: str):
+        """
+        Push based alternative to run(), subscribes to logs through websocket rpc.
+        Logs wait for confirmations in memory, logs removed by reorg before that are dropped.
+        on_change runs in executor thread, so it does not block the event loop
+        :param ws_uri: websocket rpc uri, e.g. - wss://base-rpc.publicnode.com
+        """
+        loop = asyncio.get_running_loop()
+        async with AsyncWeb3.persistent_websocket(WebsocketProviderV2(ws_uri)) as ws_w3:
+            heads = await ws_w3.eth.subscribe('newHeads')
+            for log_filter in self.filters():
+                await ws_w3.eth.subscribe('logs', log_filter)
+            head = await ws_w3.eth.block_number
+            logger.info(f'Subscribed to logs of {len(self.wallets)} wallets')
+
+            pending: Dict[tuple, Dict] = {}
+            async for message in ws_w3.ws.listen_to_websocket():
+                result = message['result']
+                if message['subscription'] == heads:
+                    head = max(head, _int(result['number']))
+                elif result.get('removed'):
+                    pending.pop(_log_id(result), None)
+                else:
+                    pending[_log_id(result)] = result
+
+                confirmed = [log_id for log_id, log in pending.items()
+                             if _int(log['blockNumber']) <= head - self.confirmations]
+                if confirmed:
+                    await loop.run_in_executor(None, self.emit, [pending.pop(log_id) for log_id in confirmed])
+
+    def run_websocket(self, ws_uri: str):
+        asyncio.run(self.subscribe(ws_uri))
@@ -0,0 +1,213 @@
+import json
+import sqlite3
+import threading
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Iterator, Tuple
+
+from web3 import Web3
+from eth_account.account import ChecksumAddress
+
+from utils.constants import ZERO_ADDRESS
+from config import super_positions_address, positions_db_file, get_logs_initial_range, get_logs_max_range
+
+abi_file = 'files/abis/superform/SuperPositions.json'
+
+# errors of different providers when eth_getLogs range or response is too big
+RANGE_ERRORS = ('range', 'too large', 'too many', 'more than', 'limited to', 'exceed', 'response size', 'timed out')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS transfers (
+    chain_id INTEGER NOT NULL,
+    block INTEGER NOT NULL,
+    tx_hash TEXT NOT NULL,
+    log_index INTEGER NOT NULL,
+    kind TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    receiver TEXT NOT NULL,
+    superform_id TEXT NOT NULL,
+    amount TEXT NOT NULL,
+    batch_index INTEGER NOT NULL,
+    PRIMARY KEY (chain_id, tx_hash, log_index, batch_index)
+);
+CREATE INDEX IF NOT EXISTS transfers_sender ON transfers (sender, superform_id);
+CREATE INDEX IF NOT EXISTS transfers_receiver ON transfers (receiver, superform_id);
+CREATE TABLE IF NOT EXISTS balances (
+    chain_id INTEGER NOT NULL,
+    wallet TEXT NOT NULL,
+    superform_id TEXT NOT NULL,
+    balance TEXT NOT NULL,
+    PRIMARY KEY (wallet, superform_id, chain_id)
+);
+CREATE TABLE IF NOT EXISTS cursors (
+    chain_id INTEGER PRIMARY KEY,
+    last_block INTEGER NOT NULL
+);
+"""
+
+
+class AdaptiveLogFetcher:
+    def __init__(self, w3: Web3, initial_range: int = get_logs_initial_range, max_range: int = get_logs_max_range,
+                 min_range: int = 1, sparse_logs: int = 100):
+        """
+        Pages eth_getLogs with block range that shrinks on 'range too large' errors and grows on sparse responses
+        :param w3: Web3 instance
+        :param initial_range: first block range
+        :param max_range: biggest allowed block range
+        :param min_range: range that is never split further
+        :param sparse_logs: responses with fewer logs double the range
+        """
+        self.w3 = w3
+        self.block_range = initial_range
+        self.max_range = max_range
+        self.min_range = min_range
+        self.sparse_logs = sparse_logs
+
+    @staticmethod
+    def _is_range_error(err: Exception) -> bool:
+        message = str(err).lower()
+        return any(error in message for error in RANGE_ERRORS)
+
+    def iter_logs(self, log_filter: Dict, from_block: int, to_block: int) -> Iterator[Tuple[int, List]]:
+        """
+        :param log_filter: filter without block range - {'address': ..., 'topics': [...]}
+        :return: iterator of (last block of page, logs of page), pages are in block order
+        """
+        start = from_block
+        while start <= to_block:
+            end = min(start + self.block_range - 1, to_block)
+            try:
+                logs = self.w3.eth.get_logs({**log_filter, 'fromBlock': start, 'toBlock': end})
+            except Exception as err:
+                if not self._is_range_error(err) or self.block_range <= self.min_range:
+                    raise
+                self.block_range = max(self.min_range, self.block_range // 2)
+                logger.debug(f'eth_getLogs range shrunk to {self.block_range}: {err}')
+                continue
+
+            yield end, logs
+            start = end + 1
+            if len(logs) < self.sparse_logs and self.block_range < self.max_range:
+                self.block_range = min(self.max_range, self.block_range * 2)
+
+
+class PositionsIndexer:
+    def __init__(self, w3: Web3, chain_id: int, db_path: str = positions_db_file,
+                 super_positions: str = super_positions_address):
+        """
+        Indexes SuperPositions mint, burn and transfer events of one chain into SQLite
+        :param w3: Web3 instance of the chain
+        :param chain_id: chain id, e.g. - 8453
+        :param db_path: SQLite database file, shared by all chains
+        :param super_positions: SuperPositions contract address
+        """
+        self.w3 = w3
+        self.chain_id = chain_id
+        self.contract = w3.eth.contract(address=Web3.to_checksum_address(super_positions),
+                                        abi=json.load(Path(abi_file).open()))
+        self.events = {
+            self.contract.events.TransferSingle: 'TransferSingle(address,address,address,uint256,uint256)',
+            self.contract.events.TransferBatch: 'TransferBatch(address,address,address,uint256[],uint256[])',
+        }
+        self.topics = {Web3.keccak(text=signature).hex(): event for event, signature in self.events.items()}
+        self.fetcher = AdaptiveLogFetcher(w3)
+
+        Path(db_path).parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(db_path, check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self._lock = threading.Lock()
+
+    def get_cursor(self) -> int | None:
+        row = self.db.execute('SELECT last_block FROM cursors WHERE chain_id = ?', (self.chain_id,)).fetchone()
+        return row[0] if row else None
+
+    def _decode(self, log) -> List[Tuple]:
+        """
+        :return: list of transfer rows, batch transfer gives a row per superform id
+        """
+        decoded = self.topics[log['topics'][0].hex()]().process_log(log)
+        args = decoded['args']
+        ids, values = (args['ids'], args['values']) if 'ids' in args else ([args['id']], [args['value']])
+        if args['from'] == ZERO_ADDRESS:
+            kind = 'mint'
+        elif args['to'] == ZERO_ADDRESS:
+            kind = 'burn'
+        else:
+            kind = 'transfer'
+        return [(self.chain_id, decoded['blockNumber'], decoded['transactionHash'].hex(), decoded['logIndex'], kind,
+                 args['from'], args['to'], str(superform_id), str(value), batch_index)
+                for batch_index, (superform_id, value) in enumerate(zip(ids, values))]
+
+    def _apply(self, rows: List[Tuple], last_block: int):
+        """
+        Stores transfers, updates balances and cursor in one transaction.
+        Amounts are uint256 so balances are kept as text and summed in python
+        """
+        with self._lock, self.db:
+            deltas: Dict[Tuple[str, str], int] = {}
+            for row in rows:
+                inserted = self.db.execute('INSERT OR IGNORE INTO transfers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                           row).rowcount
+                if not inserted:
+                    continue
+                _, _, _, _, _, sender, receiver, superform_id, amount, _ = row
+                if sender != ZERO_ADDRESS:
+                    deltas[(sender, superform_id)] = deltas.get((sender, superform_id), 0) - int(amount)
+                if receiver != ZERO_ADDRESS:
+                    deltas[(receiver, superform_id)] = deltas.get((receiver, superform_id), 0) + int(amount)
+
+            for (wallet, superform_id), delta in deltas.items():
+                row = self.db.execute('SELECT balance FROM balances WHERE wallet = ? AND superform_id = ? '
+                                      'AND chain_id = ?', (wallet, superform_id, self.chain_id)).fetchone()
+                balance = (int(row[0]) if row else 0) + delta
+                self.db.execute('INSERT OR REPLACE INTO balances VALUES (?, ?, ?, ?)',
+                                (self.chain_id, wallet, superform_id, str(balance)))
+            self.db.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?)', (self.chain_id, last_block))
+
+    def sync(self, from_block: int = 0, to_block: int = None) -> int:
+        """
+        Backfills or follows events up to to_block, resumes from the last indexed block
+        :param from_block: first block if chain was never indexed, e.g. SuperPositions deployment block
+        :param to_block: (opt) last block, default is current head
+        :return: (int) number of stored transfers
+        """
+        cursor = self.get_cursor()
+        start = cursor + 1 if cursor is not None else from_block
+        end = self.w3.eth.block_number if to_block is None else to_block
+        if start > end:
+            return 0
+
+        log_filter = {'address': self.contract.address, 'topics': [list(self.topics)]}
+        total = 0
+        for page_end, logs in self.fetcher.iter_logs(log_filter, start, end):
+            rows = [row for log in logs for row in self._decode(log)]
+            self._apply(rows, page_end)
+            total += len(rows)
+        logger.info(f'Indexed {total} SuperPositions transfers on chain {self.chain_id} up to block {end}')
+        return total
+
+    def get_positions(self, wallet: str | ChecksumAddress) -> Dict[str, int]:
+        """
+        :param wallet: wallet address
+        :return: Dict - {superform_id: balance} of non-zero positions on this chain
+        """
+        rows = self.db.execute('SELECT superform_id, balance FROM balances WHERE wallet = ? AND chain_id = ?',
+                               (Web3.to_checksum_address(wallet), self.chain_id)).fetchall()
+        return {superform_id: int(balance) for superform_id, balance in rows if int(balance)}
+
+    def get_history(self, wallet: str | ChecksumAddress, superform_id: int | str = None) -> List[Dict]:
+        """
+        :param wallet: wallet address
+        :param superform_id: (opt) filter by superform id
+        :return: list of transfers of the wallet in block order
+        """
+        wallet = Web3.to_checksum_address(wallet)
+        query = 'SELECT * FROM transfers WHERE chain_id = ? AND (sender = ? OR receiver = ?)'
+        params = [self.chain_id, wallet, wallet]
+        if superform_id is not None:
+            query += ' AND superform_id = ?'
+            params.append(str(superform_id))
+        cursor = self.db.execute(query + ' ORDER BY block, log_index, batch_index', params)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor.fetchall()]
@@ -0,0 +1,264 @@
+import json
+import time
+import random
+import numpy as np
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+
+from modules.superform_api import SuperFormApi
+from utils.rpc_pool import provider_pool
+from utils.price_oracle import price_oracle
+from utils.helpful_scripts import get_network_by_chain_id
+from config import rebalance_max_vault_share, rebalance_max_tvl_share, rebalance_min_tvl, \
+    rebalance_min_move_gas_multiple, rebalance_horizon_days, rebalance_gas_units, rebalance_plan_file, \
+    points_fetch_workers
+
+# stats response fields, the first one present is used
+STAT_FIELDS = {
+    'vault_id': ('vault_id', 'id'),
+    'chain_id': ('chain_id',),
+    'apy': ('apy', 'vault_apy', 'apy_now'),
+    'tvl': ('tvl', 'tvl_usd', 'total_assets_usd'),
+}
+NATIVE_COINGECKO_IDS = {'ETH': 'ethereum', 'MATIC': 'matic-network', 'AVAX': 'avalanche-2', 'BNB': 'binancecoin'}
+
+
+def _stat_value(stat: Dict, field: str):
+    for key in STAT_FIELDS[field]:
+        value = stat.get(key)
+        if value is None and isinstance(stat.get('vault'), dict):
+            value = stat['vault'].get(key)
+        if value is not None:
+            return value
+    return None
+
+
+def estimate_gas_costs(network_ids: List[int], gas_units: int = rebalance_gas_units) -> Dict[int, float]:
+    """
+    Usd cost of one vault operation on every chain from current gas price and native coin price
+    :param network_ids: numbers according to get_network_by_chain_id
+    :return: Dict - {chain id: usd}, chains with unknown price or failed rpc are missing
+    """
+    networks = [get_network_by_chain_id(network_id) for network_id in network_ids]
+    prices = price_oracle.get_prices({NATIVE_COINGECKO_IDS.get(network.token.upper(), '') for network in networks} - {''})
+
+    def gas_price(network):
+        try:
+            return provider_pool.get_web3(random.choice(network.rpc)).eth.gas_price
+        except Exception as err:
+            logger.error(f'Could not get gas price of {network} - {type(err).__name__}: {err}')
+            return None
+
+    result = {}
+    with ThreadPoolExecutor(max_workers=len(networks) or 1) as pool:
+        for network, price_wei in zip(networks, pool.map(gas_price, networks)):
+            price = prices.get(NATIVE_COINGECKO_IDS.get(network.token.upper(), ''))
+            if price_wei is not None and price is not None:
+                result[network.chain_id] = price_wei * gas_units / 10 ** network.decimals * price
+    return result
+
+
+class Rebalancer:
+    def __init__(self, max_vault_share: float = rebalance_max_vault_share,
+                 max_tvl_share: float = rebalance_max_tvl_share, min_tvl: float = rebalance_min_tvl,
+                 min_move_gas_multiple: float = rebalance_min_move_gas_multiple,
+                 horizon_days: float = rebalance_horizon_days):
+        """
+        Computes target allocation of all wallets at once and plans deposits and withdrawals to reach it
+        :param max_vault_share: max part of wallet value in one vault
+        :param max_tvl_share: max part of vault tvl held by all our wallets together
+        :param min_tvl: vaults with smaller tvl are not used as targets
+        :param min_move_gas_multiple: deposit or withdrawal smaller than gas cost x this value is skipped
+        :param horizon_days: wallet is rebalanced only if extra yield over this period pays for its gas
+        """
+        self.max_vault_share = max_vault_share
+        self.max_tvl_share = max_tvl_share
+        self.min_tvl = min_tvl
+        self.min_move_gas_multiple = min_move_gas_multiple
+        self.horizon_days = horizon_days
+
+    """
+    INPUTS
+    """
+
+    @staticmethod
+    def vault_arrays(vault_stats: List[Dict]) -> Dict[str, np.ndarray]:
+        """
+        :param vault_stats: get_all_vaults_stats response
+        :return: Dict - {'vault_id': array, 'chain_id': array, 'apy': array in percent, 'tvl': array in usd}
+        """
+        rows = [(_stat_value(stat, 'vault_id'), _stat_value(stat, 'chain_id'), _stat_value(stat, 'apy'),
+                 _stat_value(stat, 'tvl')) for stat in vault_stats]
+        rows = [row for row in rows if row[0] is not None and row[1] is not None]
+        return {
+            'vault_id': np.array([row[0] for row in rows], dtype=str),
+            'chain_id': np.array([int(row[1]) for row in rows], dtype=np.int64),
+            'apy': np.array([float(row[2]) if row[2] is not None else np.nan for row in rows]),
+            'tvl': np.array([float(row[3]) if row[3] is not None else np.nan for row in rows]),
+        }
+
+    @staticmethod
+    def holdings_matrix(portfolios: Dict[str, Dict], vault_ids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param portfolios: Dict - {wallet: SuperFormApi.get_portfolio response}
+        :param vault_ids: vault ids, columns of the matrix
+        :return: (wallets array, usd holdings matrix wallets x vaults)
+        """
+        wallets = np.array(sorted(portfolios), dtype=str)
+        column = {vault_id: i for i, vault_id in enumerate(vault_ids)}
+        holdings = np.zeros((len(wallets), len(vault_ids)))
+        unknown = 0
+        for row, wallet in enumerate(wallets):
+            for superposition in (portfolios[wallet] or {}).get('superpositions') or []:
+                i = column.get(superposition['vault']['id'])
+                if i is None:
+                    unknown += 1
+                    continue
+                holdings[row, i] += float(superposition['superposition_usd_value'] or 0)
+        if unknown:
+            logger.warning(f'{unknown} positions are in vaults without stats, they are not rebalanced')
+        return wallets, holdings
+
+    @staticmethod
+    def fetch_portfolios(addresses: List[str], api: SuperFormApi = None,
+                         max_workers: int = points_fetch_workers) -> Dict[str, Dict | None]:
+        """
+        :return: Dict - {address: get_portfolio response or None if request failed}
+        """
+        api = api if api else SuperFormApi()
+
+        def fetch_one(address):
+            try:
+                return api.get_portfolio(address=address)
+            except Exception as err:
+                logger.error(f'Could not get portfolio of {address} - {type(err).__name__}: {err}')
+                return None
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return dict(zip(addresses, pool.map(fetch_one, addresses)))
+
+    """
+    ALLOCATION
+    """
+
+    def targets(self, holdings: np.ndarray, apy: np.ndarray, tvl: np.ndarray, idle: np.ndarray = None) -> np.ndarray:
+        """
+        Fills vaults from the best apy down, every wallet puts at most max_vault_share of its value in one vault
+        and all wallets together at most max_tvl_share of vault tvl, biggest wallets fill capped vault first.
+        Value which could not be placed under these caps stays where it is
+        :param holdings: usd holdings, wallets x vaults
+        :param apy: apy of vaults in percent
+        :param tvl: tvl of vaults in usd
+        :param idle: (opt) usd available for deposits per wallet
+        :return: target usd holdings, wallets x vaults
+        """
+        idle = np.zeros(len(holdings)) if idle is None else idle
+        value = holdings.sum(axis=1) + idle
+        eligible = (tvl >= self.min_tvl) & (apy > 0)
+        order = [v for v in np.argsort(-np.nan_to_num(apy, nan=-np.inf)) if eligible[v]]
+        wallet_cap = self.max_vault_share * value
+
+        target = np.zeros_like(holdings)
+        remaining = value.copy()
+        for v in order:
+            take = np.minimum(remaining, wallet_cap)
+            total = take.sum()
+            capacity = self.max_tvl_share * tvl[v]
+            if total > capacity:
+                # capped vault is filled wallet by wallet, biggest first, so few wallets move instead of all of them
+                by_size = np.argsort(-take, kind='stable')
+                sizes = take[by_size]
+                take[by_size] = np.clip(capacity - (np.cumsum(sizes) - sizes), 0, sizes)
+            target[:, v] = take
+            remaining -= take
+            if remaining.max(initial=0) <= 1e-9:
+                break
+
+        kept = np.divide(remaining, value, out=np.zeros_like(value), where=value > 0)
+        return target + holdings * kept[:, None]
+
+    def moves(self, holdings: np.ndarray, target: np.ndarray, apy: np.ndarray, gas: np.ndarray,
+              idle: np.ndarray = None) -> np.ndarray:
+        """
+        Turns targets into usd moves, drops moves which do not pay for gas
+        :param gas: usd cost of one operation per vault, nan if unknown
+        :return: usd change of holdings, wallets x vaults, positive - deposit, negative - withdrawal
+        """
+        idle = np.zeros(len(holdings)) if idle is None else idle
+        delta = target - holdings
+        # vaults on chains with unknown gas cost are not touched
+        small = ~(np.abs(delta) >= np.nan_to_num(gas, nan=np.inf) * self.min_move_gas_multiple)
+        delta[small] = 0
+
+        # deposits could use only withdrawn and idle funds
+        deposits = delta.clip(min=0).sum(axis=1)
+        available = idle - delta.clip(max=0).sum(axis=1)
+        scale = np.divide(available, deposits, out=np.ones_like(deposits), where=deposits > available)
+        delta = np.where(delta > 0, delta * scale[:, None], delta)
+
+        gain = (delta * np.nan_to_num(apy) / 100).sum(axis=1) * self.horizon_days / 365
+        cost = (delta != 0) @ np.nan_to_num(gas)
+        delta[gain <= cost] = 0
+        return delta
+
+    """
+    PLAN
+    """
+
+    def plan(self, vault_stats: List[Dict], portfolios: Dict[str, Dict], gas_costs: Dict[int, float],
+             idle: Dict[str, float] = None) -> Dict:
+        """
+        :param vault_stats: get_all_vaults_stats response
+        :param portfolios: Dict - {wallet: get_portfolio response}
+        :param gas_costs: Dict - {chain id: usd cost of one vault operation}, e.g. from estimate_gas_costs
+        :param idle: (opt) Dict - {wallet: usd available for deposits}
+        :return: Dict - {'summary': {...}, 'withdrawals': [...], 'deposits': [...]}, withdrawals go first
+        """
+        start = time.perf_counter()
+        vaults = self.vault_arrays(vault_stats)
+        wallets, holdings = self.holdings_matrix(portfolios, vaults['vault_id'])
+        idle_usd = np.array([float((idle or {}).get(wallet, 0)) for wallet in wallets])
+        gas = np.array([gas_costs.get(int(chain_id), np.nan) for chain_id in vaults['chain_id']])
+
+        target = self.targets(holdings, vaults['apy'], vaults['tvl'], idle_usd)
+        delta = self.moves(holdings, target, vaults['apy'], gas, idle_usd)
+
+        rows, columns = np.nonzero(delta)
+        amounts = delta[rows, columns]
+        out = amounts < 0
+        # sdk withdraws whole percents of position
+        percents = np.minimum(100, np.ceil(-amounts[out] / holdings[rows[out], columns[out]] * 100)).astype(np.int64)
+        moves = [{'wallet': wallet, 'vault_id': vault_id, 'chain_id': chain_id, 'usd_amount': usd_amount}
+                 for wallet, vault_id, chain_id, usd_amount in zip(
+                     wallets[rows].tolist(), vaults['vault_id'][columns].tolist(),
+                     vaults['chain_id'][columns].tolist(), np.round(np.abs(amounts), 2).tolist())]
+        withdrawals = [move for move, is_out in zip(moves, out.tolist()) if is_out]
+        deposits = [move for move, is_out in zip(moves, out.tolist()) if not is_out]
+        for move, percent in zip(withdrawals, percents.tolist()):
+            move['withdraw_percent'] = percent
+
+        moved = np.abs(delta).sum()
+        return {
+            'summary': {
+                'wallets': int(len(wallets)),
+                'vaults': int(len(vaults['vault_id'])),
+                'rebalanced_wallets': int(np.count_nonzero(np.any(delta != 0, axis=1))),
+                'moved_usd': round(float(moved), 2),
+                'yearly_gain_usd': round(float((delta * np.nan_to_num(vaults['apy']) / 100).sum()), 2),
+                'gas_usd': round(float(((delta != 0) @ np.nan_to_num(gas)).sum()), 2),
+                'seconds': round(time.perf_counter() - start, 3),
+            },
+            'withdrawals': withdrawals,
+            'deposits': deposits,
+        }
+
+    @staticmethod
+    def save(plan: Dict, path: str = rebalance_plan_file) -> Path:
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with path.open('w') as file:
+            json.dump(plan, file, indent=2)
+        return path
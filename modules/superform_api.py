@@ -1,10 +1,26 @@
+import json
+import hashlib
 import requests
+import threading
 import urllib.parse
 
 from eth_account.account import ChecksumAddress
-from typing import Dict, List
+from typing import Dict, List, Iterable, Iterator, Tuple
 from fake_useragent import UserAgent
 
+# optional, faster decoding of big responses
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from utils.metrics import api_response_hook
+from utils.cassette import install_cassette
+
 
 class RequestException(Exception):
     def __init__(self, message):
@@ -24,24 +40,126 @@ def _get_headers() -> Dict:
            }
 
 
-def _handle_response(response: requests.Response):
+def _handle_response(response: requests.Response, fast: bool = False):
     """Internal helper for handling API responses from the server.
     Raises the appropriate exceptions when necessary; otherwise, returns the
     response.
+    With fast=True the body is decoded by orjson, see loads.
     """
     if not (200 <= response.status_code < 300):
         raise RequestException('Invalid Response: %s' % response.text)
     try:
-        return response.json()
+        return loads(response.content) if fast else json.loads(response.content)
     except:
         raise RequestException('Invalid Response: %s' % response.text)
 
 
+def loads(content: bytes):
+    """
+    Decodes json with orjson if it is installed.
+    WARNING, orjson turns integers bigger than 64 bit into floats, use it only for listings without wei amounts
+    """
+    return orjson.loads(content) if orjson else json.loads(content)
+
+
+def _project(item: Dict, fields: Tuple[str, ...]) -> Dict:
+    """
+    :param fields: field names, nested fields are separated by dot, e.g. - ('id', 'chain.id')
+    :return: Dict - {field: value or None}
+    """
+    result = {}
+    for field in fields:
+        value = item
+        for key in field.split('.'):
+            value = value.get(key) if isinstance(value, dict) else None
+        result[field] = value
+    return result
+
+
+def iter_json_items(chunks: Iterable[bytes], fields: Tuple[str, ...] = None) -> Iterator[Dict]:
+    """
+    Decodes top level json array incrementally, only one item is in memory at a time
+    :param chunks: body chunks, e.g. response.iter_content()
+    :param fields: (opt) keep only these fields of every item, see _project
+    :return: iterator of items
+    """
+    if ijson is None:
+        items = loads(b''.join(chunks))
+        yield from (_project(item, fields) for item in items) if fields else items
+        return
+
+    events = ijson.sendable_list()
+    parser = ijson.items_coro(events, 'item', use_float=True)
+    for chunk in chunks:
+        parser.send(chunk)
+        for item in events:
+            yield _project(item, fields) if fields else item
+        del events[:]
+    parser.close()
+    for item in events:
+        yield _project(item, fields) if fields else item
+
+
+class ConditionalCache:
+    def __init__(self):
+        """
+        Parsed responses of rarely changing endpoints with their validators, shared by all SuperFormApi instances
+        """
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    def get(self, uri: str) -> Dict | None:
+        """
+        :return: Dict - {'etag', 'last_modified', 'content_hash', 'data', 'version'} or None
+        """
+        with self._lock:
+            return self._entries.get(uri)
+
+    def validators(self, uri: str) -> Dict:
+        """
+        :return: conditional request headers for uri
+        """
+        entry = self.get(uri)
+        headers = {}
+        if entry and entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def store(self, uri: str, response: requests.Response, content_hash: str, data) -> int:
+        """
+        :return: version of data, it grows only when content changes
+        """
+        with self._lock:
+            entry = self._entries.get(uri)
+            changed = entry is None or entry['content_hash'] != content_hash
+            self._entries[uri] = {
+                'etag': response.headers.get('ETag'),
+                'last_modified': response.headers.get('Last-Modified'),
+                'content_hash': content_hash,
+                'data': data if changed else entry['data'],
+                'version': (entry['version'] + 1 if entry else 1) if changed else entry['version'],
+            }
+            return self._entries[uri]['version']
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+conditional_cache = ConditionalCache()
+
+
 class SuperFormApi:
     def __init__(self, headers=None):
         self.endpoint = 'https://api.superform.xyz/'
         self.headers = headers if headers else _get_headers()
         self.session = self._init_session()
+        # set by conditional requests, True if data did not change since previous call of this instance
+        self.unchanged = False
+        # {uri: version of conditional_cache data last returned by this instance}
+        self._seen_versions: Dict[str, int] = {}
 
     """
     BASE METHODS
@@ -54,6 +172,8 @@ class SuperFormApi:
         """
         session = requests.session()
         session.headers.update(self.headers)
+        session.hooks['response'].append(api_response_hook)
+        install_cassette(session)
         return session
 
     def _create_api_uri(self, path: str, params: Dict = None) -> str:
@@ -67,18 +187,62 @@ class SuperFormApi:
             return self.endpoint + path + urllib.parse.urlencode(params)
         return self.endpoint + path
 
-    def _request(self, method: str, uri: str, **kwargs):
+    def _request(self, method: str, uri: str, fast: bool = False, **kwargs):
         """
         Makes request
         :param method: (str) get, put, option request method
         :param uri: (str) uri string for request
+        :param fast: (bool) decode with orjson, only for listings, amounts in wei lose precision
         :param kwargs: (dict) additional arguments to request
         :return: returns request response from _handle_response function
         """
         if method.lower() not in ['get', 'post', 'option']:
             raise RequestException('Used wrong request method')
         self.response = getattr(self.session, method)(uri, **kwargs)
-        return _handle_response(self.response)
+        return _handle_response(self.response, fast=fast)
+
+    def _stream(self, uri: str, fields: Tuple[str, ...] = None, chunk_size: int = 64 * 1024) -> Iterator[Dict]:
+        """
+        GET of json array that is decoded while it is downloaded
+        :param uri: (str) uri string for request
+        :param fields: (opt) keep only these fields of every item, e.g. - ('id', 'chain.id')
+        :param chunk_size: bytes read at once
+        :return: iterator of items
+        """
+        with self.session.get(uri, stream=True) as response:
+            self.response = response
+            if not (200 <= response.status_code < 300):
+                raise RequestException('Invalid Response: %s' % response.text)
+            yield from iter_json_items(response.iter_content(chunk_size), fields)
+
+    def _request_conditional(self, uri: str):
+        """
+        GET with If-None-Match/If-Modified-Since, parsed object is reused on 304. Used only for listings,
+        body is decoded by orjson.
+        If server does not send validators, body hash is compared instead, so unchanged body is not parsed again.
+        self.unchanged is True if the same data as on the previous call of this instance was returned,
+        calls of other instances do not affect it.
+        WARNING, returned object is shared by all callers, do not modify it
+        :param uri: (str) uri string for request
+        :return: parsed response
+        """
+        cached = conditional_cache.get(uri)
+        self.response = self.session.get(uri, headers=conditional_cache.validators(uri))
+        if self.response.status_code == 304 and cached:
+            data, version = cached['data'], cached['version']
+        else:
+            if not (200 <= self.response.status_code < 300):
+                raise RequestException('Invalid Response: %s' % self.response.text)
+            content_hash = hashlib.blake2b(self.response.content, digest_size=16).hexdigest()
+            if cached and cached['content_hash'] == content_hash:
+                data = cached['data']
+            else:
+                data = _handle_response(self.response, fast=True)
+            version = conditional_cache.store(uri, self.response, content_hash, data)
+            data = conditional_cache.get(uri)['data']
+        self.unchanged = self._seen_versions.get(uri) == version
+        self._seen_versions[uri] = version
+        return data
 
     """
     GENERAL METHODS
@@ -87,10 +251,11 @@ class SuperFormApi:
     def get_supported_chains(self) -> List[Dict]:
         """
         :return: The list of supported chains with all data
+        Revalidated with conditional request, result is shared cached object, do not modify it
         """
         path = 'supported/chains'
         uri = self._create_api_uri(path)
-        return self._request(method='get', uri=uri)
+        return self._request_conditional(uri=uri)
 
     def get_admin(self) -> Dict:
         """
@@ -103,10 +268,11 @@ class SuperFormApi:
     def get_contract_deployment_address(self) -> Dict:
         """
         :return: The list  of deployed contracts in different chains
+        Revalidated with conditional request, result is shared cached object, do not modify it
         """
         path = 'deployment'
         uri = self._create_api_uri(path)
-        return self._request(method='get', uri=uri)
+        return self._request_conditional(uri=uri)
 
     """
     PROTOCOL METHODS
@@ -115,10 +281,11 @@ class SuperFormApi:
     def get_all_protocols(self) -> List[Dict]:
         """
         :return: list of all protocols with details
+        Revalidated with conditional request, result is shared cached object, do not modify it
         """
         path = f'protocols'
         uri = self._create_api_uri(path)
-        return self._request(method='get', uri=uri)
+        return self._request_conditional(uri=uri)
 
     def get_protocol_data(self, protocol_vanity_url: str) -> Dict:
         """
@@ -150,10 +317,21 @@ class SuperFormApi:
     def get_all_vaults(self) -> List[Dict]:
         """
         :return: list of all vaults with details
+        Revalidated with conditional request, result is shared cached object, do not modify it
         """
         path = f'vaults'
         uri = self._create_api_uri(path)
-        return self._request(method='get', uri=uri)
+        return self._request_conditional(uri=uri)
+
+    def iter_all_vaults(self, fields: Tuple[str, ...] = None) -> Iterator[Dict]:
+        """
+        Streaming alternative of get_all_vaults, vaults are decoded one by one while response is downloaded
+        :param fields: (opt) keep only these fields of every vault, e.g. - ('id', 'chain.id')
+        :return: iterator of vaults
+        """
+        path = f'vaults'
+        uri = self._create_api_uri(path)
+        return self._stream(uri=uri, fields=fields)
 
     def get_vault_data(self, vault_id: str) -> Dict:
         """
@@ -174,7 +352,17 @@ class SuperFormApi:
         """
         path = f'stats/vault/superformStat'
         uri = self._create_api_uri(path)
-        return self._request(method='get', uri=uri)
+        return self._request(method='get', uri=uri, fast=True)
+
+    def iter_all_vaults_stats(self, fields: Tuple[str, ...] = None) -> Iterator[Dict]:
+        """
+        Streaming alternative of get_all_vaults_stats, stats are decoded one by one while response is downloaded
+        :param fields: (opt) keep only these fields of every vault stats
+        :return: iterator of vault stats
+        """
+        path = f'stats/vault/superformStat'
+        uri = self._create_api_uri(path)
+        return self._stream(uri=uri, fields=fields)
 
     """
     USER METHODS
@@ -5,14 +5,18 @@ from loguru import logger
 from web3 import Web3
 from eth_account.account import ChecksumAddress
 
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Tuple
 
 from modules.client import MyClient
 from modules.superform_api import SuperFormApi
+from modules.local_simulation import LocalSimulator, SimulationResult
+from modules.calldata_verifier import verify_router_tx, verify_claim_tx, log_mismatches
 from eth_account.signers.local import LocalAccount
 
-from utils.helpful_scripts import check_tx_status, approve, send_tx_with_data
-from config import superform_router_address, eth_address, bridge_slippage, swap_slippage
+from utils.helpful_scripts import check_tx_status, approve, is_approved, send_tx_with_data
+from utils.tracing import tracer
+from config import superform_router_address, eth_address, bridge_slippage, swap_slippage, local_simulation, \
+    remote_simulation
 
 
 class MySuperform(MyClient):
@@ -20,6 +24,7 @@ class MySuperform(MyClient):
         super().__init__(account=account, network_id=base_network_id)
         self.module_name = 'SuperForm'
         self.superform_api = SuperFormApi()
+        self.local_simulator = LocalSimulator(self.w3)
         self.native_balance = self.get_native_balance()
 
     def _check_if_has_enough_balance(self, amount: float, token_address: ChecksumAddress):
@@ -40,33 +45,108 @@ class MySuperform(MyClient):
             return False
         return True
 
+    def _approval_target(self, tx_data: Dict, token_address: ChecksumAddress, operation_type: str) \
+            -> Tuple[ChecksumAddress | None, ChecksumAddress | None]:
+        """
+        :return: (token, spender) that operation needs approval for, (None, None) if approval is not needed
+        """
+        approve_data = tx_data['approvalData']
+        if approve_data:
+            return Web3.to_checksum_address(approve_data['to']), \
+                Web3.to_checksum_address('0x' + approve_data['data'][34:74])
+        # for some reason deposit data from api do not have approve_data, router is approved manually
+        if operation_type == 'smart' and token_address != Web3.to_checksum_address(eth_address):
+            return token_address, Web3.to_checksum_address(superform_router_address)
+        return None, None
+
+    def preflight(self, tx_data: Dict, token_address: ChecksumAddress, operation_type: str) -> SimulationResult | None:
+        """
+        Simulates operation tx locally as if token was already approved, nothing is sent
+        :return: SimulationResult, None if approval is needed but allowance of token could not be overridden
+        """
+        approval_token, approval_spender = self._approval_target(tx_data, token_address, operation_type)
+        with tracer.span('local_simulation'):
+            return self.local_simulator.simulate_with_approval(
+                sender=self.address, to=tx_data['to'], data=tx_data['data'], value=int(tx_data['value']),
+                token=approval_token, spender=approval_spender)
+
     def before_vault_operation(self, tx_data: Dict, amount: float | int, token_address: ChecksumAddress,
-                               superform_id: str, operation_type: str) -> bool:
+                               superform_id: str, operation_type: str, calldata_verified: bool = False,
+                               preflight: SimulationResult = None) -> int | None:
+        """
+        Approves token spend if needed and simulates operation tx.
+        Local simulation runs before approvals when allowance could be overridden, remote ones are opt-in
+        :param calldata_verified: calldata was decoded and matches quote, remote router simulation is skipped
+        :param preflight: (opt) result of preflight() that was already made
+        :return: gas limit for operation tx, 0 if it was not simulated locally, None if operation would fail
+        """
 
         approve_data = tx_data['approvalData']
-
-        if approve_data:
+        approval_token, approval_spender = self._approval_target(tx_data, token_address, operation_type)
+
+        simulation = preflight
+        if local_simulation and simulation is None:
+            simulation = self.preflight(tx_data=tx_data, token_address=token_address, operation_type=operation_type)
+        if simulation is not None and not simulation.success:
+            logger.error(f'Local simulation reverted: {simulation.revert_reason}. Would not make tx')
+            return None
+
+        # approval from api is skipped if allowance is already enough
+        if approve_data and not is_approved(account=self.account, w3=self.w3, token_addr=approval_token,
+                                            amount=int(approve_data['data'][74:138], 16), spender=approval_spender):
             logger.info('Approving')
-            tx_approve_hash = send_tx_with_data(to=approve_data['to'], w3=self.w3, explorer=self.explorer,
-                                                account=self.account, eip1559=self.eip1559_support,
-                                                data=approve_data['data'], value=int(approve_data['value']))
-            if not check_tx_status(w3=self.w3, tx_hash=tx_approve_hash):
-                logger.error('Could not approve token spend')
-                return False
+            with tracer.span('approve'):
+                tx_approve_hash = send_tx_with_data(to=approve_data['to'], w3=self.w3, explorer=self.explorer,
+                                                    account=self.account, eip1559=self.eip1559_support,
+                                                    data=approve_data['data'], value=int(approve_data['value']))
+                if not check_tx_status(w3=self.w3, tx_hash=tx_approve_hash):
+                    logger.error('Could not approve token spend')
+                    return None
 
             time.sleep(random.randint(5, 10))
 
         # for some reason deposit data from api do not have approve_data, need to do this manually
         if operation_type == 'smart' and not approve_data:
-            amount = self.to_wei(number=amount, decimals=self.get_decimals(token_address=token_address))
-            if not approve(account=self.account, w3=self.w3, token_address=token_address,
-                           spender=superform_router_address,
-                           explorer=self.explorer, eip1559=self.eip1559_support, amount=amount):
-                logger.error('Could not approve token spend')
-                return False
+            decimals = 18 if token_address == Web3.to_checksum_address(eth_address) else \
+                self.get_decimals(token_address=token_address)
+            amount = self.to_wei(number=amount, decimals=decimals)
+
+        # native coin does not need approval
+        if approval_spender and not approve_data and not is_approved(account=self.account, w3=self.w3,
+                                                                      token_addr=token_address, amount=amount,
+                                                                      spender=superform_router_address):
+            with tracer.span('approve'):
+                if not approve(account=self.account, w3=self.w3, token_address=token_address,
+                               spender=superform_router_address,
+                               explorer=self.explorer, eip1559=self.eip1559_support, amount=amount):
+                    logger.error('Could not approve token spend')
+                    return None
 
             time.sleep(random.randint(5, 10))
 
+        # allowance of token could not be overridden, simulate with real approval
+        if local_simulation and simulation is None:
+            with tracer.span('local_simulation'):
+                simulation = self.local_simulator.simulate(sender=self.address, to=tx_data['to'],
+                                                           data=tx_data['data'], value=int(tx_data['value']))
+            if not simulation.success:
+                logger.error(f'Local simulation reverted: {simulation.revert_reason}. Would not make tx')
+                return None
+
+        if remote_simulation or not local_simulation:
+            if not self._remote_simulation(tx_data=tx_data, amount=amount, superform_id=superform_id,
+                                           operation_type=operation_type, router_simulation=not calldata_verified):
+                return None
+
+        return int(simulation.gas_used * 1.05) if simulation else 0
+
+    def _remote_simulation(self, tx_data: Dict, amount: float | int, superform_id: str, operation_type: str,
+                           router_simulation: bool = True) -> bool:
+        """
+        Simulates operation and router tx on Superform API
+        :param router_simulation: False to skip router tx simulation, e.g. when calldata is verified locally
+        :return: True if all simulations succeeded
+        """
         sim_data = {
             'user_address': self.address,
             'superform_id': superform_id,
@@ -77,12 +157,16 @@ class MySuperform(MyClient):
             'retain_4626': False,
         }
 
-        simulations = self.superform_api.get_simulation(sim_data)['data']
+        with tracer.span('simulation'):
+            simulations = self.superform_api.get_simulation(sim_data)['data']
         for simulation in simulations:
             if 'success' not in simulation.keys() or not simulation['success']:
                 logger.error(f'Simulation error {simulation}. Would not make tx correctly')
                 return False
 
+        if not router_simulation:
+            return True
+
         sim_router_data = {
             'user_address': self.address,
             'chain_id': self.chain_id,
@@ -91,30 +175,19 @@ class MySuperform(MyClient):
             'is_router': True
         }
 
-        router_simulation = self.superform_api.get_router_simulation(request_data=sim_router_data)['data']
+        with tracer.span('router_simulation'):
+            router_simulation = self.superform_api.get_router_simulation(request_data=sim_router_data)['data']
         if 'success' not in router_simulation.keys() or not router_simulation['success']:
             logger.error(f'Router simulation error {router_simulation}. Would not make operation correctly')
             return False
 
         return True
 
-    def deposit_single_vault(self, vault_id: str, amount: float, token_address: str | ChecksumAddress = eth_address) \
-            -> bool:
+    def quote_deposit(self, vault_id: str, amount: float, token_address: ChecksumAddress) -> Tuple[Dict, Dict] | None:
         """
-        Makes deposit to the selected vault
-        :param vault_id: vault_id, e.g. - pxOqM7dFwI2Abt-yTv4jC
-        :param amount: (float) amount to deposit in human-readable format
-        :param token_address: token to deposit, default is ETH
-        :return: True if success, False if not
+        Gets deposit route and transaction from api and verifies its calldata
+        :return: (calculate_user_deposit response, start_deposit response), None if calldata does not match quote
         """
-
-        token_address = Web3.to_checksum_address(token_address)
-
-        logger.info(f'Depositing {amount} of {token_address} to vault {vault_id}')
-
-        if not self._check_if_has_enough_balance(amount=amount, token_address=token_address):
-            raise ValueError(f'Deposit amount {amount} of {token_address} is bigger than balance')
-
         deposit_params = {
             'user_address': self.address,
             'from_token_address': token_address,
@@ -129,22 +202,62 @@ class MySuperform(MyClient):
             'force': int(time.time()) + 300000,
         }
 
-        calculate_dep = self.superform_api.calculate_user_deposit(deposit_params)
-        dep_tx_data = self.superform_api.start_deposit(calculate_dep)
+        with tracer.span('calculate'):
+            calculate_dep = self.superform_api.calculate_user_deposit(deposit_params)
+        with tracer.span('start'):
+            dep_tx_data = self.superform_api.start_deposit(calculate_dep)
+
+        max_value = self.to_wei(number=amount) if token_address == Web3.to_checksum_address(eth_address) else None
+        with tracer.span('verify_calldata'):
+            mismatches = verify_router_tx(tx_data=dep_tx_data, operation='deposit', user=self.address,
+                                          superform_id=calculate_dep['in']['superFormId'],
+                                          max_slippage=bridge_slippage + swap_slippage, amount=max_value,
+                                          token=token_address)
+        if not log_mismatches(mismatches, operation='deposit'):
+            return None
+        return calculate_dep, dep_tx_data
 
-        if not self.before_vault_operation(tx_data=dep_tx_data, amount=amount, token_address=token_address,
-                                           superform_id=calculate_dep['in']['superFormId'], operation_type='smart'):
-            logger.error('Could not make prepare for deposit')
-            return False
+    def deposit_single_vault(self, vault_id: str, amount: float, token_address: str | ChecksumAddress = eth_address) \
+            -> bool:
+        """
+        Makes deposit to the selected vault
+        :param vault_id: vault_id, e.g. - pxOqM7dFwI2Abt-yTv4jC
+        :param amount: (float) amount to deposit in human-readable format
+        :param token_address: token to deposit, default is ETH
+        :return: True if success, False if not
+        """
 
-        tx_hash = send_tx_with_data(to=dep_tx_data['to'], w3=self.w3, explorer=self.explorer, account=self.account,
-                                    eip1559=self.eip1559_support, data=dep_tx_data['data'],
-                                    value=int(dep_tx_data['value']))
+        with tracer.span('deposit', wallet=self.address, vault=vault_id, chain=self.chain_id), \
+                logger.contextualize(vault=vault_id):
+            token_address = Web3.to_checksum_address(token_address)
 
-        if check_tx_status(w3=self.w3, tx_hash=tx_hash):
-            logger.success('Deposited')
-            return True
-        return False
+            logger.info(f'Depositing {amount} of {token_address} to vault {vault_id}')
+
+            with tracer.span('balance_check'):
+                has_enough_balance = self._check_if_has_enough_balance(amount=amount, token_address=token_address)
+            if not has_enough_balance:
+                raise ValueError(f'Deposit amount {amount} of {token_address} is bigger than balance')
+
+            quote = self.quote_deposit(vault_id=vault_id, amount=amount, token_address=token_address)
+            if quote is None:
+                return False
+            calculate_dep, dep_tx_data = quote
+
+            gas = self.before_vault_operation(tx_data=dep_tx_data, amount=amount, token_address=token_address,
+                                              superform_id=calculate_dep['in']['superFormId'], operation_type='smart',
+                                              calldata_verified=True)
+            if gas is None:
+                logger.error('Could not make prepare for deposit')
+                return False
+
+            tx_hash = send_tx_with_data(to=dep_tx_data['to'], w3=self.w3, explorer=self.explorer, account=self.account,
+                                        eip1559=self.eip1559_support, data=dep_tx_data['data'],
+                                        value=int(dep_tx_data['value']), gas=gas, vault=vault_id)
+
+            if check_tx_status(w3=self.w3, tx_hash=tx_hash):
+                logger.success('Deposited')
+                return True
+            return False
 
     def withdraw_single_vault(self, vault_id: str, withdraw_percent: int = 100,
                               token_address: str | ChecksumAddress = eth_address) -> bool:
@@ -157,62 +270,77 @@ class MySuperform(MyClient):
         :return: True if success, False if not
         """
 
-        token_address = Web3.to_checksum_address(token_address)
-
-        logger.info(f'Withdrawing {withdraw_percent} percent from vault {vault_id}')
-
-        user_portfolio = self.get_portfolio()
-        if vault_id not in user_portfolio.keys():
-            logger.info('Do not have deposit in this vault')
-            return True
-
-        user_data_in_vault = user_portfolio[vault_id]
-        if withdraw_percent == 100:
-            amount_to_withdraw = int(user_data_in_vault['superposition_balance'])
-        else:
-            amount_to_withdraw = int(int(user_data_in_vault['superposition_balance']) / 100 * withdraw_percent)
-
-        # Superposition is represented by number with 18 decimals, we do not want withdrew dust
-        if amount_to_withdraw < 100:
-            logger.warning('Probably already withdrew. Would not make withdrew of dust position')
-            return True
-
-        params = {
-            'user_address': self.address,
-            'refund_address': self.address,
-            'vault_id': vault_id,
-            'bridge_slippage': bridge_slippage,
-            'swap_slippage': swap_slippage,
-            'route_type': 'output',
-            'to_token_address': token_address,
-            'to_chain_id': self.chain_id,
-            'superpositions_amount_in': amount_to_withdraw,
-            'superpositions_chain_id': user_data_in_vault['chain id'],
-            'is_part_of_multivault': False,
-            'force': int(time.time()) + 300000,
-            'is_erc20': user_data_in_vault['is_erc20'],
-            'retain_4626': 'false',
+        with tracer.span('withdraw', wallet=self.address, vault=vault_id, chain=self.chain_id), \
+                logger.contextualize(vault=vault_id):
+            token_address = Web3.to_checksum_address(token_address)
+
+            logger.info(f'Withdrawing {withdraw_percent} percent from vault {vault_id}')
+
+            with tracer.span('portfolio'):
+                user_portfolio = self.get_portfolio()
+            if vault_id not in user_portfolio.keys():
+                logger.info('Do not have deposit in this vault')
+                return True
+
+            user_data_in_vault = user_portfolio[vault_id]
+            if withdraw_percent == 100:
+                amount_to_withdraw = int(user_data_in_vault['superposition_balance'])
+            else:
+                amount_to_withdraw = int(int(user_data_in_vault['superposition_balance']) / 100 * withdraw_percent)
+
+            # Superposition is represented by number with 18 decimals, we do not want withdrew dust
+            if amount_to_withdraw < 100:
+                logger.warning('Probably already withdrew. Would not make withdrew of dust position')
+                return True
+
+            params = {
+                'user_address': self.address,
+                'refund_address': self.address,
+                'vault_id': vault_id,
+                'bridge_slippage': bridge_slippage,
+                'swap_slippage': swap_slippage,
+                'route_type': 'output',
+                'to_token_address': token_address,
+                'to_chain_id': self.chain_id,
+                'superpositions_amount_in': amount_to_withdraw,
+                'superpositions_chain_id': user_data_in_vault['chain id'],
+                'is_part_of_multivault': False,
+                'force': int(time.time()) + 300000,
+                'is_erc20': user_data_in_vault['is_erc20'],
+                'retain_4626': 'false',
+
+            }
+
+            with tracer.span('calculate'):
+                calculate_withdraw = self.superform_api.calculate_user_withdrawal(params)
+            with tracer.span('start'):
+                withdraw_tx_data = self.superform_api.start_withdrawal(calculate_withdraw)
+
+            with tracer.span('verify_calldata'):
+                mismatches = verify_router_tx(tx_data=withdraw_tx_data, operation='withdraw', user=self.address,
+                                              superform_id=calculate_withdraw['in']['superFormId'],
+                                              max_slippage=bridge_slippage + swap_slippage, amount=amount_to_withdraw)
+            if not log_mismatches(mismatches, operation='withdrawal'):
+                return False
 
-        }
+            gas = self.before_vault_operation(tx_data=withdraw_tx_data, token_address=token_address,
+                                              superform_id=calculate_withdraw['in']['superFormId'],
+                                              amount=amount_to_withdraw, operation_type='withdrawal',
+                                              calldata_verified=True)
+            if gas is None:
+                logger.error('Could not make prepare for withdrawal')
+                return False
 
-        calculate_withdraw = self.superform_api.calculate_user_withdrawal(params)
-        withdraw_tx_data = self.superform_api.start_withdrawal(calculate_withdraw)
+            tx_hash = send_tx_with_data(to=withdraw_tx_data['to'], w3=self.w3, explorer=self.explorer,
+                                        account=self.account, eip1559=self.eip1559_support, data=withdraw_tx_data['data'],
+                                        value=int(withdraw_tx_data['value']), gas=gas,
+                                        vault=vault_id)
 
-        if not self.before_vault_operation(tx_data=withdraw_tx_data, token_address=token_address,
-                                           superform_id=calculate_withdraw['in']['superFormId'],
-                                           amount=amount_to_withdraw, operation_type='withdrawal'):
-            logger.error('Could not make prepare for withdrawal')
+            if check_tx_status(w3=self.w3, tx_hash=tx_hash):
+                logger.success('Withdrew')
+                return True
             return False
 
-        tx_hash = send_tx_with_data(to=withdraw_tx_data['to'], w3=self.w3, explorer=self.explorer, account=self.account,
-                                    eip1559=self.eip1559_support, data=withdraw_tx_data['data'],
-                                    value=int(withdraw_tx_data['value']))
-
-        if check_tx_status(w3=self.w3, tx_hash=tx_hash):
-            logger.success('Withdrew')
-            return True
-        return False
-
     def get_portfolio(self) -> Dict[Any, Dict[str, Any]]:
         """
         :return: Account portfolio - {'Vault_id': {'usd amount': '', 'chain id': 8453, 'superposition_balance': '', 'is_erc20': False}}
@@ -249,32 +377,40 @@ class MySuperform(MyClient):
                 result.append(reward)
         return result
 
-    def claim_all_rewards(self, season: int) -> bool:
+    def claim_all_rewards(self, season: int, claimable_rewards: List = None) -> bool:
         """
         Claims all possible rewards for account in particular safari season
         :param season: (int) Safari season number
+        :param claimable_rewards: (opt) claimable rewards if already known, e.g. from claim plan
         :return: True if success, False if not
         """
-        logger.info(f'Claiming rewards for season {season}')
-
-        claimable_rewards = self.get_claimable_user_safari_rewards(season=season)
-        if len(claimable_rewards) == 0:
-            logger.info('No rewards for claim')
-            return True
-
-        params = {
-            'tournamentID': season,
-            'user': self.address,
-        }
-
-        claim_tx_data = self.superform_api.start_claim_rewards(request_data=params)
-        tx_hash = send_tx_with_data(to=claim_tx_data['to'], w3=self.w3, explorer=self.explorer, account=self.account,
-                                    eip1559=self.eip1559_support, data=claim_tx_data['transactionData'])
+        with tracer.span('claim', wallet=self.address, season=season, chain=self.chain_id):
+            logger.info(f'Claiming rewards for season {season}')
+
+            if claimable_rewards is None:
+                with tracer.span('rewards_check'):
+                    claimable_rewards = self.get_claimable_user_safari_rewards(season=season)
+            if len(claimable_rewards) == 0:
+                logger.info('No rewards for claim')
+                return True
+
+            params = {
+                'tournamentID': season,
+                'user': self.address,
+            }
+
+            with tracer.span('start'):
+                claim_tx_data = self.superform_api.start_claim_rewards(request_data=params)
+            if not log_mismatches(verify_claim_tx(claim_tx_data=claim_tx_data, user=self.address), operation='claim'):
+                return False
+            tx_hash = send_tx_with_data(to=claim_tx_data['to'], w3=self.w3, explorer=self.explorer,
+                                        account=self.account, eip1559=self.eip1559_support,
+                                        data=claim_tx_data['transactionData'])
 
-        if check_tx_status(w3=self.w3, tx_hash=tx_hash):
-            logger.success('Claimed')
-            return True
-        return False
+            if check_tx_status(w3=self.w3, tx_hash=tx_hash):
+                logger.success('Claimed')
+                return True
+            return False
 
     def get_rewards(self) -> Dict[Any, Dict[str, Any]]:
         """
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import threading
+import numpy as np
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, List, Tuple
+
+from modules.superform_api import SuperFormApi
+from modules.rebalancer import Rebalancer
+from config import vault_history_dir, vault_history_capacity, vault_history_interval
+
+"""
+VAULT HISTORY
+One append-only file per metric, every row is one snapshot with fixed number of vault columns (capacity),
+vaults without value are NaN. Timestamps file is written last and defines how many rows are complete.
+Reads are memory-mapped, only rows of the requested time range are touched
+"""
+
+METRICS = {'apy': np.float32, 'tvl': np.float64}
+DAY = 24 * 60 * 60
+
+
+class VaultHistoryStore:
+    def __init__(self, path: str = vault_history_dir, capacity: int = vault_history_capacity):
+        """
+        :param path: directory of the store
+        :param capacity: max number of vaults, fixed when store is created
+        """
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        meta_file = self.path / 'meta.json'
+        if meta_file.exists():
+            meta = json.loads(meta_file.read_text())
+        else:
+            meta = {'capacity': capacity, 'vaults': []}
+        self.capacity = meta['capacity']
+        self.vault_ids: List[str] = meta['vaults']
+        self._columns = {vault_id: i for i, vault_id in enumerate(self.vault_ids)}
+        self._lock = threading.Lock()
+        self._save_meta()
+
+    def _file(self, name: str) -> Path:
+        return self.path / f'{name}.bin'
+
+    def _save_meta(self):
+        tmp_file = self.path / 'meta.json.tmp'
+        tmp_file.write_text(json.dumps({'capacity': self.capacity, 'vaults': self.vault_ids}))
+        os.replace(tmp_file, self.path / 'meta.json')
+
+    def _column(self, vault_id: str) -> int | None:
+        """
+        :return: column of the vault, new vaults get next free column, None if store is full
+        """
+        if vault_id not in self._columns:
+            if len(self.vault_ids) >= self.capacity:
+                return None
+            self._columns[vault_id] = len(self.vault_ids)
+            self.vault_ids.append(vault_id)
+        return self._columns[vault_id]
+
+    def rows(self) -> int:
+        """
+        :return: number of complete snapshots
+        """
+        timestamps_file = self._file('timestamps')
+        return timestamps_file.stat().st_size // 8 if timestamps_file.exists() else 0
+
+    def append(self, timestamp: int, values: Dict[str, np.ndarray], vault_ids: np.ndarray):
+        """
+        Appends one snapshot
+        :param timestamp: unix time of snapshot, has to be bigger than the last one
+        :param values: Dict - {metric: array of values in order of vault_ids}
+        :param vault_ids: vault ids of values
+        """
+        with self._lock:
+            rows = self.rows()
+            if rows:
+                last = np.memmap(self._file('timestamps'), dtype=np.int64, mode='r', shape=(rows,))[-1]
+                if timestamp <= last:
+                    raise ValueError(f'snapshot {timestamp} is not newer than the last one {last}')
+
+            known = len(self.vault_ids)
+            columns = [self._column(str(vault_id)) for vault_id in vault_ids]
+            stored = np.array([column is not None for column in columns], dtype=bool)
+            if not stored.all():
+                logger.warning(f'Vault history is full, {int((~stored).sum())} vaults are not stored')
+            if len(self.vault_ids) != known:
+                self._save_meta()
+
+            columns = np.array([column for column in columns if column is not None], dtype=np.int64)
+            for metric, dtype in METRICS.items():
+                row = np.full(self.capacity, np.nan, dtype=dtype)
+                row[columns] = np.asarray(values[metric], dtype=dtype)[stored]
+                # rows left by interrupted append are cut before writing the new one
+                with self._file(metric).open('r+b' if self._file(metric).exists() else 'wb') as file:
+                    file.truncate(rows * row.nbytes)
+                    file.seek(rows * row.nbytes)
+                    file.write(row.tobytes())
+            with self._file('timestamps').open('ab') as file:
+                file.write(np.int64(timestamp).tobytes())
+
+    """
+    QUERIES
+    """
+
+    def window(self, metric: str, start: int = None, end: int = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        :param metric: one of METRICS
+        :param start: (opt) unix time, inclusive
+        :param end: (opt) unix time, exclusive
+        :return: (timestamps, values snapshots x vaults), values are memory-mapped and read only
+        """
+        rows = self.rows()
+        if not rows:
+            return np.empty(0, dtype=np.int64), np.empty((0, len(self.vault_ids)), dtype=METRICS[metric])
+        timestamps = np.memmap(self._file('timestamps'), dtype=np.int64, mode='r', shape=(rows,))
+        first = 0 if start is None else int(np.searchsorted(timestamps, start, side='left'))
+        last = rows if end is None else int(np.searchsorted(timestamps, end, side='left'))
+        values = np.memmap(self._file(metric), dtype=METRICS[metric], mode='r', shape=(rows, self.capacity))
+        return np.asarray(timestamps[first:last]), values[first:last, :len(self.vault_ids)]
+
+    def _by_vault(self, result: np.ndarray) -> Dict[str, float]:
+        return {vault_id: float(value) for vault_id, value in zip(self.vault_ids, result) if not np.isnan(value)}
+
+    def mean(self, metric: str, days: float = 7, now: int = None) -> Dict[str, float]:
+        """
+        :return: Dict - {vault id: mean of metric over last days}, e.g. 7-day mean apy
+        """
+        now = int(time.time()) if now is None else now
+        _, values = self.window(metric, start=now - int(days * DAY))
+        if not len(values):
+            return {}
+        with np.errstate(invalid='ignore'):
+            counts = np.count_nonzero(~np.isnan(values), axis=0)
+            sums = np.nansum(values, axis=0, dtype=np.float64)
+            return self._by_vault(np.where(counts > 0, sums / np.maximum(counts, 1), np.nan))
+
+    def drawdown(self, metric: str = 'tvl', days: float = 7, now: int = None) -> Dict[str, float]:
+        """
+        :return: Dict - {vault id: max drop from running peak over last days, 0.25 = -25%}
+        """
+        now = int(time.time()) if now is None else now
+        _, values = self.window(metric, start=now - int(days * DAY))
+        if not len(values):
+            return {}
+        values = np.asarray(values, dtype=np.float64)
+        # NaN does not reset the peak
+        peaks = np.fmax.accumulate(values, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            drops = np.where(peaks > 0, 1 - values / peaks, -np.inf)
+        result = np.nan_to_num(drops, nan=-np.inf).max(axis=0)
+        return self._by_vault(np.where(np.isinf(result), np.nan, result))
+
+
+class VaultStatsCollector:
+    def __init__(self, store: VaultHistoryStore = None, api: SuperFormApi = None,
+                 interval: int = vault_history_interval):
+        """
+        Snapshots get_all_vaults_stats into VaultHistoryStore on schedule
+        :param interval: seconds between snapshots
+        """
+        self.store = store if store else VaultHistoryStore()
+        self.api = api if api else SuperFormApi()
+        self.interval = interval
+
+    def collect_once(self) -> int:
+        """
+        :return: number of vaults in snapshot
+        """
+        # stats are decoded one by one while downloaded, full response is never in memory
+        vaults = Rebalancer.vault_arrays(self.api.iter_all_vaults_stats())
+        self.store.append(int(time.time()), {metric: vaults[metric] for metric in METRICS}, vaults['vault_id'])
+        return len(vaults['vault_id'])
+
+    def run(self):
+        """
+        Collects snapshots forever, next snapshot is scheduled from the start of the previous one
+        """
+        logger.info(f'Collecting vault stats every {self.interval} seconds to {self.store.path}')
+        while True:
+            started = time.monotonic()
+            try:
+                logger.info(f'Vault stats snapshot {self.store.rows()}: {self.collect_once()} vaults')
+            except Exception as err:
+                logger.error(f'Vault stats snapshot failed - {type(err).__name__}: {err}')
+            time.sleep(max(0., self.interval - (time.monotonic() - started)))
@@ -0,0 +1,27 @@
+import gzip
+import json
+
+import requests
+
+from modules.superform_api import SuperFormApi
+from utils.cassette import Cassette, CassetteAdapter, request_keys
+
+
+def _write_cassette(path, uri, body):
+    request = requests.Request('GET', uri).prepare()
+    exact, loose = request_keys(request)
+    with gzip.open(path, 'wt') as file:
+        file.write(json.dumps({'key': exact, 'loose_key': loose, 'status': 200, 'reason': 'OK',
+                               'headers': {'content-type': 'application/json'}, 'elapsed': 0.1,
+                               'text': json.dumps(body)}) + '\n')
+
+
+def test_replay_streamed_endpoint(tmp_path):
+    stats = [{'vault_id': f'vault-{i}', 'chain_id': 8453, 'apy': 3.5 + i} for i in range(3)]
+    api = SuperFormApi()
+    path = tmp_path / 'cassette.jsonl.gz'
+    _write_cassette(path, api._create_api_uri('stats/vault/superformStat'), stats)
+    api.session.mount('https://', CassetteAdapter(Cassette(str(path), 'replay')))
+
+    assert list(api.iter_all_vaults_stats(fields=('vault_id', 'apy'))) == \
+        [{'vault_id': stat['vault_id'], 'apy': stat['apy']} for stat in stats]
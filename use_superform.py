@@ -1,21 +1,35 @@
-import time
+import json
 import random
 
+from pathlib import Path
+
 from loguru import logger
 
-from config import sleeping_time, log_file, keys_file, morpho_well_eth_vault_id, eth_address, minimum_balance_left
+from config import sleeping_time, log_file, metrics_file, keys_file, morpho_well_eth_vault_id, eth_address, minimum_balance_left, \
+    superform_router_address, scan_network_ids, scan_tokens, scan_superform_ids, scan_report_file
 from modules.superform_sdk import MySuperform
-from utils.helpful_scripts import load_accounts_from_keys, load_logger, catch_errors
+from modules.claim_planner import build_claim_plan
+from modules.position_watcher import PositionWatcher
+from modules.multichain_scanner import MultiChainScanner
+from modules.deposit_pipeline import DepositPipeline
+from modules.rebalancer import Rebalancer, estimate_gas_costs
+from modules.vault_history import VaultStatsCollector
+from modules.superform_api import SuperFormApi
+from utils.helpful_scripts import load_accounts_from_keys, load_logger, catch_errors, get_network_by_chain_id, \
+    scan_allowances, UNLIMITED_ALLOWANCE
 from utils.constants import BreakTimer
+from utils.metrics import metrics
+from utils.retry_scheduler import RetryScheduler
+from utils.rpc_pool import provider_pool
 
 
-@catch_errors(sleeping_time)
-def claim_rewards(account, season):
+@catch_errors
+def claim_rewards(account, season, claimable_rewards=None):
     super_bot = MySuperform(account=account)
-    return super_bot.claim_all_rewards(season)
+    return super_bot.claim_all_rewards(season, claimable_rewards=claimable_rewards)
 
 
-@catch_errors(sleeping_time)
+@catch_errors
 def get_portfolio(account):
     super_bot = MySuperform(account=account)
     normalized_balance = super_bot.get_normalize_amount(super_bot.native_balance, 18)
@@ -23,7 +37,7 @@ def get_portfolio(account):
     logger.info(super_bot.get_portfolio())
 
 
-@catch_errors(sleeping_time)
+@catch_errors
 def deposit(account, vault_id, token_address=eth_address):
     super_bot = MySuperform(account=account)
 
@@ -49,43 +63,183 @@ def deposit(account, vault_id, token_address=eth_address):
     return super_bot.deposit_single_vault(vault_id=vault_id, amount=amount, token_address=token_address)
 
 
-@catch_errors(sleeping_time)
+@catch_errors
 def withdraw(account, vault_id, token_address=eth_address):
     super_bot = MySuperform(account=account)
     return super_bot.withdraw_single_vault(vault_id=vault_id, withdraw_percent=100, token_address=token_address)
 
 
+# inner functions are called undecorated, so RetryScheduler, which unwraps catch_errors, sees their errors
+@catch_errors
 def deposit_to_morpho(account, token_address=eth_address):
-    return deposit(account, morpho_well_eth_vault_id, token_address=token_address)
+    return deposit.__wrapped__(account, morpho_well_eth_vault_id, token_address=token_address)
 
 
+@catch_errors
 def withdraw_from_morpho(account):
-    return withdraw(account, morpho_well_eth_vault_id)
+    return withdraw.__wrapped__(account, morpho_well_eth_vault_id)
+
+
+def scan_approvals(accounts, token_address, network_id: int = 3):
+    """
+    Checks allowances of all wallets to superform router in bulk, later approve checks are answered from cache
+    :return: list of wallet addresses that will need approval
+    """
+    w3 = provider_pool.get_web3(random.choice(get_network_by_chain_id(network_id).rpc))
+    allowances = scan_allowances(w3=w3, owners=[account.address for account in accounts],
+                                 token_address=token_address, spender=superform_router_address)
+    need_approval = [owner for owner, allowance in allowances.items() if allowance < UNLIMITED_ALLOWANCE]
+    logger.info(f'{len(need_approval)} of {len(accounts)} wallets need approval of {token_address}')
+    return need_approval
 
 
 def use_script():
+    load_logger(log_file)
     accounts = load_accounts_from_keys(keys_file)
     total_account = len(accounts)
     logger.info(f"Loaded for {total_account} accounts")
 
     random.shuffle(accounts)
+    scheduler = RetryScheduler()
+    # wallets are paced by scheduled start time, failed wallets are retried while next wallets keep running
+    start_delay = 0
     for account in accounts:
-        # while True:
-        # account = accounts[random.randint(0, len(accounts) - 1)]
-
-        load_logger(log_file)
-        logger.info(f'Started for wallet {account.address}')
-        random_sleep = random.randint(*sleeping_time['default'])
-
         # todo uncomment necessary script the script
-        claim_rewards(account=account, season=3)
-        # withdraw_from_morpho(account=account)
-        # deposit_to_morpho(account=account)
-        # get_portfolio(account=account)
-
-        logger.info(f"Sleeping for {random_sleep} seconds")
-        time.sleep(random_sleep)
+        context = {'wallet': account.address}
+        scheduler.submit(claim_rewards, account=account, season=3, delay=start_delay, context=context)
+        # scheduler.submit(withdraw_from_morpho, account=account, delay=start_delay, context=context)
+        # scheduler.submit(deposit_to_morpho, account=account, delay=start_delay, context=context)
+        # scheduler.submit(get_portfolio, account=account, delay=start_delay, context=context)
+        start_delay += random.randint(*sleeping_time['default'])
+
+    logger.info(f'Scheduled {total_account} wallets over {start_delay} seconds')
+    logger.info(f'Finished: {scheduler.run()}')
+    logger.info(f'Metrics summary: {metrics.dump(metrics_file)}')
+    logger.complete()
+
+
+def use_claim_script(seasons):
+    """
+    Checks rewards of all wallets first and builds clients only for wallets that have something to claim
+    :param seasons: list of safari seasons
+    """
+    load_logger(log_file)
+    accounts = {account.address: account for account in load_accounts_from_keys(keys_file)}
+    logger.info(f"Loaded for {len(accounts)} accounts")
+
+    plan = build_claim_plan(list(accounts), seasons)
+    plan.save()
+    logger.info(f'Claim plan: {plan.summary()}')
+
+    scheduler = RetryScheduler()
+    start_delay = 0
+    for address, season, rewards in plan.items():
+        scheduler.submit(claim_rewards, account=accounts[address], season=season, claimable_rewards=rewards,
+                         delay=start_delay, context={'wallet': address})
+        start_delay += random.randint(*sleeping_time['default'])
+
+    logger.info(f'Finished: {scheduler.run()}')
+    logger.info(f'Metrics summary: {metrics.dump(metrics_file)}')
+    logger.complete()
+
+
+def use_watch_script(network_id: int = 3):
+    """
+    Watches SuperPositions and reward events of our wallets and refreshes portfolio only for affected wallets
+    :param network_id: number according to get_network_by_chain_id
+    """
+    load_logger(log_file)
+    accounts = {account.address: account for account in load_accounts_from_keys(keys_file)}
+    w3 = provider_pool.get_web3(random.choice(get_network_by_chain_id(network_id).rpc))
+
+    def on_change(wallet, events):
+        with logger.contextualize(wallet=wallet):
+            logger.info(f"Wallet {wallet} changed: {[(event['event'], event['tx_hash']) for event in events]}")
+            get_portfolio(account=accounts[wallet])
+
+    PositionWatcher(w3=w3, wallets=accounts, on_change=on_change).run()
+
+
+def superform_ids_from_portfolios(addresses, network_ids):
+    """
+    :return: Dict - {network id: [superform ids]} of SuperPositions that wallets hold according to api
+    """
+    network_by_chain = {get_network_by_chain_id(network_id).chain_id: network_id for network_id in network_ids}
+    superform_ids = {}
+    for portfolio in Rebalancer.fetch_portfolios(addresses).values():
+        for superposition in (portfolio or {}).get('superpositions') or []:
+            superform_id = superposition.get('superform_id') or superposition['vault'].get('superform_id')
+            network_id = network_by_chain.get(superposition['chain_id'])
+            if superform_id is not None and network_id is not None:
+                superform_ids.setdefault(network_id, set()).add(int(superform_id))
+    return {network_id: sorted(ids) for network_id, ids in superform_ids.items()}
+
+
+def use_scan_script():
+    """
+    Scans native, token and SuperPositions balances of all wallets on all chains from scan_network_ids concurrently
+    """
+    load_logger(log_file)
+    addresses = [account.address for account in load_accounts_from_keys(keys_file)]
+    superform_ids = scan_superform_ids or superform_ids_from_portfolios(addresses, scan_network_ids)
+    report = MultiChainScanner(network_ids=scan_network_ids, tokens=scan_tokens,
+                               superform_ids=superform_ids).scan(addresses)
+    Path(scan_report_file).parent.mkdir(parents=True, exist_ok=True)
+    with open(scan_report_file, 'w') as file:
+        json.dump(report, file, indent=2)
+    logger.info(f"Scanned {len(addresses)} wallets, chain seconds: {report['chain_seconds']}, "
+                f"failed: {report['failed_chains']}")
+    logger.complete()
+
+
+def use_pipeline_script(vault_id=morpho_well_eth_vault_id, token_address=eth_address, dry_run=False):
+    """
+    Deposits from all wallets through plan -> simulate -> sign -> broadcast stages, plan is saved to pipeline_plan_file
+    :param dry_run: only plan and simulate, nothing is approved, signed or sent
+    """
+    load_logger(log_file)
+    accounts = load_accounts_from_keys(keys_file)
+    logger.info(f"Loaded for {len(accounts)} accounts")
+    if token_address.lower() != eth_address.lower():
+        # allowances of all wallets are cached by one multicall scan, approve checks of deposits use the cache
+        scan_approvals(accounts, token_address=token_address)
+
+    summary = DepositPipeline(accounts, vault_id=vault_id, token_address=token_address, dry_run=dry_run).run()
+    logger.info(f'Finished: {summary}')
+    logger.info(f'Metrics summary: {metrics.dump(metrics_file)}')
+    logger.complete()
+
+
+def use_rebalance_script():
+    """
+    Plans withdrawals and deposits of all wallets towards best vaults from vault stats, portfolios and gas costs.
+    Plan is saved to rebalance_plan_file, nothing is sent
+    """
+    load_logger(log_file)
+    addresses = [account.address for account in load_accounts_from_keys(keys_file)]
+    api = SuperFormApi()
+    rebalancer = Rebalancer()
+    portfolios = rebalancer.fetch_portfolios(addresses, api=api)
+    plan = rebalancer.plan(vault_stats=api.get_all_vaults_stats(),
+                           portfolios={address: portfolio for address, portfolio in portfolios.items() if portfolio},
+                           gas_costs=estimate_gas_costs(scan_network_ids))
+    logger.info(f"Rebalance plan: {plan['summary']}, saved to {rebalancer.save(plan)}")
+    logger.complete()
+
+
+def use_vault_history_script():
+    """
+    Snapshots apy and tvl of all vaults every vault_history_interval seconds to vault_history_dir
+    """
+    load_logger(log_file)
+    VaultStatsCollector().run()
 
 
 if __name__ == '__main__':
     use_script()
+    # use_claim_script(seasons=[3])
+    # use_watch_script()
+    # use_scan_script()
+    # use_pipeline_script(dry_run=True)
+    # use_rebalance_script()
+    # use_vault_history_script()
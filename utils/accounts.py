@@ -0,0 +1,127 @@
+import itertools
+
+from pathlib import Path
+from typing import Iterator, Iterable
+from concurrent.futures import ProcessPoolExecutor
+
+from hexbytes import HexBytes
+from eth_keys import keys
+from eth_account import Account
+from eth_account.signers.local import LocalAccount
+from eth_account.account import ChecksumAddress
+
+"""
+STREAMING KEY LOADING
+Keys are read line by line, addresses are derived lazily or in process pool,
+LocalAccount is created only when signing is needed
+"""
+
+
+def _normalize_key(key: str) -> str:
+    key = key.strip()
+    return key if key.startswith('0x') else '0x' + key
+
+
+def derive_address(key: str) -> ChecksumAddress:
+    """
+    Derives checksum address from private key without building LocalAccount
+    :param key: private key hex string
+    :return: ChecksumAddress
+    """
+    return keys.PrivateKey(HexBytes(_normalize_key(key))).public_key.to_checksum_address()
+
+
+class LazyAccount:
+    __slots__ = ('_key', '_address', '_account')
+
+    def __init__(self, key: str, address: ChecksumAddress = None):
+        """
+        Drop-in replacement of LocalAccount that derives address on first use
+        and builds LocalAccount only when one of its signing methods is called
+        :param key: private key hex string
+        :param address: (opt) already derived address
+        """
+        self._key = _normalize_key(key)
+        self._address = address
+        self._account = None
+
+    @property
+    def key(self) -> HexBytes:
+        return HexBytes(self._key)
+
+    @property
+    def address(self) -> ChecksumAddress:
+        if self._address is None:
+            self._address = derive_address(self._key)
+        return self._address
+
+    @property
+    def account(self) -> LocalAccount:
+        if self._account is None:
+            self._account = Account.from_key(self._key)
+            self._address = self._account.address
+        return self._account
+
+    def __getattr__(self, name):
+        # sign_transaction, sign_message, encrypt and other LocalAccount methods.
+        # private and special names are not delegated, otherwise unset slots recurse here during copy and pickle
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.account, name)
+
+    def __getstate__(self):
+        return self._key, self._address
+
+    def __setstate__(self, state):
+        self._key, self._address = state
+        self._account = None
+
+    def __repr__(self):
+        return f'LazyAccount({self._address or "<not derived>"})'
+
+
+def iter_lines(path: str) -> Iterator[str]:
+    """
+    Streams stripped non-empty lines of the file, file is closed after the last line
+    :param path: file path
+    """
+    with Path(path).open() as file:
+        for line in file:
+            line = line.strip()
+            if line:
+                yield line
+
+
+def _iter_addresses(private_keys: Iterable[str], workers: int, chunk_size: int) -> Iterator[tuple]:
+    """
+    Derives addresses in process pool, keys are sent to workers batch by batch so the file is never fully in memory
+    :return: iterator of (key, address)
+    """
+    private_keys = iter(private_keys)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while True:
+            batch = list(itertools.islice(private_keys, workers * chunk_size))
+            if not batch:
+                return
+            yield from zip(batch, pool.map(derive_address, batch, chunksize=chunk_size))
+
+
+def iter_accounts_from_keys(path: str, workers: int = 0, chunk_size: int = 256, address_only: bool = False) \
+        -> Iterator[LazyAccount | ChecksumAddress]:
+    """
+    Streams accounts from keys file
+    :param path: keys file, one private key per line
+    :param workers: number of processes to derive addresses in, 0 - derive lazily on first access
+    :param chunk_size: keys per worker task
+    :param address_only: yield only addresses, for read-only jobs
+    :return: iterator of LazyAccount or ChecksumAddress if address_only
+    """
+    private_keys = iter_lines(path)
+
+    if workers:
+        for key, address in _iter_addresses(private_keys, workers=workers, chunk_size=chunk_size):
+            yield address if address_only else LazyAccount(key, address=address)
+        return
+
+    for key in private_keys:
+        yield derive_address(key) if address_only else LazyAccount(key)
@@ -0,0 +1,50 @@
+import threading
+
+from typing import Dict, Tuple
+
+from web3 import Web3
+from hexbytes import HexBytes
+
+"""
+ALLOWANCE CACHE
+Known erc20 allowances per (chain, owner, token, spender), filled by bulk multicall scan and by
+Approval events from receipts of our own transactions
+"""
+
+APPROVAL_TOPIC = Web3.keccak(text='Approval(address,address,uint256)').hex()
+
+
+class AllowanceCache:
+    def __init__(self):
+        self._allowances: Dict[Tuple[int, str, str, str], int] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(chain_id: int, owner: str, token: str, spender: str) -> Tuple[int, str, str, str]:
+        return chain_id, owner.lower(), token.lower(), spender.lower()
+
+    def get(self, chain_id: int, owner: str, token: str, spender: str) -> int | None:
+        """
+        :return: cached allowance, None if it is unknown
+        """
+        with self._lock:
+            return self._allowances.get(self._key(chain_id, owner, token, spender))
+
+    def set(self, chain_id: int, owner: str, token: str, spender: str, amount: int):
+        with self._lock:
+            self._allowances[self._key(chain_id, owner, token, spender)] = amount
+
+    def observe_receipt(self, chain_id: int, receipt: Dict):
+        """
+        Updates cache from Approval events of transaction receipt
+        """
+        for log in receipt.get('logs', []):
+            topics = log['topics']
+            if len(topics) != 3 or HexBytes(topics[0]).hex() != APPROVAL_TOPIC:
+                continue
+            owner = '0x' + HexBytes(topics[1]).hex()[-40:]
+            spender = '0x' + HexBytes(topics[2]).hex()[-40:]
+            self.set(chain_id, owner, log['address'], spender, int.from_bytes(HexBytes(log['data']), 'big'))
+
+
+allowance_cache = AllowanceCache()
@@ -0,0 +1,220 @@
+import io
+import gzip
+import json
+import time
+import atexit
+import base64
+import datetime
+import threading
+import collections
+
+from pathlib import Path
+from typing import Dict, Tuple
+from urllib.parse import urlsplit, parse_qsl, urlencode
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+from config import cassette_mode, cassette_file, cassette_speed
+from utils.metrics import get_path_template
+
+"""
+RECORD / REPLAY OF HTTP TRAFFIC
+Superform api and json-rpc calls are recorded into gzipped json lines cassette and could be replayed offline
+through the same code paths. Set cassette_mode in config to 'record' or 'replay'.
+Streamed responses are read whole while recording and replayed from memory
+"""
+
+# query parameters that change on every run and should not be part of request key
+_volatile_params = ('force',)
+_kept_headers = ('content-type', 'etag', 'last-modified', 'retry-after')
+
+
+def _rpc_payload(request: requests.PreparedRequest):
+    """
+    :return: decoded json-rpc payload (dict or list for batch) or None if request is not json-rpc
+    """
+    if request.method != 'POST' or not request.body:
+        return None
+    try:
+        payload = json.loads(request.body)
+    except (ValueError, TypeError):
+        return None
+    first = payload[0] if isinstance(payload, list) and payload else payload
+    if isinstance(first, dict) and 'jsonrpc' in first:
+        return payload
+    return None
+
+
+def _strip_rpc_ids(payload):
+    if isinstance(payload, list):
+        return [_strip_rpc_ids(item) for item in payload]
+    return {key: value for key, value in payload.items() if key != 'id'}
+
+
+def request_keys(request: requests.PreparedRequest) -> Tuple[str, str]:
+    """
+    Builds exact and loose keys of request.
+    Exact key matches the same request, loose key - any request to the same endpoint / rpc method
+    :return: (exact key, loose key)
+    """
+    rpc_payload = _rpc_payload(request)
+    if rpc_payload is not None:
+        # rpc host is chosen randomly from network list, so it is not part of the key
+        methods = [item['method'] for item in rpc_payload] if isinstance(rpc_payload, list) else [rpc_payload['method']]
+        return 'rpc ' + json.dumps(_strip_rpc_ids(rpc_payload), sort_keys=True), 'rpc ' + ','.join(methods)
+
+    url = urlsplit(request.url)
+    query = urlencode([(key, value) for key, value in parse_qsl(url.query) if key not in _volatile_params])
+    body = request.body.decode() if isinstance(request.body, bytes) else (request.body or '')
+    exact = f'{request.method} {url.path}?{query} {body}'
+    loose = f'{request.method} {get_path_template(request.url)}'
+    return exact, loose
+
+
+def _restore_rpc_ids(content: bytes, request: requests.PreparedRequest) -> bytes:
+    """
+    Replaces ids in recorded json-rpc response with ids of the current request
+    """
+    payload = _rpc_payload(request)
+    response = json.loads(content)
+    if isinstance(payload, list):
+        for item, request_item in zip(response, payload):
+            item['id'] = request_item.get('id')
+    else:
+        response['id'] = payload.get('id')
+    return json.dumps(response).encode()
+
+
+class Cassette:
+    def __init__(self, path: str, mode: str, speed: float = 0):
+        """
+        :param path: path of cassette file (.jsonl.gz)
+        :param mode: 'record' or 'replay'
+        :param speed: replay speed multiplier for recorded latency, e.g. 1 or 10. 0 - as fast as possible
+        """
+        if mode not in ('record', 'replay'):
+            raise ValueError(f'Unknown cassette mode {mode}')
+        self.path = Path(path)
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._file = None
+        self._exact: Dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        self._loose: Dict[str, collections.deque] = collections.defaultdict(collections.deque)
+        if mode == 'replay':
+            self._load()
+
+    def _load(self):
+        with gzip.open(self.path, 'rt') as file:
+            for line in file:
+                interaction = json.loads(line)
+                # same interaction object is shared by both indexes, 'used' flag prevents double replay
+                interaction['used'] = False
+                self._exact[interaction['key']].append(interaction)
+                self._loose[interaction['loose_key']].append(interaction)
+
+    def record(self, request: requests.PreparedRequest, response: requests.Response, elapsed: float):
+        """
+        :param elapsed: seconds the request took, response.elapsed is not set yet inside transport adapter
+        """
+        exact, loose = request_keys(request)
+        content = response.content
+        try:
+            body = {'text': content.decode()}
+        except UnicodeDecodeError:
+            body = {'b64': base64.b64encode(content).decode()}
+        line = json.dumps({
+            'key': exact,
+            'loose_key': loose,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': {key: value for key, value in response.headers.items() if key.lower() in _kept_headers},
+            'elapsed': elapsed,
+            **body,
+        })
+        with self._lock:
+            if self._file is None:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._file = gzip.open(self.path, 'at')
+                atexit.register(self.close)
+            self._file.write(line + '\n')
+
+    def _pop(self, index: Dict[str, collections.deque], key: str):
+        queue = index.get(key)
+        while queue:
+            interaction = queue.popleft()
+            if not interaction['used']:
+                interaction['used'] = True
+                return interaction
+        return None
+
+    def replay(self, request: requests.PreparedRequest) -> requests.Response:
+        exact, loose = request_keys(request)
+        with self._lock:
+            interaction = self._pop(self._exact, exact) or self._pop(self._loose, loose)
+        if interaction is None:
+            raise requests.exceptions.ConnectionError(f'Cassette {self.path} has no response for {exact[:200]}',
+                                                      request=request)
+        if self.speed:
+            time.sleep(interaction['elapsed'] / self.speed)
+
+        content = interaction['text'].encode() if 'text' in interaction else base64.b64decode(interaction['b64'])
+        if interaction['key'].startswith('rpc '):
+            content = _restore_rpc_ids(content, request)
+
+        response = requests.Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response._content = content
+        # streamed responses read raw body in iter_content and close it
+        response.raw = io.BytesIO(content)
+        response.encoding = 'utf-8'
+        response.url = request.url
+        response.request = request
+        response.elapsed = datetime.timedelta(seconds=interaction['elapsed'])
+        return response
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class CassetteAdapter(HTTPAdapter):
+    def __init__(self, cassette: Cassette, **kwargs):
+        """
+        Transport adapter that records real responses or serves them from cassette
+        :param cassette: Cassette instance
+        """
+        super().__init__(**kwargs)
+        self.cassette = cassette
+
+    def send(self, request, **kwargs):
+        if self.cassette.mode == 'replay':
+            return self.cassette.replay(request)
+        start = time.perf_counter()
+        response = super().send(request, **kwargs)
+        self.cassette.record(request, response, elapsed=time.perf_counter() - start)
+        return response
+
+
+cassette = Cassette(cassette_file, cassette_mode, cassette_speed) if cassette_mode else None
+
+
+def install_cassette(session: requests.Session):
+    """
+    Mounts cassette adapter to session if cassette mode is enabled in config
+    :param session: requests.Session of api client or web3 provider
+    """
+    current = session.get_adapter('https://')
+    if cassette is None or isinstance(current, CassetteAdapter):
+        return
+    # keep connection pool settings of the adapter that is replaced
+    adapter = CassetteAdapter(cassette, pool_connections=current._pool_connections,
+                              pool_maxsize=current._pool_maxsize, pool_block=current._pool_block)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
@@ -0,0 +1,93 @@
+import json
+import threading
+
+from pathlib import Path
+from loguru import logger
+from typing import Dict, Tuple
+
+from config import gas_profiles_file, gas_profile_quantile, gas_profile_margin, gas_profile_min_samples
+
+"""
+GAS LIMIT PROFILES
+Gas used by our transactions is learned from receipts per (chain, to, selector, vault).
+When profile has enough samples, gas limit is taken from it instead of eth_estimateGas
+"""
+
+MAX_SAMPLES = 50
+# reverted tx that used this part of its gas limit is treated as out of gas
+OUT_OF_GAS_RATIO = 0.97
+
+
+class GasProfileStore:
+    def __init__(self, path: str = gas_profiles_file, quantile: float = gas_profile_quantile,
+                 margin: float = gas_profile_margin, min_samples: int = gas_profile_min_samples):
+        """
+        :param path: json file with profiles, '' to keep them in memory only
+        :param quantile: quantile of gas used samples taken as a base of gas limit
+        :param margin: multiplier added on top of quantile
+        :param min_samples: samples needed before profile is used instead of estimation
+        """
+        self.path = Path(path) if path else None
+        self.quantile = quantile
+        self.margin = margin
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self._pending: Dict[str, Tuple[str, int]] = {}
+        self.profiles: Dict[str, list] = {}
+        if self.path and self.path.exists():
+            self.profiles = json.load(self.path.open())
+
+    @staticmethod
+    def key(chain_id: int, to: str, data: str, vault: str = '') -> str:
+        """
+        :return: profile key - chain:to:selector:vault
+        """
+        selector = data[:10] if data else '0x'
+        return f'{chain_id}:{to.lower()}:{selector}:{vault}'
+
+    def gas_limit(self, key: str) -> int:
+        """
+        :return: gas limit from profile, 0 if profile does not have enough samples yet
+        """
+        with self._lock:
+            samples = sorted(self.profiles.get(key, []))
+        if len(samples) < self.min_samples:
+            return 0
+        return int(samples[min(len(samples) - 1, int(len(samples) * self.quantile))] * self.margin)
+
+    def track(self, tx_hash: str, key: str, gas_limit: int):
+        """
+        Remembers sent transaction to learn from its receipt later
+        """
+        with self._lock:
+            self._pending[tx_hash] = (key, gas_limit)
+
+    def observe(self, tx_hash: str, receipt: Dict):
+        """
+        Learns gas used from receipt of tracked transaction, profile is dropped if transaction ran out of gas
+        """
+        with self._lock:
+            if tx_hash not in self._pending:
+                return
+            key, gas_limit = self._pending.pop(tx_hash)
+            gas_used = receipt['gasUsed']
+            if receipt['status'] == 1:
+                self.profiles[key] = (self.profiles.get(key, []) + [gas_used])[-MAX_SAMPLES:]
+            elif gas_used >= gas_limit * OUT_OF_GAS_RATIO:
+                logger.warning(f'Tx probably ran out of gas ({gas_used}/{gas_limit}), gas profile {key} is reset')
+                self.profiles.pop(key, None)
+            else:
+                return
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = self.path.with_suffix('.tmp')
+        with temp_path.open('w') as file:
+            json.dump(self.profiles, file)
+        temp_path.replace(self.path)
+
+
+gas_profiles = GasProfileStore()
@@ -4,6 +4,7 @@ import time
 import requests
 import functools
 import datetime
+import threading
 
 from sys import stderr
 from loguru import logger
@@ -17,13 +18,25 @@ from eth_account.signers.local import LocalAccount
 from eth_account.account import ChecksumAddress
 
 from utils.constants import MAX_APPROVAL_INT
-from config import tg_token, tg_chat_id, script_name
+from utils.tracing import tracer
+from utils.accounts import LazyAccount, iter_accounts_from_keys, iter_lines
+from utils.keystore import KeystoreReader, is_keystore
+from utils.log_pipeline import BackgroundSink, StreamWriter, DailyFileWriter
+from utils.notifier import notifier
+from utils.price_oracle import price_oracle
+from utils.gas_profiles import gas_profiles
+from utils.allowances import allowance_cache
+from config import script_name, key_loader_workers, log_json, log_compression, eth_address, multicall3_address
 from utils.networks import *
 
 abi_files = {
     'erc20': 'files/abis/erc20.json',
+    'multicall3': 'files/abis/multicall3.json',
 }
 
+# allowance above this value is treated as unlimited, such allowances are not lowered by spending
+UNLIMITED_ALLOWANCE = MAX_APPROVAL_INT // 2
+
 
 """
 THE LIST OF HELPFUL FUNCTIONS
@@ -31,32 +44,63 @@ NOT ALL OF THEM USED IN EVERY PROJECT
 """
 
 
-def load_logger(file_log):
+_logger_settings = None
+
+
+def load_logger(file_log, json_logs: bool = log_json):
+    """
+    Configures logging once per process, repeated calls with the same settings do nothing.
+    Sinks write through background queue in batches, file is rotated daily and compressed.
+    Bind wallet and vault with logger.contextualize(wallet=..., vault=...)
+    :param file_log: log file prefix, date is added to the name
+    :param json_logs: write file as json lines with extra fields instead of text
+    """
+    global _logger_settings
+    if _logger_settings == (file_log, json_logs):
+        return
+    _logger_settings = (file_log, json_logs)
+
     # LOGGING SETTING
     logger.remove()
-    logger.add(stderr, format="<white>{time:HH:mm:ss}</white> | <level>{level: <8}</level> | <cyan>{line}</cyan> - "
-                              "<white>{message}</white>")
-    logger.add(file_log + f"{datetime.datetime.now().strftime('%Y%m%d')}.log",
-               format="<white>{time:HH:mm:ss}</white> | <level>{level: <8}</level> | <cyan>{line}</cyan> - <white>{"
-                      "message}</white>")
+    logger.configure(extra={'wallet': '', 'vault': ''})
+    logger.add(BackgroundSink(StreamWriter(stderr)), colorize=True,
+               format="<white>{time:HH:mm:ss}</white> | <level>{level: <8}</level> | <cyan>{line}</cyan> - "
+                      "<white>{message}</white>")
+    logger.add(BackgroundSink(DailyFileWriter(file_log, json_lines=json_logs, compression=log_compression)),
+               colorize=False, format="{time:HH:mm:ss} | {level: <8} | {line} | {extra[wallet]} {extra[vault]} - "
+                                      "{message}")
+
+
+@functools.lru_cache(maxsize=None)
+def load_abi(name: str) -> List[Dict]:
+    """
+    :param name: key of abi_files
+    :return: contract abi, file is read once per process
+    """
+    return json.load(Path(abi_files[name]).open())
+
+
+_chain_ids: Dict[str, int] = {}
+
+
+def get_chain_id(w3: Web3) -> int:
+    """
+    :return: chain id of w3, requested once per rpc
+    """
+    endpoint = getattr(w3.provider, 'endpoint_uri', None) or str(id(w3.provider))
+    if endpoint not in _chain_ids:
+        _chain_ids[endpoint] = w3.eth.chain_id
+    return _chain_ids[endpoint]
 
 
 def get_token_price(token_name: str, vs_currency: str = 'usd') -> float:
-    time.sleep(10)
-    url = 'https://api.coingecko.com/api/v3/simple/price'
-    params = {'ids': f'{token_name}', 'vs_currencies': f'{vs_currency}'}
-    session = requests.Session()
-    with session.get(url, params=params) as response:
-        if response.status_code == 200:
-            try:
-                data = response.json()
-                return float(data[token_name][vs_currency])
-            except:
-                raise AttributeError('no such currency on coingecko')
-        elif response.status_code == 429:
-            logger.error('Coingecko API RateLimit')
-            time.sleep(30)
-            raise requests.exceptions.ConnectionError(f'Bad request to CoinGecko API: {response.status_code}')
+    """
+    Cached price from PriceOracle, all requested tokens are fetched in one request per price_ttl
+    """
+    price = price_oracle.get_price(token_name, vs_currency)
+    if price is None:
+        raise AttributeError('no such currency on coingecko')
+    return price
 
 
 def get_balance(wallet: ChecksumAddress, symbol: str, w3: Web3, token_address: ChecksumAddress = None) -> int:
@@ -65,7 +109,7 @@ def get_balance(wallet: ChecksumAddress, symbol: str, w3: Web3, token_address: C
             logger.error("wrong input")
             raise ValueError
 
-        erc20_contract = w3.eth.contract(token_address, abi=json.load(Path(abi_files['erc20']).open()))
+        erc20_contract = w3.eth.contract(token_address, abi=load_abi('erc20'))
         try:
             balance = erc20_contract.functions.balanceOf(wallet).call()
         except BadFunctionCallOutput:
@@ -82,7 +126,8 @@ def get_native(wallet: ChecksumAddress, w3: Web3) -> int:
 
 
 def check_tx_status(w3: Web3, tx_hash):
-    tx_status = get_tx_status(w3=w3, tx_hash=tx_hash)
+    with tracer.span('confirm', tx_hash=tx_hash.hex()):
+        tx_status = get_tx_status(w3=w3, tx_hash=tx_hash)
     if tx_status != 1:
         return False
     return True
@@ -95,16 +140,21 @@ def get_tx_status(w3: Web3, tx_hash) -> int:
     while not status_:
         try:
             status_ = w3.eth.get_transaction_receipt(tx_hash)
-        except:
+        except Exception:
             logger.info('Still trying to get tx status')
             tries += 1
             time.sleep(150)
             if tries == 2:
-                status_["status"] = 1
+                # receipt is unknown, nothing to learn gas or allowance from
                 logger.info('Probably success, but not sure')
+                return 1
 
     status = status_["status"]
     logger.info(f"Tx status: {status}")
+    if 'gasUsed' in status_:
+        gas_profiles.observe(tx_hash.hex(), status_)
+        if status == 1:
+            allowance_cache.observe_receipt(get_chain_id(w3), status_)
 
     if status not in [0, 1]:
         raise Exception("could not obtain tx status in 60 seconds")
@@ -157,15 +207,44 @@ def _create_transaction_params(account: LocalAccount, w3: Web3, eip1559: bool, g
     return tx_params
 
 
+# hashes of transactions the current thread tried to send, RetryScheduler does not retry tasks that sent anything
+_sent_txs = threading.local()
+
+
+def sent_tx_hashes() -> List[str]:
+    """
+    :return: hashes of transactions passed to send_raw_transaction by the current thread since last clear()
+    """
+    if not hasattr(_sent_txs, 'hashes'):
+        _sent_txs.hashes = []
+    return _sent_txs.hashes
+
+
+def _send_raw(w3: Web3, signed_tx):
+    # recorded before sending, rpc error or timeout does not mean that transaction was not accepted
+    sent_tx_hashes().append(signed_tx.hash.hex())
+    return w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+
+
 def send_transaction(raw_tx: Any, w3: Web3, explorer: str, account: LocalAccount, eip1559: bool, gas: int = 0,
                      value: int = 0):
-    transaction_params = _create_transaction_params(account=account, w3=w3, eip1559=eip1559, gas=gas, value=value)
-    tx = raw_tx.build_transaction(transaction_params)
-    if tx['gas'] == 0:
-        estimate_gas = int(w3.eth.estimate_gas(tx) * 1.1)
-        tx.update({'gas': estimate_gas})
-    signed_tx = w3.eth.account.sign_transaction(tx, account.key)
-    tx_hash = w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+    with tracer.span('build_tx'):
+        transaction_params = _create_transaction_params(account=account, w3=w3, eip1559=eip1559, gas=gas, value=value)
+        gas_key = gas_profiles.key(chain_id=transaction_params['chainId'], to=raw_tx.address, data=raw_tx.selector)
+        # build_transaction calls eth_estimateGas itself unless gas is already set
+        if 'gas' not in transaction_params:
+            profile_gas = gas_profiles.gas_limit(gas_key)
+            if profile_gas:
+                transaction_params['gas'] = profile_gas
+        if 'gas' not in transaction_params:
+            with tracer.span('gas_estimate'):
+                transaction_params['gas'] = int(raw_tx.estimate_gas(transaction_params) * 1.1)
+        tx = raw_tx.build_transaction(transaction_params)
+    with tracer.span('sign'):
+        signed_tx = w3.eth.account.sign_transaction(tx, account.key)
+    with tracer.span('broadcast'):
+        tx_hash = _send_raw(w3, signed_tx)
+    gas_profiles.track(tx_hash.hex(), gas_key, tx['gas'])
     logger.info(f"Tx: {explorer}tx/{tx_hash.hex()}")
     return tx_hash
 
@@ -186,28 +265,61 @@ def send_eth(to: ChecksumAddress, w3: Web3, account: LocalAccount, explorer: str
         tx.update({'gas': estimate_gas})
 
     signed_tx = w3.eth.account.sign_transaction(tx, account.key)
-    tx_hash = w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+    tx_hash = _send_raw(w3, signed_tx)
     logger.info(f"Tx: {explorer}tx/{tx_hash.hex()}")
     return tx_hash
 
 
-def send_tx_with_data(to: ChecksumAddress, w3: Web3, account: LocalAccount, explorer: str,
-                      eip1559: bool, data: str, value: int = 0):
-    tx = _create_transaction_params(account=account, w3=w3, value=value, eip1559=eip1559)
+def build_tx_with_data(to: ChecksumAddress, w3: Web3, account: LocalAccount, eip1559: bool, data: str,
+                       value: int = 0, gas: int = 0, vault: str = '') -> Dict:
+    """
+    Builds transaction with nonce, fees and gas limit
+    :param gas: (opt) known gas limit, e.g. from simulation, otherwise it is taken from gas profile or estimated
+    :param vault: (opt) vault id, part of gas profile key
+    """
+    with tracer.span('build_tx'):
+        tx = _create_transaction_params(account=account, w3=w3, value=value, eip1559=eip1559)
     tx.update({'to': to})
     tx.update({'data': data})
 
-    estimate_gas = int(w3.eth.estimate_gas(tx) * 1.05)
-    tx.update({'gas': estimate_gas})
-
-    signed_tx = w3.eth.account.sign_transaction(tx, account.key)
-    tx_hash = w3.eth.send_raw_transaction(signed_tx.rawTransaction)
+    # gas could be already known from simulation or learned from previous receipts of the same call
+    if not gas:
+        gas = gas_profiles.gas_limit(gas_profiles.key(chain_id=tx['chainId'], to=to, data=data, vault=vault))
+    if not gas:
+        with tracer.span('gas_estimate'):
+            gas = int(w3.eth.estimate_gas(tx) * 1.05)
+    tx.update({'gas': gas})
+    return tx
+
+
+def sign_tx(w3: Web3, tx: Dict, account: LocalAccount):
+    with tracer.span('sign'):
+        return w3.eth.account.sign_transaction(tx, account.key)
+
+
+def broadcast_tx(w3: Web3, signed_tx, tx: Dict, explorer: str, vault: str = ''):
+    """
+    Sends signed transaction, gas used is learned later from its receipt
+    :param tx: transaction that was signed
+    """
+    with tracer.span('broadcast'):
+        tx_hash = _send_raw(w3, signed_tx)
+    gas_key = gas_profiles.key(chain_id=tx['chainId'], to=tx['to'], data=tx['data'], vault=vault)
+    gas_profiles.track(tx_hash.hex(), gas_key, tx['gas'])
     logger.info(f"Tx: {explorer}tx/{tx_hash.hex()}")
     return tx_hash
 
 
+def send_tx_with_data(to: ChecksumAddress, w3: Web3, account: LocalAccount, explorer: str,
+                      eip1559: bool, data: str, value: int = 0, gas: int = 0, vault: str = ''):
+    tx = build_tx_with_data(to=to, w3=w3, account=account, eip1559=eip1559, data=data, value=value, gas=gas,
+                            vault=vault)
+    return broadcast_tx(w3=w3, signed_tx=sign_tx(w3=w3, tx=tx, account=account), tx=tx, explorer=explorer,
+                        vault=vault)
+
+
 def get_decimals(w3: Web3, token_address: ChecksumAddress) -> int:
-    erc20_contract = w3.eth.contract(token_address, abi=json.load(Path(abi_files['erc20']).open()))
+    erc20_contract = w3.eth.contract(token_address, abi=load_abi('erc20'))
     try:
         decimals = erc20_contract.functions.decimals().call()
     except BadFunctionCallOutput:
@@ -215,17 +327,33 @@ def get_decimals(w3: Web3, token_address: ChecksumAddress) -> int:
     return decimals
 
 
-def load_accounts_from_keys(path: str) -> List[LocalAccount]:
-    file = Path(path).open()
-    return [Account.from_key(line.replace("\n", "")) for line in file.readlines()]
+def load_accounts_from_keys(path: str, workers: int = key_loader_workers) -> List[LazyAccount]:
+    """
+    Loads accounts from keys file. LocalAccount is built only when account signs something
+    :param path: keys file, one private key per line
+    :param workers: number of processes to derive addresses in, 0 - derive lazily on first access
+    """
+    return list(iter_accounts_from_keys(path, workers=workers))
 
 
 def load_wallets(path: str):
-    file = Path(path).open()
-    return [line.replace("\n", "") for line in file.readlines()]
-
+    return list(iter_lines(path))
+
+
+def load_accounts_from_keys_encrypted(file_path: str, key_path: str, shard: int = 0, shards: int = 1) \
+        -> List[LazyAccount]:
+    """
+    Loads accounts from encrypted file. Chunked keystore (see utils.keystore) is decrypted only for the records of
+    requested shard, old single Fernet blob is decrypted in full
+    :param file_path: encrypted keys file
+    :param key_path: Fernet key file
+    :param shard: (opt) shard number, only for chunked keystore
+    :param shards: (opt) total number of shards, only for chunked keystore
+    """
+    if is_keystore(file_path):
+        with KeystoreReader(file_path, key_path) as keystore:
+            return list(keystore.iter_accounts(shard=shard, shards=shards))
 
-def load_accounts_from_keys_encrypted(file_path: str, key_path: str) -> List[LocalAccount]:
     with open(key_path, 'rb') as unlock:
         key = unlock.read()
         f = Fernet(key)
@@ -235,7 +363,7 @@ def load_accounts_from_keys_encrypted(file_path: str, key_path: str) -> List[Loc
             # decrypt the file
             decrypted = f.decrypt(encrypted)
             # return decrypted.decode().split('\n')
-            return [Account.from_key(line.replace("\r", "")) for line in decrypted.decode().split('\n')]
+            return [LazyAccount(line.replace("\r", "")) for line in decrypted.decode().split('\n') if line.strip()]
 
 
 def get_network_by_chain_id(chain_id) -> Network:
@@ -334,47 +462,83 @@ def max_gas(max_gwei, alternative_flow=None):
     return decorator
 
 
-def _is_approved(account: LocalAccount, w3: Web3, token_addr: ChecksumAddress, amount: int, spender: ChecksumAddress) \
+def is_approved(account: LocalAccount, w3: Web3, token_addr: ChecksumAddress, amount: int, spender: ChecksumAddress) \
         -> bool:
-    erc20_contract = w3.eth.contract(token_addr, abi=json.load(Path(abi_files['erc20']).open()))
+    chain_id = get_chain_id(w3)
+    # spending lowers finite allowances, so only unlimited and zero allowances are taken from cache
+    cached = allowance_cache.get(chain_id, account.address, token_addr, spender)
+    if cached is not None and (cached >= UNLIMITED_ALLOWANCE or cached < amount):
+        return cached >= amount
+
+    erc20_contract = w3.eth.contract(token_addr, abi=load_abi('erc20'))
     approved_amount = erc20_contract.functions.allowance(account.address, spender).call()
+    allowance_cache.set(chain_id, account.address, token_addr, spender, approved_amount)
     return approved_amount >= amount
 
 
 def approve(account: LocalAccount, w3: Web3, token_address: ChecksumAddress, spender: ChecksumAddress,
             explorer, eip1559, amount: int = MAX_APPROVAL_INT) \
         -> bool:
-    if _is_approved(account, w3, token_address, amount, spender):
+    # native coin does not need approval
+    if token_address.lower() == eth_address.lower():
+        return True
+    if is_approved(account, w3, token_address, amount, spender):
         return True
 
     logger.info(f"Approving {amount} of {token_address}")
-    erc20_contract = w3.eth.contract(token_address, abi=json.load(Path(abi_files['erc20']).open()))
+    erc20_contract = w3.eth.contract(token_address, abi=load_abi('erc20'))
     raw_tx = erc20_contract.functions.approve(spender, MAX_APPROVAL_INT)
     return check_tx_status(w3=w3, tx_hash=send_transaction(raw_tx=raw_tx, w3=w3, account=account,
                                                            explorer=explorer, eip1559=eip1559))
 
 
-def catch_errors(sleep_times):
-    def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            try:
-                return func(*args, **kwargs)
-            except Exception as err:
-                exception_type = type(err)
-                if exception_type in sleep_times:
-                    sleep_time = random.randint(*sleep_times[exception_type])
-                else:
-                    sleep_time = random.randint(*sleep_times['other_exception'])
-                logger.error(f'Something went wrong with script {script_name} - {exception_type.__name__}: {err}, Sleeping for {sleep_time} seconds')
-                if len(tg_token) > 0 and len(tg_chat_id) > 0:
-                    send_error_message(message=f"Caught {exception_type.__name__}: {err} ", script=script_name)
-                time.sleep(sleep_time)
-        return wrapper
-    return decorator
-
-
-def send_error_message(message: str, script: str):
-    send_text = 'https://api.telegram.org/bot' + tg_token + '/sendMessage?chat_id=' + \
-                tg_chat_id + f'&parse_mode=Markdown&text=Script: {script}. {message}'
-    requests.get(send_text)
+def scan_allowances(w3: Web3, owners: List[str], token_address: str, spender: str, batch_size: int = 500) \
+        -> Dict[ChecksumAddress, int]:
+    """
+    Gets allowances of many wallets with Multicall3 aggregate3 calls and fills allowance cache
+    :param owners: wallet addresses
+    :param token_address: erc20 token
+    :param spender: spender, e.g. - superform_router_address
+    :param batch_size: allowance calls in one eth_call
+    :return: Dict - {owner: allowance}, failed calls are missing
+    """
+    chain_id = get_chain_id(w3)
+    token_address = Web3.to_checksum_address(token_address)
+    spender = Web3.to_checksum_address(spender)
+    erc20_contract = w3.eth.contract(token_address, abi=load_abi('erc20'))
+    multicall = w3.eth.contract(Web3.to_checksum_address(multicall3_address), abi=load_abi('multicall3'))
+
+    result = {}
+    owners = [Web3.to_checksum_address(owner) for owner in owners]
+    for i in range(0, len(owners), batch_size):
+        batch = owners[i:i + batch_size]
+        calls = [(token_address, True, erc20_contract.encodeABI('allowance', [owner, spender])) for owner in batch]
+        for owner, (success, data) in zip(batch, multicall.functions.aggregate3(calls).call()):
+            if not success or len(data) < 32:
+                continue
+            result[owner] = int.from_bytes(data[:32], 'big')
+            allowance_cache.set(chain_id, owner, token_address, spender, result[owner])
+    return result
+
+
+def catch_errors(func):
+    """
+    Logs and sends error of direct call and returns None, calling thread is not put to sleep.
+    Delays between attempts are applied by RetryScheduler, it calls func without this decorator
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as err:
+            exception_type = type(err)
+            logger.error(f'Something went wrong with script {script_name} - {exception_type.__name__}: {err}')
+            send_error_message(message=f'{err}', script=script_name, error_type=exception_type.__name__)
+    return wrapper
+
+
+def send_error_message(message: str, script: str, error_type: str = 'Error'):
+    """
+    Queues message for background telegram notifier, identical error types are sent as one digest
+    """
+    notifier.notify(script=script, error_type=error_type, message=message)
@@ -0,0 +1,166 @@
+import sys
+import mmap
+import json
+import struct
+
+from pathlib import Path
+from typing import Iterator, Iterable, List
+from cryptography.fernet import Fernet
+
+from utils.accounts import LazyAccount
+
+"""
+CHUNKED ENCRYPTED KEYSTORE
+File layout:
+    MAGIC | chunk 0 | chunk 1 | ... | index (json) | footer: index offset (u64), index length (u64), MAGIC
+Every chunk is a separate Fernet token with up to chunk_size keys separated by new line,
+so only chunks needed by a worker are decrypted and the file is read through mmap.
+Convert old single blob file: python -m utils.keystore convert <encrypted file> <key file> <new keystore file>
+"""
+
+MAGIC = b'SFKS\x01'
+_footer = struct.Struct('<QQ')
+FOOTER_SIZE = _footer.size + len(MAGIC)
+
+
+def _load_fernet(key_path: str) -> Fernet:
+    with open(key_path, 'rb') as unlock:
+        return Fernet(unlock.read().strip())
+
+
+def is_keystore(path: str) -> bool:
+    """
+    :return: True if file is in chunked keystore format, False for old single blob format
+    """
+    with open(path, 'rb') as file:
+        return file.read(len(MAGIC)) == MAGIC
+
+
+def write_keystore(private_keys: Iterable[str], path: str, key_path: str, chunk_size: int = 256) -> int:
+    """
+    Writes keys to chunked keystore, keys are consumed as a stream
+    :param private_keys: iterable of private keys
+    :param path: new keystore path
+    :param key_path: Fernet key file
+    :param chunk_size: keys per encrypted chunk
+    :return: (int) number of written keys
+    """
+    fernet = _load_fernet(key_path)
+    chunks = []
+    count = 0
+
+    def flush(file, batch: List[str]):
+        token = fernet.encrypt('\n'.join(batch).encode())
+        chunks.append([file.tell(), len(token), len(batch)])
+        file.write(token)
+
+    with open(path, 'wb') as file:
+        file.write(MAGIC)
+        batch = []
+        for private_key in private_keys:
+            private_key = private_key.strip()
+            if not private_key:
+                continue
+            batch.append(private_key)
+            count += 1
+            if len(batch) == chunk_size:
+                flush(file, batch)
+                batch = []
+        if batch:
+            flush(file, batch)
+
+        index = json.dumps({'chunk_size': chunk_size, 'count': count, 'chunks': chunks}).encode()
+        index_offset = file.tell()
+        file.write(index)
+        file.write(_footer.pack(index_offset, len(index)) + MAGIC)
+    return count
+
+
+def convert_fernet_blob(src_path: str, key_path: str, dst_path: str, chunk_size: int = 256) -> int:
+    """
+    Converts old single Fernet blob (used by load_accounts_from_keys_encrypted) to chunked keystore
+    :return: (int) number of converted keys
+    """
+    fernet = _load_fernet(key_path)
+    with open(src_path, 'rb') as encrypted_file:
+        decrypted = fernet.decrypt(encrypted_file.read()).decode()
+    return write_keystore((line.replace('\r', '') for line in decrypted.split('\n')), dst_path, key_path,
+                          chunk_size=chunk_size)
+
+
+class KeystoreReader:
+    def __init__(self, path: str, key_path: str):
+        """
+        Random access reader of chunked keystore. File is memory mapped, chunks are decrypted on demand
+        :param path: keystore path
+        :param key_path: Fernet key file
+        """
+        self.fernet = _load_fernet(key_path)
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap[:len(MAGIC)] != MAGIC or self._mmap[-len(MAGIC):] != MAGIC:
+            raise ValueError(f'{path} is not a keystore file')
+        index_offset, index_length = _footer.unpack(self._mmap[-FOOTER_SIZE:-len(MAGIC)])
+        index = json.loads(self._mmap[index_offset:index_offset + index_length])
+        self.chunk_size = index['chunk_size']
+        self.count = index['count']
+        self.chunks = index['chunks']
+
+    def __len__(self):
+        return self.count
+
+    def read_chunk(self, chunk_index: int) -> List[str]:
+        """
+        :return: decrypted keys of one chunk
+        """
+        offset, length, _ = self.chunks[chunk_index]
+        return self.fernet.decrypt(self._mmap[offset:offset + length]).decode().split('\n')
+
+    def get_key(self, record_index: int) -> str:
+        """
+        :return: private key by its position, decrypts only one chunk
+        """
+        if not 0 <= record_index < self.count:
+            raise IndexError(record_index)
+        return self.read_chunk(record_index // self.chunk_size)[record_index % self.chunk_size]
+
+    def iter_keys(self, start: int = 0, stop: int = None) -> Iterator[str]:
+        """
+        Streams keys in [start, stop) range decrypting chunk by chunk
+        """
+        stop = self.count if stop is None else min(stop, self.count)
+        for chunk_index in range(start // self.chunk_size, (stop + self.chunk_size - 1) // self.chunk_size):
+            first = chunk_index * self.chunk_size
+            for position, private_key in enumerate(self.read_chunk(chunk_index), start=first):
+                if start <= position < stop:
+                    yield private_key
+
+    def iter_accounts(self, shard: int = 0, shards: int = 1) -> Iterator[LazyAccount]:
+        """
+        Streams accounts of one shard, shard is contiguous range of records
+        :param shard: shard number, from 0 to shards - 1
+        :param shards: total number of shards (workers)
+        """
+        start = self.count * shard // shards
+        stop = self.count * (shard + 1) // shards
+        for private_key in self.iter_keys(start, stop):
+            yield LazyAccount(private_key)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[1] != 'convert':
+        print('usage: python -m utils.keystore convert <encrypted file> <key file> <new keystore file>')
+        sys.exit(1)
+    total = convert_fernet_blob(sys.argv[2], sys.argv[3], sys.argv[4])
+    print(f'Converted {total} keys to {Path(sys.argv[4])}')
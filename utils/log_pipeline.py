@@ -0,0 +1,134 @@
+import sys
+import gzip
+import json
+import queue
+import shutil
+import datetime
+import threading
+
+from pathlib import Path
+from typing import List
+
+"""
+NON-BLOCKING LOGGING SINKS FOR LOGURU
+Caller only puts formatted message into in-memory queue, background thread writes messages in batches
+"""
+
+_STOP = object()
+
+
+class StreamWriter:
+    def __init__(self, stream):
+        self.stream = stream
+
+    def write_batch(self, messages: List[str]):
+        self.stream.write(''.join(messages))
+        self.stream.flush()
+
+    def close(self):
+        self.stream.flush()
+
+
+class DailyFileWriter:
+    def __init__(self, prefix: str, json_lines: bool = False, compression: str = 'gz'):
+        """
+        Writes to {prefix}{YYYYMMDD}.log, on date change previous file is compressed
+        :param prefix: file path prefix, e.g. - ./logs/superform
+        :param json_lines: write json object with record fields and extra (wallet, vault) per line
+        :param compression: 'gz' or '' to keep old files as is
+        """
+        self.prefix = prefix
+        self.json_lines = json_lines
+        self.compression = compression
+        self.date = None
+        self.path = None
+        self.file = None
+        Path(prefix).parent.mkdir(parents=True, exist_ok=True)
+
+    def _rotate(self, date: str):
+        previous = self.path
+        if self.file:
+            self.file.close()
+        self.date = date
+        self.path = Path(f'{self.prefix}{date}.log')
+        self.file = self.path.open('a', encoding='utf-8')
+        if previous and self.compression == 'gz':
+            with previous.open('rb') as source, gzip.open(f'{previous}.gz', 'wb') as target:
+                shutil.copyfileobj(source, target)
+            previous.unlink()
+
+    @staticmethod
+    def _to_json(message) -> str:
+        record = message.record
+        row = {
+            'time': record['time'].isoformat(),
+            'level': record['level'].name,
+            'message': record['message'],
+            'module': record['module'],
+            'function': record['function'],
+            'line': record['line'],
+            'thread': record['thread'].name,
+            **{key: str(value) for key, value in record['extra'].items()},
+        }
+        if record['exception']:
+            row['exception'] = repr(record['exception'].value)
+        return json.dumps(row) + '\n'
+
+    def write_batch(self, messages: List[str]):
+        date = datetime.datetime.now().strftime('%Y%m%d')
+        if date != self.date:
+            self._rotate(date)
+        if self.json_lines:
+            self.file.write(''.join(self._to_json(message) for message in messages))
+        else:
+            self.file.write(''.join(messages))
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
+
+class BackgroundSink:
+    def __init__(self, writer: StreamWriter | DailyFileWriter, max_batch: int = 1000):
+        """
+        Loguru sink, write() only puts message to queue. Messages are written by background thread,
+        everything accumulated since the previous write goes in one batch
+        :param writer: StreamWriter or DailyFileWriter
+        :param max_batch: max messages written at once
+        """
+        self.writer = writer
+        self.max_batch = max_batch
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+        self._thread.start()
+
+    def write(self, message):
+        self._queue.put(message)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = _STOP in batch
+            messages = [message for message in batch if message is not _STOP]
+            if messages:
+                try:
+                    self.writer.write_batch(messages)
+                except Exception as err:
+                    sys.stderr.write(f'Log writer error: {type(err).__name__}: {err}\n')
+            if stop:
+                self.writer.close()
+                return
+
+    def stop(self):
+        """
+        Called by loguru on logger.remove() and at exit, writes everything left in the queue
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
@@ -0,0 +1,246 @@
+import re
+import time
+import json
+import bisect
+import threading
+
+from pathlib import Path
+from typing import Dict, List, Tuple
+from urllib.parse import urlsplit
+
+"""
+METRICS FOR SUPERFORM API AND JSON-RPC CALLS
+Counters and latency histograms per API path template and per RPC (method, endpoint)
+"""
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_address_re = re.compile(r'^0x[0-9a-fA-F]{40}$')
+_id_prefixes = ('vault', 'protocol')
+
+_rpc_context = threading.local()
+
+
+class Histogram:
+    def __init__(self, buckets: Tuple = LATENCY_BUCKETS):
+        """
+        Cumulative histogram in prometheus style
+        :param buckets: upper bounds of buckets in seconds
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self) -> List[Tuple[str, int]]:
+        """
+        :return: list of (le, cumulative count) including +Inf bucket
+        """
+        result = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((str(bound), total))
+        return result
+
+    def quantile(self, q: float) -> float:
+        """
+        Approximate quantile, upper bound of the bucket where quantile falls
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return float(bound)
+        return float('inf')
+
+
+class Series:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes = 0
+        self.latency = Histogram()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        """
+        Thread safe storage of request metrics.
+        Series are grouped by kind ('api' or 'rpc') and labels tuple
+        """
+        self._lock = threading.Lock()
+        self._series: Dict[str, Dict[Tuple, Series]] = {'api': {}, 'rpc': {}}
+        self._labels = {'api': ('method', 'path'), 'rpc': ('method', 'endpoint')}
+
+    def _get_series(self, kind: str, labels: Tuple) -> Series:
+        series = self._series[kind].get(labels)
+        if series is None:
+            series = self._series[kind].setdefault(labels, Series())
+        return series
+
+    def observe(self, kind: str, labels: Tuple, latency: float = None, error: bool = False):
+        with self._lock:
+            series = self._get_series(kind, labels)
+            series.count += 1
+            if error:
+                series.errors += 1
+            if latency is not None:
+                series.latency.observe(latency)
+
+    def add_bytes(self, kind: str, labels: Tuple, amount: int):
+        with self._lock:
+            self._get_series(kind, labels).bytes += amount
+
+    def reset(self):
+        with self._lock:
+            for series in self._series.values():
+                series.clear()
+
+    def to_prometheus(self) -> str:
+        """
+        :return: (str) metrics in prometheus text exposition format
+        """
+        lines = []
+        with self._lock:
+            for kind, all_series in self._series.items():
+                name = f'superform_{kind}'
+                label_names = self._labels[kind]
+                lines.append(f'# TYPE {name}_requests_total counter')
+                lines.append(f'# TYPE {name}_errors_total counter')
+                lines.append(f'# TYPE {name}_response_bytes_total counter')
+                lines.append(f'# TYPE {name}_latency_seconds histogram')
+                for labels, series in sorted(all_series.items()):
+                    label_str = ','.join(f'{key}="{value}"' for key, value in zip(label_names, labels))
+                    lines.append(f'{name}_requests_total{{{label_str}}} {series.count}')
+                    lines.append(f'{name}_errors_total{{{label_str}}} {series.errors}')
+                    lines.append(f'{name}_response_bytes_total{{{label_str}}} {series.bytes}')
+                    for le, count in series.latency.cumulative():
+                        lines.append(f'{name}_latency_seconds_bucket{{{label_str},le="{le}"}} {count}')
+                    lines.append(f'{name}_latency_seconds_sum{{{label_str}}} {series.latency.sum:.6f}')
+                    lines.append(f'{name}_latency_seconds_count{{{label_str}}} {series.latency.count}')
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> Dict:
+        """
+        :return: Dict - {'api': [{'method': 'get', 'path': 'vaults', 'count': 1, ...}], 'rpc': [...]}
+            sorted by total time spent, most expensive first
+        """
+        result = {}
+        with self._lock:
+            for kind, all_series in self._series.items():
+                rows = []
+                for labels, series in all_series.items():
+                    row = dict(zip(self._labels[kind], labels))
+                    row.update({
+                        'count': series.count,
+                        'errors': series.errors,
+                        'bytes': series.bytes,
+                        'total_s': round(series.latency.sum, 3),
+                        'mean_s': round(series.latency.sum / series.latency.count, 3) if series.latency.count else 0,
+                        'p95_s': series.latency.quantile(0.95),
+                    })
+                    rows.append(row)
+                result[kind] = sorted(rows, key=lambda r: r['total_s'], reverse=True)
+        return result
+
+    def dump(self, prometheus_file: str = None) -> str:
+        """
+        Writes prometheus file (if provided) and returns json summary
+        :param prometheus_file: (opt) path for prometheus text file
+        :return: (str) json summary
+        """
+        if prometheus_file:
+            Path(prometheus_file).parent.mkdir(parents=True, exist_ok=True)
+            with open(prometheus_file, 'w') as file:
+                file.write(self.to_prometheus())
+        return json.dumps(self.summary())
+
+
+metrics = MetricsRegistry()
+
+
+def get_path_template(url: str) -> str:
+    """
+    Converts api url to path template, so every address or vault gets to the same series
+    e.g. - https://api.superform.xyz/superrewards/rewards/4/0xAb.. -> superrewards/rewards/{n}/{address}
+    :param url: full request url
+    :return: (str) path template without query
+    """
+    segments = urlsplit(url).path.strip('/').split('/')
+    for i, segment in enumerate(segments):
+        if _address_re.match(segment):
+            segments[i] = '{address}'
+        elif segment.isdigit():
+            segments[i] = '{n}'
+        elif i > 0 and segments[i - 1] in _id_prefixes:
+            segments[i] = '{id}'
+    return '/'.join(segments)
+
+
+def api_response_hook(response, *args, **kwargs):
+    """
+    requests response hook, records metrics of Superform api calls
+    """
+    labels = (response.request.method.lower(), get_path_template(response.request.url))
+    metrics.observe('api', labels, latency=response.elapsed.total_seconds(), error=not response.ok)
+    # reading content of streamed response would load whole body, its size is taken from headers instead
+    size = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+    metrics.add_bytes('api', labels, size)
+    return response
+
+
+def rpc_response_hook(response, *args, **kwargs):
+    """
+    requests response hook for web3 sessions, counts bytes to rpc method currently executed in this thread
+    """
+    labels = getattr(_rpc_context, 'labels', None)
+    if labels:
+        metrics.add_bytes('rpc', labels, len(response.content))
+    return response
+
+
+def rpc_metrics_middleware(make_request, w3):
+    """
+    web3 middleware, records latency and errors per rpc method and endpoint
+    """
+    endpoint = urlsplit(getattr(w3.provider, 'endpoint_uri', '') or '').netloc
+
+    def middleware(method, params):
+        labels = (method, endpoint)
+        _rpc_context.labels = labels
+        start = time.perf_counter()
+        try:
+            response = make_request(method, params)
+        except Exception:
+            metrics.observe('rpc', labels, latency=time.perf_counter() - start, error=True)
+            raise
+        finally:
+            _rpc_context.labels = None
+        metrics.observe('rpc', labels, latency=time.perf_counter() - start, error='error' in response)
+        return response
+
+    return middleware
+
+
+def instrument_web3(w3):
+    """
+    Adds metrics middleware and bytes hook to web3 instance
+    :param w3: Web3 instance with HTTPProvider
+    """
+    from web3._utils.request import cache_and_return_session
+
+    if 'metrics' not in w3.middleware_onion:
+        w3.middleware_onion.add(rpc_metrics_middleware, 'metrics')
+    # pooled provider has own session shared by threads, default one has session per thread
+    session = getattr(w3.provider, 'session', None) or cache_and_return_session(w3.provider.endpoint_uri)
+    if rpc_response_hook not in session.hooks['response']:
+        session.hooks['response'].append(rpc_response_hook)
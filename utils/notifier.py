@@ -0,0 +1,169 @@
+import time
+import queue
+import atexit
+import threading
+import requests
+
+from loguru import logger
+from typing import Dict, Tuple
+
+from config import tg_token, tg_chat_id, notifier_window, notifier_queue_size, notifier_min_interval
+
+"""
+BACKGROUND TELEGRAM NOTIFIER
+Errors are put into bounded queue, background thread groups identical errors over a time window
+and sends one digest message per window respecting telegram rate limit
+"""
+
+TELEGRAM_API = 'https://api.telegram.org'
+MAX_MESSAGE_LENGTH = 4096
+# puts end to the current window, digest is sent right away
+_FLUSH = object()
+
+
+class ErrorNotifier:
+    def __init__(self, token: str = tg_token, chat_id: str = tg_chat_id, base_url: str = TELEGRAM_API,
+                 window: float = notifier_window, queue_size: int = notifier_queue_size,
+                 min_interval: float = notifier_min_interval):
+        """
+        :param token: telegram bot token, notifier does nothing if token or chat id is empty
+        :param chat_id: telegram chat id
+        :param base_url: telegram api url, could be replaced with local http server
+        :param window: seconds to collect errors before sending digest
+        :param queue_size: errors above this number are dropped and counted instead of blocking the caller
+        :param min_interval: minimal seconds between two messages
+        """
+        self.token = token
+        self.chat_id = chat_id
+        self.base_url = base_url.rstrip('/')
+        self.window = window
+        self.min_interval = min_interval
+        self.dropped = 0
+        self.sent = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._session = requests.Session()
+        self._last_send = 0.0
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flushed = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.token) and bool(self.chat_id)
+
+    def notify(self, script: str, error_type: str, message: str):
+        """
+        Never blocks, starts background thread on the first call
+        :param script: script name
+        :param error_type: errors with the same script and type are grouped in digest
+        :param message: error text, the latest one is shown in digest
+        """
+        if not self.enabled:
+            return
+        self._start()
+        try:
+            self._queue.put_nowait((script, error_type, message))
+        except queue.Full:
+            self.dropped += 1
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='error-notifier', daemon=True)
+                self._thread.start()
+                # errors of the last window would be lost with daemon thread at exit
+                atexit.register(self.flush)
+
+    def flush(self, timeout: float = 10):
+        """
+        Sends collected errors without waiting for the end of the window
+        :param timeout: max seconds to wait for the digest to be sent
+        """
+        if self._thread is None:
+            return
+        self._flushed.clear()
+        try:
+            self._queue.put(_FLUSH, timeout=timeout)
+        except queue.Full:
+            return
+        self._flushed.wait(timeout)
+
+    @staticmethod
+    def format_digest(errors: Dict[Tuple[str, str], list], dropped: int = 0) -> str:
+        """
+        :param errors: Dict - {(script, error type): [count, last message]}
+        :param dropped: number of errors dropped because queue was full
+        """
+        lines = [f'Script: {script}. Caught {error_type} x{count}: {message}'
+                 for (script, error_type), (count, message) in errors.items()]
+        if dropped:
+            lines.append(f'{dropped} more errors dropped')
+        return '\n'.join(lines)[:MAX_MESSAGE_LENGTH]
+
+    def _collect(self) -> Tuple[Dict[Tuple[str, str], list], bool]:
+        """
+        Waits for the first error and then collects everything that arrives during the window
+        :return: (errors, True if flush was requested)
+        """
+        item = self._queue.get()
+        if item is _FLUSH:
+            return {}, True
+        script, error_type, message = item
+        errors = {(script, error_type): [1, message]}
+        deadline = time.monotonic() + self.window
+        while (timeout := deadline - time.monotonic()) > 0:
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is _FLUSH:
+                return errors, True
+            script, error_type, message = item
+            error = errors.setdefault((script, error_type), [0, message])
+            error[0] += 1
+            error[1] = message
+        return errors, False
+
+    def _redact(self, text: str) -> str:
+        """
+        Removes bot token, requests errors contain full url
+        """
+        return text.replace(self.token, '<token>') if self.token else text
+
+    def _run(self):
+        while True:
+            errors, flush = self._collect()
+            dropped, self.dropped = self.dropped, 0
+            if errors or dropped:
+                try:
+                    self.send(self.format_digest(errors, dropped))
+                except Exception as err:
+                    logger.warning(f'Could not send telegram message - '
+                                   f'{type(err).__name__}: {self._redact(str(err))}')
+            if flush:
+                self._flushed.set()
+
+    def send(self, text: str):
+        """
+        Sends message, waits for min_interval since previous message and retries once after 429 retry_after
+        """
+        for _ in range(2):
+            wait = self._last_send + self.min_interval - time.monotonic()
+            if wait > 0:
+                time.sleep(wait)
+            response = self._session.post(f'{self.base_url}/bot{self.token}/sendMessage', timeout=10,
+                                          data={'chat_id': self.chat_id, 'text': text})
+            self._last_send = time.monotonic()
+            if response.status_code != 429:
+                response.raise_for_status()
+                self.sent += 1
+                return
+            try:
+                retry_after = response.json()['parameters']['retry_after']
+            except (ValueError, KeyError, TypeError):
+                retry_after = int(response.headers.get('Retry-After', 5))
+            time.sleep(retry_after)
+        raise requests.HTTPError('Telegram rate limit', response=response)
+
+
+notifier = ErrorNotifier()
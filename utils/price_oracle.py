@@ -0,0 +1,159 @@
+import time
+import datetime
+import threading
+import requests
+
+from email.utils import parsedate_to_datetime
+
+from loguru import logger
+from typing import Dict, Iterable, List
+from requests.adapters import HTTPAdapter
+
+from utils.metrics import api_response_hook
+from utils.cassette import install_cassette
+from config import price_ttl, price_stale_ttl
+
+"""
+COINGECKO PRICE ORACLE
+All known ids of a currency are fetched in one simple/price request, prices are cached for ttl seconds.
+Stale prices are returned right away while background refresh gets new ones
+"""
+
+COINGECKO_API = 'https://api.coingecko.com/api/v3/'
+MAX_IDS_PER_REQUEST = 250
+NEVER = float('-inf')
+
+
+def retry_after_seconds(value: str | None, default: float = 60) -> float:
+    """
+    :param value: Retry-After header, seconds or http date
+    :return: seconds to wait, default if header is missing or malformed
+    """
+    if not value:
+        return default
+    try:
+        return max(0., float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0., (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+class PriceOracle:
+    def __init__(self, ttl: float = price_ttl, stale_ttl: float = price_stale_ttl, endpoint: str = COINGECKO_API):
+        """
+        :param ttl: seconds while price is fresh
+        :param stale_ttl: seconds after ttl while stale price is returned and refreshed in background
+        :param endpoint: coingecko api url
+        """
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.endpoint = endpoint
+        self.session = self._init_session()
+        # {vs_currency: {token id: (price, fetched at)}}
+        self._prices: Dict[str, Dict[str, tuple]] = {}
+        self._lock = threading.Lock()
+        self._refreshing = set()
+        self._blocked_until = 0.0
+
+    @staticmethod
+    def _init_session() -> requests.Session:
+        session = requests.Session()
+        session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=4))
+        session.headers.update({'Accept': 'application/json'})
+        session.hooks['response'].append(api_response_hook)
+        install_cassette(session)
+        return session
+
+    def track(self, token_ids: Iterable[str], vs_currency: str = 'usd'):
+        """
+        Adds ids that should be fetched together with every following request
+        """
+        with self._lock:
+            prices = self._prices.setdefault(vs_currency, {})
+            for token_id in token_ids:
+                prices.setdefault(token_id, (None, NEVER))
+
+    def _fetch(self, token_ids: List[str], vs_currency: str):
+        if time.monotonic() < self._blocked_until:
+            raise requests.exceptions.ConnectionError('CoinGecko API RateLimit, waiting for Retry-After')
+
+        for i in range(0, len(token_ids), MAX_IDS_PER_REQUEST):
+            chunk = token_ids[i:i + MAX_IDS_PER_REQUEST]
+            response = self.session.get(self.endpoint + 'simple/price', timeout=10,
+                                        params={'ids': ','.join(chunk), 'vs_currencies': vs_currency})
+            if response.status_code == 429:
+                retry_after = retry_after_seconds(response.headers.get('Retry-After'))
+                self._blocked_until = time.monotonic() + retry_after
+                logger.error(f'Coingecko API RateLimit, next request in {retry_after:.0f} seconds')
+                raise requests.exceptions.ConnectionError(f'Bad request to CoinGecko API: {response.status_code}')
+            if response.status_code != 200:
+                raise requests.exceptions.ConnectionError(f'Bad request to CoinGecko API: {response.status_code}')
+
+            data = response.json()
+            now = time.monotonic()
+            with self._lock:
+                prices = self._prices.setdefault(vs_currency, {})
+                for token_id in chunk:
+                    price = data.get(token_id, {}).get(vs_currency)
+                    prices[token_id] = (float(price) if price is not None else None, now)
+
+    def _refresh_in_background(self, vs_currency: str):
+        with self._lock:
+            if vs_currency in self._refreshing:
+                return
+            self._refreshing.add(vs_currency)
+            token_ids = list(self._prices[vs_currency])
+
+        def refresh():
+            try:
+                self._fetch(token_ids, vs_currency)
+            except Exception as err:
+                logger.warning(f'Background price refresh failed - {type(err).__name__}: {err}')
+            finally:
+                with self._lock:
+                    self._refreshing.discard(vs_currency)
+
+        threading.Thread(target=refresh, name='price-refresh', daemon=True).start()
+
+    def get_prices(self, token_ids: Iterable[str], vs_currency: str = 'usd') -> Dict[str, float | None]:
+        """
+        :param token_ids: coingecko ids, e.g. - ['ethereum', 'usd-coin']
+        :param vs_currency: e.g. - 'usd'
+        :return: Dict - {token id: price or None if coingecko does not know the id}
+        """
+        token_ids = list(token_ids)
+        self.track(token_ids, vs_currency)
+        now = time.monotonic()
+        with self._lock:
+            cached = {token_id: self._prices[vs_currency][token_id] for token_id in token_ids}
+        ages = [now - fetched_at for _, fetched_at in cached.values()]
+
+        if any(age >= self.ttl + self.stale_ttl for age in ages):
+            # refresh every tracked id of the currency in the same request
+            with self._lock:
+                all_ids = list(self._prices[vs_currency])
+            try:
+                self._fetch(all_ids, vs_currency)
+            except (requests.exceptions.RequestException, ValueError):
+                # timeouts and broken json fall back to expired prices too
+                if any(fetched_at == NEVER for _, fetched_at in cached.values()):
+                    raise
+                logger.warning('Using expired prices, CoinGecko API is not available')
+            with self._lock:
+                cached = {token_id: self._prices[vs_currency][token_id] for token_id in token_ids}
+        elif any(age >= self.ttl for age in ages):
+            self._refresh_in_background(vs_currency)
+
+        return {token_id: price for token_id, (price, _) in cached.items()}
+
+    def get_price(self, token_id: str, vs_currency: str = 'usd') -> float | None:
+        return self.get_prices([token_id], vs_currency)[token_id]
+
+
+price_oracle = PriceOracle()
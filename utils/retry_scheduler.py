@@ -0,0 +1,168 @@
+import json
+import time
+import heapq
+import random
+import datetime
+import itertools
+import threading
+
+from pathlib import Path
+from loguru import logger
+from typing import Callable, Dict, List
+from concurrent.futures import ThreadPoolExecutor
+
+from utils.constants import BreakTimer
+from utils.helpful_scripts import send_error_message, sent_tx_hashes
+from config import script_name, sleeping_time, retry_max_attempts, retry_workers, dead_letter_file
+
+"""
+DELAYED RETRY QUEUE
+Failed operation is put back into time ordered queue with backoff delay instead of sleeping in worker thread,
+operations of other wallets keep running meanwhile. Operations that failed max_attempts times go to dead-letter file.
+Operation that failed after it sent a transaction is never retried, it goes to dead-letter file with tx hashes
+"""
+
+
+class Task:
+    __slots__ = ('func', 'args', 'kwargs', 'context', 'attempts', 'errors', 'tx_hashes')
+
+    def __init__(self, func: Callable, args: tuple, kwargs: Dict, context: Dict):
+        # functions decorated with catch_errors are called without the decorator so errors reach the scheduler,
+        # scheduler sends error messages itself
+        self.func = getattr(func, '__wrapped__', func)
+        self.args = args
+        self.kwargs = kwargs
+        self.context = context
+        self.attempts = 0
+        self.errors: List[str] = []
+        # transactions sent by the last attempt
+        self.tx_hashes: List[str] = []
+
+    @property
+    def name(self) -> str:
+        return self.func.__name__
+
+    def to_dict(self) -> Dict:
+        def arg(value):
+            # do not write accounts with private keys, only addresses
+            return getattr(value, 'address', value)
+
+        return {
+            'function': self.name,
+            'args': [arg(value) for value in self.args],
+            'kwargs': {key: arg(value) for key, value in self.kwargs.items()},
+            'context': self.context,
+            'attempts': self.attempts,
+            'errors': self.errors,
+            'tx_hashes': self.tx_hashes,
+        }
+
+
+class RetryScheduler:
+    def __init__(self, sleep_times: Dict = sleeping_time, max_attempts: int = retry_max_attempts,
+                 workers: int = retry_workers, dead_letter: str = dead_letter_file):
+        """
+        :param sleep_times: Dict - {exception type: (min, max) seconds}, used as retry delays, e.g. config.sleeping_time
+        :param max_attempts: attempts before task goes to dead-letter file
+        :param workers: number of tasks running at the same time
+        :param dead_letter: jsonl file for tasks which failed max_attempts times
+        """
+        self.sleep_times = sleep_times
+        self.max_attempts = max_attempts
+        self.workers = workers
+        self.dead_letter = Path(dead_letter)
+        self.results = []
+        self.stats = {'completed': 0, 'skipped': 0, 'retried': 0, 'dead': 0}
+        self._heap = []
+        self._sequence = itertools.count()
+        self._running = 0
+        self._condition = threading.Condition()
+
+    def submit(self, func: Callable, *args, delay: float = 0, context: Dict = None, **kwargs):
+        """
+        Schedules func(*args, **kwargs) to run after delay seconds
+        :param context: (opt) logger context for the task, e.g. - {'wallet': account.address}
+        """
+        self._push(Task(func, args, kwargs, context or {}), delay)
+
+    def _push(self, task: Task, delay: float):
+        with self._condition:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._sequence), task))
+            self._condition.notify()
+
+    def retry_delay(self, err: Exception) -> int:
+        return random.randint(*self.sleep_times.get(type(err), self.sleep_times['other_exception']))
+
+    def _execute(self, task: Task):
+        task.attempts += 1
+        outcome = 'completed'
+        sent_tx_hashes().clear()
+        try:
+            with logger.contextualize(**task.context):
+                logger.info(f'Started {task.name}, attempt {task.attempts}')
+                try:
+                    result = task.func(*task.args, **task.kwargs)
+                    with self._condition:
+                        self.results.append((task, result))
+                except BreakTimer:
+                    logger.info(f'{task.name} skipped')
+                    outcome = 'skipped'
+                except Exception as err:
+                    task.tx_hashes = list(sent_tx_hashes())
+                    outcome = self._failed(task, err)
+        finally:
+            with self._condition:
+                self.stats[outcome] += 1
+                self._running -= 1
+                self._condition.notify()
+
+    def _failed(self, task: Task, err: Exception) -> str:
+        """
+        :return: 'dead' if task is written to dead-letter file, 'retried' if it is scheduled again
+        """
+        error = f'{type(err).__name__}: {err}'
+        task.errors.append(error)
+        if task.tx_hashes:
+            # transaction could be already mined, new attempt would send it again
+            logger.error(f'{task.name} failed after sending {task.tx_hashes}, not retried - {error}')
+            send_error_message(message=f'{task.name} failed after sending {task.tx_hashes}, moved to dead-letter '
+                                       f'file: {err}', script=script_name, error_type=f'{type(err).__name__} (tx sent)')
+            self._dead_letter(task)
+            return 'dead'
+        if task.attempts >= self.max_attempts:
+            logger.error(f'{task.name} failed {task.attempts} times, last error - {error}')
+            send_error_message(message=f'{task.name} failed {task.attempts} times, moved to dead-letter file: {err}',
+                               script=script_name, error_type=f'{type(err).__name__} (dead letter)')
+            self._dead_letter(task)
+            return 'dead'
+
+        delay = self.retry_delay(err)
+        logger.error(f'{task.name} attempt {task.attempts} failed - {error}, retry in {delay} seconds')
+        send_error_message(message=f'{task.name} attempt {task.attempts} failed, retry in {delay} seconds: {err}',
+                           script=script_name, error_type=type(err).__name__)
+        self._push(task, delay)
+        return 'retried'
+
+    def _dead_letter(self, task: Task):
+        self.dead_letter.parent.mkdir(parents=True, exist_ok=True)
+        with self.dead_letter.open('a') as file:
+            file.write(json.dumps({'time': datetime.datetime.now().isoformat(), **task.to_dict()}, default=str) + '\n')
+
+    def run(self) -> Dict:
+        """
+        Runs scheduled tasks until the queue is empty and nothing is running, retries are added by the workers
+        :return: Dict - stats of completed, skipped, retried and dead tasks
+        """
+        with ThreadPoolExecutor(max_workers=self.workers) as pool, self._condition:
+            while self._heap or self._running:
+                if not self._heap or self._running >= self.workers:
+                    self._condition.wait()
+                    continue
+                wait = self._heap[0][0] - time.monotonic()
+                if wait > 0:
+                    self._condition.wait(wait)
+                    continue
+                _, _, task = heapq.heappop(self._heap)
+                self._running += 1
+                pool.submit(self._execute, task)
+        return self.stats
@@ -0,0 +1,70 @@
+import threading
+import requests
+
+from typing import Any, Dict
+
+from web3 import Web3, HTTPProvider
+from web3.types import RPCEndpoint, RPCResponse
+from requests.adapters import HTTPAdapter
+
+from utils.metrics import instrument_web3
+from utils.cassette import install_cassette
+from config import rpc_pool_size, rpc_timeout
+
+"""
+SHARED RPC CONNECTIONS
+One Web3 instance and one tuned requests session per rpc url, shared by all clients and threads,
+so keep-alive connections are reused across wallets instead of new TCP and TLS handshake per client
+"""
+
+
+class PooledHTTPProvider(HTTPProvider):
+    def __init__(self, endpoint_uri: str, session: requests.Session, timeout: float = rpc_timeout):
+        """
+        HTTPProvider that sends requests through the given session from every thread.
+        Default HTTPProvider keeps separate session per thread
+        """
+        super().__init__(endpoint_uri, request_kwargs={'timeout': timeout})
+        self.session = session
+
+    def make_request(self, method: RPCEndpoint, params: Any) -> RPCResponse:
+        request_data = self.encode_rpc_request(method, params)
+        response = self.session.post(self.endpoint_uri, data=request_data, **self.get_request_kwargs())
+        response.raise_for_status()
+        return self.decode_rpc_response(response.content)
+
+
+class ProviderPool:
+    def __init__(self, pool_size: int = rpc_pool_size, timeout: float = rpc_timeout):
+        """
+        :param pool_size: max keep-alive connections per rpc host
+        :param timeout: request timeout in seconds
+        """
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self._web3: Dict[str, Web3] = {}
+        self._lock = threading.Lock()
+
+    def _session(self) -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update({'Connection': 'keep-alive'})
+        install_cassette(session)
+        return session
+
+    def get_web3(self, rpc: str) -> Web3:
+        """
+        :param rpc: rpc url
+        :return: Web3 instance shared by every caller with the same rpc
+        """
+        with self._lock:
+            if rpc not in self._web3:
+                w3 = Web3(PooledHTTPProvider(rpc, session=self._session(), timeout=self.timeout))
+                instrument_web3(w3)
+                self._web3[rpc] = w3
+            return self._web3[rpc]
+
+
+provider_pool = ProviderPool()
@@ -0,0 +1,129 @@
+import os
+import time
+import itertools
+import multiprocessing
+
+from loguru import logger
+from typing import Dict, Iterable, List
+from urllib.parse import urlsplit
+from concurrent.futures import ProcessPoolExecutor
+
+from web3 import Web3
+from web3._utils.request import cache_and_return_session
+from hexbytes import HexBytes
+from eth_account import Account
+from eth_account.datastructures import SignedTransaction
+
+from utils.metrics import metrics
+from utils.tracing import tracer
+from config import signing_workers, signing_chunk_size, broadcast_batch_size
+
+"""
+BULK SIGNING AND BROADCAST
+Signing holds the GIL, so threads sign one by one. Keys are sent to worker processes once at start,
+after that only built transactions go to workers and raw transactions come back
+"""
+
+# accounts of worker process, filled only inside workers by _init_worker
+_worker_accounts: Dict[str, Account] = {}
+
+
+def _init_worker(private_keys: List[str]):
+    for key in private_keys:
+        account = Account.from_key(key)
+        _worker_accounts[account.address] = account
+
+
+def _sign(tx: Dict) -> SignedTransaction:
+    account = _worker_accounts.get(Web3.to_checksum_address(tx['from']))
+    if account is None:
+        raise ValueError(f"no key for {tx['from']} in signing worker")
+    return account.sign_transaction(tx)
+
+
+class SigningService:
+    def __init__(self, private_keys: Iterable[str], workers: int = signing_workers,
+                 chunk_size: int = signing_chunk_size):
+        """
+        Signs fully built transactions in process pool, every worker keeps keys of all accounts.
+        Workers are spawned, not forked, they start lazily from pipeline threads while log and notifier threads run
+        :param private_keys: private keys, hex strings or bytes, e.g. account.key
+        :param workers: number of processes, 0 - one per cpu
+        :param chunk_size: transactions per worker task
+        """
+        self.chunk_size = chunk_size
+        self._pool = ProcessPoolExecutor(max_workers=workers or os.cpu_count(), initializer=_init_worker,
+                                         initargs=([HexBytes(key).hex() for key in private_keys],),
+                                         mp_context=multiprocessing.get_context('spawn'))
+
+    def sign(self, txs: List[Dict]) -> List[SignedTransaction]:
+        """
+        :param txs: transactions with 'from', nonce, fees and gas, e.g. from build_tx_with_data
+        :return: signed transactions in the same order
+        """
+        with tracer.span('sign_batch', size=len(txs)):
+            return list(self._pool.map(_sign, txs, chunksize=self.chunk_size))
+
+    def close(self):
+        self._pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RawTxBroadcaster:
+    def __init__(self, w3: Web3, explorer: str = '', batch_size: int = broadcast_batch_size):
+        """
+        Sends raw transactions with eth_sendRawTransaction in json-rpc batches, one http request per batch
+        :param w3: Web3 with HTTPProvider, pooled provider session is reused
+        :param explorer: (opt) explorer url to log links
+        :param batch_size: transactions in one http request
+        """
+        self.w3 = w3
+        self.endpoint_uri = w3.provider.endpoint_uri
+        # pooled provider has own session shared by threads, default one has session per thread
+        self.session = getattr(w3.provider, 'session', None) or cache_and_return_session(self.endpoint_uri)
+        self.explorer = explorer
+        self.batch_size = batch_size
+
+    def _post(self, payload: List[Dict]) -> List[Dict]:
+        labels = ('eth_sendRawTransaction[batch]', urlsplit(self.endpoint_uri).netloc)
+        start = time.perf_counter()
+        try:
+            response = self.session.post(self.endpoint_uri, json=payload, **self.w3.provider.get_request_kwargs())
+            response.raise_for_status()
+            result = response.json()
+        except Exception:
+            metrics.observe('rpc', labels, latency=time.perf_counter() - start, error=True)
+            raise
+        metrics.observe('rpc', labels, latency=time.perf_counter() - start)
+        # rpc answers with single error object if it does not support batches
+        if not isinstance(result, list):
+            raise ValueError(f'rpc does not support batch requests: {result}')
+        return result
+
+    def broadcast(self, signed_txs: List[SignedTransaction]) -> List[Dict]:
+        """
+        :return: list of {'tx_hash': HexBytes | None, 'error': str | None} in the same order
+        """
+        results = []
+        signed_txs = iter(signed_txs)
+        while batch := list(itertools.islice(signed_txs, self.batch_size)):
+            payload = [{'jsonrpc': '2.0', 'id': i, 'method': 'eth_sendRawTransaction',
+                        'params': [HexBytes(signed_tx.rawTransaction).hex()]} for i, signed_tx in enumerate(batch)]
+            with tracer.span('broadcast_batch', size=len(batch)):
+                responses = {response.get('id'): response for response in self._post(payload)}
+
+            for i, signed_tx in enumerate(batch):
+                response = responses.get(i, {'error': {'message': 'no response'}})
+                if 'error' in response:
+                    logger.error(f"Tx {signed_tx.hash.hex()} was not sent: {response['error'].get('message')}")
+                    results.append({'tx_hash': None, 'error': response['error'].get('message')})
+                else:
+                    tx_hash = HexBytes(response['result'])
+                    logger.info(f'Tx: {self.explorer}tx/{tx_hash.hex()}')
+                    results.append({'tx_hash': tx_hash, 'error': None})
+        return results
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import threading
+import contextlib
+
+from pathlib import Path
+from typing import Dict, List
+
+from config import script_name, trace_file
+
+"""
+LIGHTWEIGHT TRACING OF WALLET OPERATIONS
+Spans follow OpenTelemetry data model and are exported as OTLP/JSON lines (one line per finished trace),
+so the file could be loaded by otel collector (otlpjsonfile receiver) into Jaeger/Tempo.
+Run `python -m utils.tracing logs/traces.jsonl > trace.json` to convert it to chrome trace format
+and open in https://ui.perfetto.dev or chrome://tracing
+"""
+
+STATUS_OK = 1
+STATUS_ERROR = 2
+
+
+class Span:
+    def __init__(self, name: str, trace_id: str, parent_id: str = None, attributes: Dict = None):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        self.status = STATUS_OK
+        self.status_message = ''
+
+    def set_attribute(self, key: str, value):
+        self.attributes[key] = value
+
+    def set_error(self, err: BaseException):
+        self.status = STATUS_ERROR
+        self.status_message = f'{type(err).__name__}: {err}'
+
+    def to_otlp(self) -> Dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [{'key': key, 'value': {'stringValue': str(value)}}
+                           for key, value in self.attributes.items()],
+            'status': {'code': self.status, 'message': self.status_message},
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+
+class FileSpanExporter:
+    def __init__(self, path: str, service_name: str = script_name):
+        """
+        Appends every finished trace as one OTLP/JSON line, directory and file are created with the first trace
+        :param path: trace file path
+        :param service_name: value of service.name resource attribute
+        """
+        self.path = Path(path)
+        self._created = False
+        self.resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': service_name}}]}
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[Span]):
+        line = json.dumps({'resourceSpans': [{
+            'resource': self.resource,
+            'scopeSpans': [{'scope': {'name': 'superform'}, 'spans': [span.to_otlp() for span in spans]}],
+        }]})
+        with self._lock:
+            if not self._created:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                self._created = True
+            with self.path.open('a') as file:
+                file.write(line + '\n')
+
+
+class Tracer:
+    def __init__(self, exporter: FileSpanExporter = None):
+        """
+        Creates spans, keeps the current span per thread and sends finished traces to exporter.
+        Child spans inherit attributes of the parent (wallet, vault, chain)
+        :param exporter: (opt) exporter, tracing is disabled if not provided
+        """
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def _stack(self) -> List[Span]:
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+            self._local.finished = []
+        return stack
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Context manager that wraps the phase of operation into span
+        :param name: span name, e.g. - 'calculate'
+        :param attributes: span attributes, e.g. - wallet=..., vault=..., chain=...
+        """
+        if self.exporter is None:
+            yield None
+            return
+
+        stack = self._stack()
+        if stack:
+            parent = stack[-1]
+            span = Span(name, trace_id=parent.trace_id, parent_id=parent.span_id,
+                        attributes={**parent.attributes, **attributes})
+        else:
+            span = Span(name, trace_id=os.urandom(16).hex(), attributes=attributes)
+
+        stack.append(span)
+        try:
+            yield span
+        except BaseException as err:
+            span.set_error(err)
+            raise
+        finally:
+            span.end_ns = time.time_ns()
+            stack.pop()
+            self._local.finished.append(span)
+            if not stack:
+                finished, self._local.finished = self._local.finished, []
+                self.exporter.export(finished)
+
+
+tracer = Tracer(FileSpanExporter(trace_file) if trace_file else None)
+
+
+def to_chrome_trace(path: str) -> Dict:
+    """
+    Converts OTLP/JSON lines trace file to chrome trace event format, every trace is shown as separate row
+    :param path: trace file path
+    :return: Dict - {'traceEvents': [...]}
+    """
+    events = []
+    with open(path) as file:
+        for row, line in enumerate(file):
+            if not line.strip():
+                continue
+            for resource_spans in json.loads(line)['resourceSpans']:
+                for scope_spans in resource_spans['scopeSpans']:
+                    for span in scope_spans['spans']:
+                        start = int(span['startTimeUnixNano'])
+                        args = {attr['key']: attr['value']['stringValue'] for attr in span['attributes']}
+                        if span['status']['code'] == STATUS_ERROR:
+                            args['error'] = span['status']['message']
+                        events.append({
+                            'name': span['name'],
+                            'ph': 'X',
+                            'ts': start / 1000,
+                            'dur': (int(span['endTimeUnixNano']) - start) / 1000,
+                            'pid': 1,
+                            'tid': row,
+                            'args': args,
+                        })
+    return {'traceEvents': events}
+
+
+if __name__ == '__main__':
+    json.dump(to_chrome_trace(sys.argv[1] if len(sys.argv) > 1 else trace_file), sys.stdout)